@@ -4,12 +4,18 @@ import time
 import sys
 import requests
 import os
+import socket
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from queue import Queue
 
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
+from transcoder import SYSCALL_STREAM_SUFFIX, transcode_scap
+
 
 # Signal-Handler
 def handle_signal(sig, frame):
@@ -25,14 +31,167 @@ def start_sysdig(target_container: str):
     """Starts a sysdig process for monitoring the Docker container with the given name"""
     return subprocess.Popen(["sysdig", "-G", "10", "-w", "recordings/trace.scap", f"container.name={target_container}"])
 
+# output format expected by the ids, has to match SYSDIG_OUTPUT_FORMAT in ids/syscall.py
+SYSDIG_OUTPUT_FORMAT = "%evt.rawtime %proc.name %thread.tid %evt.dir %syscall.type %evt.args"
+
+def start_sysdig_stream(target_container: str):
+    """Starts a sysdig process which prints the syscalls of the Docker container with the given name"""
+    return subprocess.Popen(["sysdig", "-p", SYSDIG_OUTPUT_FORMAT, f"container.name={target_container}"], stdout=subprocess.PIPE)
+
 # register signal handler
 signal.signal(signal.SIGTERM, handle_signal)
 signal.signal(signal.SIGINT, handle_signal)
 
+# Sends scap files to the IDS in the background
+# the files are moved to a spool folder first, so unsent files survive a restart of the agent,
+# and are uploaded gzip compressed by several threads over one connection pool.
+# every file gets a sequence number (per run of the agent) which the IDS uses to process the files in order
+class UploadSender:
+    def __init__(self, endpoint, spool_path, workers=4, max_spool_files=60, transcode=None, stream_id=None):
+        self._endpoint = endpoint
+        # with a stream id the ids keeps the detector state and testcases of this agent apart from other agents
+        self._stream_id = stream_id
+        self._spool_path = spool_path
+        # with transcode (the feature of the ids: name or name_result) the scap files are decoded here
+        # and sent as binary syscall streams (see transcoder.py)
+        self._transcode = transcode
+        self._max_spool_files = max_spool_files
+        self._session = requests.Session()
+        self._session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=workers))
+        self._session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=workers))
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._lock = threading.Lock()
+        # spool file -> (upload session, sequence number, original file name) of all files not uploaded yet
+        self._pending = {}
+        self._upload_session = str(time.time_ns())
+        self._next_sequence = 0
+        if not os.path.exists(spool_path):
+            os.makedirs(spool_path)
+
+    def resume(self):
+        """Sends the files left in the spool folder by a previous run"""
+        spooled = []
+        for spool_name in os.listdir(self._spool_path):
+            parts = spool_name.split("-", 2)
+            if len(parts) == 3 and parts[1].isdigit():
+                spooled.append((parts[0], int(parts[1]), parts[2], os.path.join(self._spool_path, spool_name)))
+        for upload_session, sequence, filename, spool_file in sorted(spooled):
+            print(f'[{get_current_timestamp()}] resending spooled file {filename} ({upload_session}/{sequence})', flush=True)
+            self._add(spool_file, upload_session, sequence, filename)
+
+    def submit(self, file_path):
+        """Moves the file into the spool folder and schedules its upload"""
+        with self._lock:
+            sequence = self._next_sequence
+            self._next_sequence += 1
+        filename = os.path.basename(file_path)
+        spool_file = os.path.join(self._spool_path, f"{self._upload_session}-{sequence:010d}-{filename}")
+        os.replace(file_path, spool_file)
+        self._add(spool_file, self._upload_session, sequence, filename)
+
+    def _add(self, spool_file, upload_session, sequence, filename):
+        with self._lock:
+            self._pending[spool_file] = (upload_session, sequence, filename)
+            # keep the spool bounded, the oldest files are given up
+            while len(self._pending) > self._max_spool_files:
+                oldest = min(self._pending, key=lambda path: self._pending[path][:2])
+                del self._pending[oldest]
+                self._remove(oldest)
+                print(f'[{get_current_timestamp()}] spool full, dropped {oldest}', flush=True)
+        self._executor.submit(self._upload, spool_file)
+
+    def _acked(self, upload_session, sequence):
+        # all sequence numbers below the lowest pending one are uploaded or given up, called with the lock held.
+        # the file itself can be dropped from the spool meanwhile, then nothing of the session may be pending anymore
+        return min((other_sequence for other_session, other_sequence, _ in self._pending.values() if other_session == upload_session),
+                   default=sequence)
+
+    def _compressed_chunks(self, spool_file):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS + 16)  # gzip
+        with open(spool_file, 'rb') as f:
+            while True:
+                chunk = f.read(1 << 20)
+                if not chunk:
+                    break
+                compressed = compressor.compress(chunk)
+                if compressed:
+                    yield compressed
+        yield compressor.flush()
+
+    def _transcode_file(self, spool_file):
+        # replaces the spooled scap file by its binary syscall stream
+        target = spool_file + SYSCALL_STREAM_SUFFIX
+        syscalls = transcode_scap(spool_file, target, with_results=self._transcode == "name_result")
+        with self._lock:
+            if spool_file not in self._pending:
+                self._remove(target)
+                return None
+            upload_session, sequence, filename = self._pending.pop(spool_file)
+            self._pending[target] = (upload_session, sequence, filename + SYSCALL_STREAM_SUFFIX)
+        self._remove(spool_file)
+        print(f'[{get_current_timestamp()}] transcoded {filename}: {syscalls} syscalls, {os.path.getsize(target)} bytes', flush=True)
+        return target
+
+    def _upload(self, spool_file):
+        if self._transcode is not None and not spool_file.endswith(SYSCALL_STREAM_SUFFIX):
+            try:
+                spool_file = self._transcode_file(spool_file)
+            except (OSError, ValueError) as e:
+                print(f'[{get_current_timestamp()}] Error transcoding {spool_file}: {e}', flush=True)
+                return
+            if spool_file is None:
+                return
+        delay = 1
+        while True:
+            with self._lock:
+                if spool_file not in self._pending:
+                    return  # dropped from the spool
+                upload_session, sequence, filename = self._pending[spool_file]
+                acked = self._acked(upload_session, sequence)
+            headers = {
+                "Content-Type": "application/octet-stream",
+                "Content-Encoding": "gzip",
+                "X-Upload-Filename": filename,
+                "X-Upload-Session": upload_session,
+                "X-Upload-Sequence": str(sequence),
+                "X-Upload-Acked": str(acked),
+            }
+            if self._stream_id is not None:
+                headers["X-Stream-Id"] = self._stream_id
+            try:
+                r = self._session.post(self._endpoint, data=self._compressed_chunks(spool_file), headers=headers)
+                r.raise_for_status()
+                print(f'[{get_current_timestamp()}] sent {filename} ({upload_session}/{sequence})', flush=True)
+                break
+            except (requests.exceptions.RequestException, OSError) as e:
+                print(f'[{get_current_timestamp()}] Error {filename}: {e}, retrying in {delay}s', flush=True)
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
+        with self._lock:
+            self._pending.pop(spool_file, None)
+        self._remove(spool_file)
+
+    def _remove(self, spool_file):
+        try:
+            os.remove(spool_file)
+        except OSError as e:
+            print(f"[{get_current_timestamp()}] Error trying do delete: {spool_file} : {e.strerror}", flush=True)
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def shutdown(self):
+        # unsent files stay in the spool folder for the next run
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
 # Handles file observer and sends the files to IDS
 class AgentFileHandler(FileSystemEventHandler):
-    def __init__(self, endpoint):        
+    def __init__(self, endpoint, sender=None, stream_id=None):
         self._endpoint = endpoint
+        self._stream_id = stream_id
+        self._sender = sender
         self._sent_files = set()
         self.last_update_timestamp = time.time()  # Timestamp of the last update in seconds
         self.file_queue = Queue()  # Queue of files to send
@@ -53,7 +212,10 @@ class AgentFileHandler(FileSystemEventHandler):
             # This way we know that file i has been completely written to disk
             return
         file_path = self.file_queue.get_nowait()
-        self.send_file(file_path)
+        if self._sender is not None:
+            self._sender.submit(file_path)
+        else:
+            self.send_file(file_path)
         self.last_update_timestamp = time.time()
         return
 
@@ -62,7 +224,8 @@ class AgentFileHandler(FileSystemEventHandler):
             files = {'file': (os.path.basename(file_path), f)}
             try:
                 print(f'[{get_current_timestamp()}] sending {file_path} ', end='', flush=True)
-                r = requests.post(self._endpoint, files=files)
+                data = {'stream': self._stream_id} if self._stream_id is not None else None
+                r = requests.post(self._endpoint, files=files, data=data)
                 r.raise_for_status()                
             except requests.exceptions.RequestException as e:
                 print(f'[{get_current_timestamp()}] Error {file_path}: {e}', flush=True)
@@ -85,6 +248,63 @@ class AgentFileHandler(FileSystemEventHandler):
         self._sent_files = set()
 
 
+# Sends the live output of sysdig over one persistent tcp connection to the ids (--stream-port of ids.py)
+class SyscallStreamer:
+    def __init__(self, endpoint, stream_id=None):
+        host, port = endpoint.rsplit(":", 1)
+        self._address = (host, int(port))
+        self._stream_id = stream_id
+        self._socket = None
+
+    def connect(self):
+        """(Re)connects to the ids, retries until it is reachable"""
+        self.close()
+        delay = 1
+        while True:
+            try:
+                self._socket = socket.create_connection(self._address)
+                self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                if self._stream_id is not None:
+                    # the first line of a connection names the stream (see stream_server.py of the ids)
+                    self._socket.sendall(b"#stream-id " + self._stream_id.encode() + b"\n")
+                print(f'[{get_current_timestamp()}] streaming syscalls to {self._address[0]}:{self._address[1]}', flush=True)
+                return
+            except OSError as e:
+                print(f'[{get_current_timestamp()}] Error connecting to {self._address[0]}:{self._address[1]}: {e}, retrying in {delay}s', flush=True)
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
+
+    def send(self, data):
+        while True:
+            try:
+                self._socket.sendall(data)
+                return
+            except OSError as e:
+                print(f'[{get_current_timestamp()}] Error sending syscalls: {e}', flush=True)
+                self.connect()
+
+    def stream(self, process):
+        """Forwards the output of the given sysdig process until it ends, only complete lines are sent"""
+        if self._socket is None:
+            self.connect()
+        rest = b""
+        while True:
+            # read1 returns as soon as sysdig has written something, so events are sent right away
+            chunk = process.stdout.read1(1 << 16)
+            if not chunk:
+                break
+            chunk = rest + chunk
+            end = chunk.rfind(b'\n') + 1
+            rest = chunk[end:]
+            if end:
+                self.send(chunk[:end])
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+
 ###########################################################################
 # START
 ###########################################################################
@@ -92,16 +312,47 @@ if __name__ == "__main__":
     # check for command line arguments
     # we want the name of the container to observe on position 1
 
+    # options:
+    #   --stream            the endpoint is host:port of the stream port of the ids and the syscalls are sent live
+    #   --transcode=FEATURE decode the scap files here and send them as binary syscall streams with only the fields
+    #                       the feature of the ids (name or name_result) needs, the endpoint is .../ids/upload_syscalls
+    #   --stream-id=ID      the stream of this agent at the ids, needed if several agents send to one ids
+    options = dict(argument[2:].partition("=")[::2] for argument in sys.argv[1:] if argument.startswith("--"))
+    arguments = [argument for argument in sys.argv if not argument.startswith("--")]
+    streaming = "stream" in options
+    transcode = options.get("transcode")
+    stream_id = options.get("stream-id")
+    if transcode is not None and transcode not in ("name", "name_result"):
+        print("transcode has to be name or name_result")
+        exit()
+
     # Überprüfen Sie, ob Argumente übergeben wurden
-    if len(sys.argv) > 1:        
-        target_container = sys.argv[1]
+    if len(arguments) > 2:
+        target_container = arguments[1]
         print(f"Container Name: {target_container}")
-        endpoint = sys.argv[2]
+        endpoint = arguments[2]
         print(f"Endpoint: {endpoint}")
     else:
-        print("need arguments: container_name endpoint")
+        print("need arguments: container_name endpoint [--stream] [--transcode=name|name_result] [--stream-id=ID]")
         exit()
 
+    if streaming:
+        streamer = SyscallStreamer(endpoint, stream_id=stream_id)
+        try:
+            print("agent is streaming system calls to the given endpoint...")
+            print("--> press ctrl+c to stop agent <--")
+            while True:
+                sysdig_process = start_sysdig_stream(target_container)
+                streamer.stream(sysdig_process)
+                sysdig_process.wait()
+                print(f"[{get_current_timestamp()}] Restarting Sysdig as process seems finished...", flush=True)
+                time.sleep(1)
+        finally:
+            streamer.close()
+            sysdig_process.send_signal(signal.SIGTERM)
+            sysdig_process.wait()
+            print("agent stopped.")
+
     
     path = os.getcwd() + "/recordings/"
     # first check wether the directory already exists, if not create it
@@ -110,7 +361,10 @@ if __name__ == "__main__":
 
     # AgentFileHandler
     print(f"observing files in: {path}")
-    event_handler = AgentFileHandler(endpoint=endpoint)
+    # unsent files of a previous run are sent first
+    sender = UploadSender(endpoint, os.getcwd() + "/spool/", transcode=transcode, stream_id=stream_id)
+    sender.resume()
+    event_handler = AgentFileHandler(endpoint=endpoint, sender=sender, stream_id=stream_id)
     observer = Observer()
     observer.schedule(event_handler, path, recursive=False)
     observer.start()
@@ -148,6 +402,8 @@ if __name__ == "__main__":
                 event_handler.restart()
 
     finally:
+        # unsent files stay in the spool
+        sender.shutdown()
         # stop the observer
         observer.stop()
         # wait for observer 
@@ -0,0 +1,118 @@
+import subprocess
+
+# writes the compact binary syscall stream read by the ids (see ids/syscall_stream.py for the format)
+SYSCALL_STREAM_MAGIC = b"IDSSYSC2"
+SYSCALL_STREAM_SUFFIX = ".sysc"
+
+# output format expected by the ids, has to match SYSDIG_OUTPUT_FORMAT in ids/syscall.py
+SYSDIG_OUTPUT_FORMAT = "%evt.rawtime %proc.name %thread.tid %evt.dir %syscall.type %evt.args"
+
+_DIRECTIONS = {">": 1, "<": 2}
+
+# thread id of events without thread (sysdig prints -1 or <NA>)
+_NO_THREAD = -1
+
+
+def _varint(value, out):
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _zigzag(value, out):
+    _varint(value << 1 if value >= 0 else (-value << 1) - 1, out)
+
+
+def _thread_id(field):
+    try:
+        return int(field)
+    except ValueError:
+        return _NO_THREAD
+
+
+def _string_record(tag, string_id, string):
+    out = bytearray(tag)
+    data = string.encode('utf-8')
+    _varint(string_id, out)
+    _varint(len(data), out)
+    out += data
+    return out
+
+
+class SyscallStreamWriter:
+    """
+    encodes sysdig output lines (SYSDIG_OUTPUT_FORMAT) into the binary syscall stream
+    only timestamp, thread id, syscall name, direction and (with_results) the "res" param are kept
+    """
+
+    def __init__(self, output, with_results=False, block_size=8192):
+        self._output = output
+        self._with_results = with_results
+        self._block_size = block_size
+        self._names = {}
+        self._results = {}
+        self._block = []
+        output.write(SYSCALL_STREAM_MAGIC)
+
+    def add_line(self, line):
+        parts = line.split(' ', 5)
+        if len(parts) < 5:
+            return
+        name_id = self._names.get(parts[4])
+        if name_id is None:
+            name_id = self._names[parts[4]] = len(self._names)
+            self._output.write(_string_record(b"N", name_id, parts[4]))
+        result_id = 0
+        if self._with_results and len(parts) > 5:
+            result = None
+            for param in parts[5].split(' '):
+                if param.startswith("res="):
+                    result = param[4:]
+            if result is not None:
+                result_id = self._results.get(result)
+                if result_id is None:
+                    result_id = self._results[result] = len(self._results) + 1
+                    self._output.write(_string_record(b"R", result_id - 1, result))
+        self._block.append((int(parts[0]), _thread_id(parts[2]), name_id, _DIRECTIONS.get(parts[3], 0), result_id))
+        if len(self._block) >= self._block_size:
+            self.flush()
+
+    def flush(self):
+        if not self._block:
+            return
+        columns = [bytearray() for _ in range(5)]
+        timestamps, thread_ids, name_ids, directions, results = columns
+        base = previous = self._block[0][0]
+        for timestamp, thread_id, name_id, direction, result_id in self._block:
+            _zigzag(timestamp - previous, timestamps)
+            previous = timestamp
+            # zigzag, the thread id can be negative
+            _zigzag(thread_id, thread_ids)
+            _varint(name_id, name_ids)
+            directions.append(direction)
+            if self._with_results:
+                _varint(result_id, results)
+        out = bytearray(b"B")
+        _varint(len(self._block), out)
+        _zigzag(base, out)
+        for column in columns:
+            _varint(len(column), out)
+            out += column
+        self._output.write(out)
+        self._block = []
+
+
+def transcode_scap(scap_file, output_file, with_results=False):
+    """
+    decodes a scap file with sysdig and writes it as binary syscall stream, returns the number of syscalls
+    """
+    syscalls = 0
+    with open(output_file, 'wb') as output, \
+            subprocess.Popen(["sysdig", "-r", scap_file, "-p", SYSDIG_OUTPUT_FORMAT], stdout=subprocess.PIPE) as proc:
+        writer = SyscallStreamWriter(output, with_results)
+        for line in proc.stdout:
+            writer.add_line(line.decode('utf-8', errors='replace').rstrip('\n'))
+            syscalls += 1
+        writer.flush()
+    return syscalls
@@ -1,34 +1,257 @@
 from typing import Callable
-from collections import deque
-from syscall import Syscall
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from syscall import Syscall, SyscallBatch, THREAD_EXITS
+from vocabulary import Vocabulary
+
+# limits of the per thread ngram history, see expire_threads
+MAX_THREADS = 65536
+# threads without syscalls for this long (in syscall time) are forgotten
+THREAD_IDLE_NS = 600 * 1_000_000_000
+
 
 class ANgram():
     """
     calculate thread aware ngram form a stream of system calls
+
+    the elements (mapped system calls) are interned in a Vocabulary and each ngram is packed
+    into a single integer key: every element id takes `bits` bits, the oldest element sits in
+    the highest bits. per thread only the packed key of its last n elements is stored, so
+    appending an element is one shift, one or and one mask.
     """
 
-    def __init__(self, n: int):
+    def __init__(self, n: int, vocabulary: Vocabulary = None, on_repack: Callable[[int], None] = None, bits: int = None):
         """
         n: length of the ngram
+        vocabulary: vocabulary of the elements, a new one is created if None
+        on_repack: called with the old number of bits whenever the key layout had to grow,
+                   keys created before have to be converted with repack()
+        bits: bits per element of the packed keys, the smallest width that fits the vocabulary if None
         """
         self._ngram_buffer = {}
+        # thread id -> timestamp of its last syscall, least recently seen first (see expire_threads)
+        self._last_seen = {}
+        self.max_threads = MAX_THREADS
+        self.idle_ns = THREAD_IDLE_NS
         self._n = n
+        self.vocabulary = vocabulary if vocabulary is not None else Vocabulary()
+        self._on_repack = on_repack
+        # single entry cache for translate_ids: (source vocabulary, translation table)
+        self._translation = (None, [])
+        if bits is None:
+            bits = max(1, (len(self.vocabulary) - 1).bit_length())
+        self._set_bits(bits)
 
-    def get_ngram(self, syscall: Syscall, element: Callable[[Syscall], str]):
+    def _set_bits(self, bits):
+        self._bits = bits
+        self._max_id = (1 << bits) - 1
+        self._mask = (1 << (bits * self._n)) - 1
+        # a key is a complete ngram as soon as its oldest slot is not EMPTY
+        self._oldest_shift = bits * (self._n - 1)
+
+    @property
+    def n(self):
+        return self._n
+
+    @property
+    def bits(self):
+        return self._bits
+
+    def _grow(self):
+        """
+        widens the key layout after the vocabulary outgrew it and repacks all thread buffers
+        """
+        old_bits = self._bits
+        self._set_bits((len(self.vocabulary) - 1).bit_length())
+        for thread_id, key in self._ngram_buffer.items():
+            self._ngram_buffer[thread_id] = self.repack(key, old_bits)
+        if self._on_repack is not None:
+            self._on_repack(old_bits)
+
+    def element_id(self, element: str) -> int:
+        """
+        returns the vocabulary id of the given element
+        """
+        element_id = self.vocabulary.get_id(element)
+        if element_id > self._max_id:
+            self._grow()
+        return element_id
+
+    def translate_ids(self, source: Vocabulary, ids):
+        """
+        maps ids of another vocabulary (e.g. the interned syscall names of a SyscallBatch)
+        to element ids of this ngram builder, returns a list
+        """
+        cached_source, table = self._translation
+        if cached_source is not source:
+            table = []
+            self._translation = (source, table)
+        if len(table) < len(source):
+            strings = source.strings()
+            for source_id in range(len(table), len(strings)):
+                table.append(self.vocabulary.get_id(strings[source_id]))
+            if len(self.vocabulary) - 1 > self._max_id:
+                self._grow()
+        return [table[source_id] for source_id in ids]
+
+    def add_id(self, thread_id: int, element_id: int):
+        """
+        appends an element id to the ngram of the given thread
+        returns None if the ngram is not full
+        otherwise returns the packed key of the ngram
+        """
+        key = ((self._ngram_buffer.get(thread_id, 0) << self._bits) | element_id) & self._mask
+        self._ngram_buffer[thread_id] = key
+        if key >> self._oldest_shift:
+            return key
+        return None
+
+    def get_ngram_key(self, syscall: Syscall, element: Callable[[Syscall], str]):
         """
         builds ngrams from given system calls
         returns None if the ngrams are not full
-        otherwise returns a tuple of length n (the ngram) of strings
-        """        
+        otherwise returns the packed key of the ngram
+        """
         # group by thread id
         thread_id = syscall.thread_id()
-        if thread_id not in self._ngram_buffer:
-            self._ngram_buffer[thread_id] = deque(maxlen=self._n)
-        
-        # append the current element (generated from the syscall) to the ngram
-        self._ngram_buffer[thread_id].append(element(syscall))
-
-        # return the ngram if its complete
-        if len(self._ngram_buffer[thread_id]) == self._n:
-            return tuple(self._ngram_buffer[thread_id])
-        return None
+        return self.add_id(thread_id, self.element_id(element(syscall)))
+
+    def get_ngram(self, syscall: Syscall, element: Callable[[Syscall], str]):
+        """
+        builds ngrams from given system calls
+        returns None if the ngrams are not full
+        otherwise returns a tuple of length n (the ngram) of strings
+        """
+        key = self.get_ngram_key(syscall, element)
+        if key is None:
+            return None
+        return self.unpack(key)
+
+    def get_ngram_windows(self, thread_ids: np.ndarray, element_ids: np.ndarray) -> np.ndarray:
+        """
+        vectorized variant of add_id for a whole batch of syscalls
+        returns a (len, n) array with the ngram (element ids, oldest first) of every syscall,
+        ngrams which are not full yet start with EMPTY (0) ids.
+        the thread buffers are continued from and updated to the end of the batch
+        """
+        count = len(thread_ids)
+        windows = np.zeros((count, self._n), dtype=np.uint32)
+        if count == 0:
+            return windows
+        # group the syscalls by thread id, keeping their order within each thread
+        order = np.argsort(thread_ids, kind='stable')
+        sorted_thread_ids = thread_ids[order]
+        starts = np.concatenate(([0], np.flatnonzero(sorted_thread_ids[1:] != sorted_thread_ids[:-1]) + 1))
+        ends = np.append(starts[1:], count)
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            rows = order[start:end]
+            thread_id = int(sorted_thread_ids[start])
+            # the last n-1 elements of the thread, followed by the new ones
+            history = self._unpack_ids(self._ngram_buffer.get(thread_id, 0))[1:]
+            sequence = np.concatenate((np.array(history, dtype=np.uint32), element_ids[rows].astype(np.uint32)))
+            windows[rows] = sliding_window_view(sequence, self._n)
+            self._ngram_buffer[thread_id] = self._pack_ids(sequence[-self._n:].tolist())
+        return windows
+
+    def thread_count(self) -> int:
+        """
+        returns the number of threads with a ngram history
+        """
+        return len(self._ngram_buffer)
+
+    def expire_threads(self, thread_ids: np.ndarray, timestamps: np.ndarray, exited=()):
+        """
+        forgets the ngram history of threads which exited (see syscall.THREAD_EXITS) or were idle for idle_ns, and of the least
+        recently seen threads beyond max_threads, called after each batch with its thread ids and timestamps.
+        a new thread reusing the id of a forgotten one starts with an empty ngram.
+        returns the number of (exited, expired) threads which were forgotten
+        """
+        last_seen = self._last_seen
+        if len(thread_ids) > 0:
+            # the last timestamp of every thread in the batch, moved to the end in the order of these timestamps
+            threads, last_rows = np.unique(thread_ids[::-1], return_index=True)
+            last_timestamps = timestamps[::-1][last_rows]
+            order = np.argsort(last_timestamps, kind='stable')
+            for thread_id, timestamp in zip(threads[order].tolist(), last_timestamps[order].tolist()):
+                last_seen.pop(thread_id, None)
+                last_seen[thread_id] = timestamp
+        exited_count = 0
+        for thread_id in exited:
+            if self._forget(thread_id):
+                exited_count += 1
+        expired_count = 0
+        if len(timestamps) > 0:
+            idle_since = int(timestamps.max()) - self.idle_ns
+            while last_seen and next(iter(last_seen.values())) < idle_since:
+                self._forget(next(iter(last_seen)))
+                expired_count += 1
+        while len(last_seen) > self.max_threads:
+            self._forget(next(iter(last_seen)))
+            expired_count += 1
+        return exited_count, expired_count
+
+    def expire_batch_threads(self, batch: SyscallBatch):
+        """
+        expire_threads after the given batch, the threads with one of the THREAD_EXITS in it exited
+        """
+        return self.expire_threads(np.frombuffer(batch.thread_ids, dtype=np.int64), np.frombuffer(batch.timestamps, dtype=np.int64),
+                                   batch.thread_ids_of(THREAD_EXITS))
+
+    def _forget(self, thread_id) -> bool:
+        self._last_seen.pop(thread_id, None)
+        return self._ngram_buffer.pop(thread_id, None) is not None
+
+    def _unpack_ids(self, key: int) -> list:
+        return [(key >> (self._bits * position)) & self._max_id for position in range(self._n - 1, -1, -1)]
+
+    def _pack_ids(self, element_ids) -> int:
+        key = 0
+        for element_id in element_ids:
+            key = (key << self._bits) | element_id
+        return key
+
+    def pack(self, ngram: tuple) -> int:
+        """
+        packs a tuple of n strings into a key
+        """
+        if len(ngram) != self._n:
+            raise ValueError(f"Invalid ngram length {len(ngram)}. Must be {self._n}.")
+        # intern all elements first, the key layout might grow while doing so
+        element_ids = [self.element_id(element) for element in ngram]
+        return self._pack_ids(element_ids)
+
+    def unpack(self, key: int) -> tuple:
+        """
+        unpacks a key into a tuple of n strings
+        """
+        strings = self.vocabulary.strings()
+        return tuple(strings[element_id] for element_id in self._unpack_ids(key))
+
+    def repack(self, key: int, old_bits: int) -> int:
+        """
+        converts a key packed with old_bits bits per element to the current layout
+        """
+        old_max_id = (1 << old_bits) - 1
+        new_key = 0
+        for position in range(self._n - 1, -1, -1):
+            new_key = (new_key << self._bits) | ((key >> (old_bits * position)) & old_max_id)
+        return new_key
+
+    def take_over_buffers(self, other: "ANgram"):
+        """
+        continues the per thread ngrams of another ngram builder with the same n (e.g. of the model before a reload),
+        their elements are mapped to the ids of this vocabulary
+        """
+        if other.n != self._n:
+            raise ValueError(f"Can't continue ngrams with n={other.n} with n={self._n}")
+        other_strings = other.vocabulary.strings()
+        translation = {Vocabulary.EMPTY: Vocabulary.EMPTY, Vocabulary.UNKNOWN: Vocabulary.UNKNOWN}
+        for thread_id, key in list(other._ngram_buffer.items()):
+            element_ids = []
+            for element_id in other._unpack_ids(key):
+                if element_id not in translation:
+                    translation[element_id] = self.element_id(other_strings[element_id])
+                element_ids.append(translation[element_id])
+            self._ngram_buffer[thread_id] = self._pack_ids(element_ids)
+        self._last_seen = dict(other._last_seen)
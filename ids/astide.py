@@ -1,9 +1,15 @@
 from collections import deque
+import copy
 import time
-import json
 
-from syscall import Syscall
+import numpy as np
+
+from syscall import Syscall, SyscallBatch
 from angram import ANgram
+from vocabulary import Vocabulary
+from ngram_table import SortedNgramTable, BloomNgramFilter, pack_windows, MEMBERSHIPS, MEMBERSHIP_SET, MEMBERSHIP_BLOOM, DEFAULT_FALSE_POSITIVE_RATE
+from model_store import BinaryModel, DeltaLog, is_binary_model_file, read_json_model, write_json_model, write_binary_model, read_delta_log, remove_delta_log, BINARY_MODEL_SUFFIX, ASTIDE_MODEL
+from stats import window_means
 
 # helper function: maps a given system call to its name
 def name(syscall: Syscall):
@@ -20,7 +26,10 @@ def name_ret(syscall: Syscall):
 
 class ASTIDE():
     # Initialize ASTIDE with given number of ngrams, window size, and early stopping time
-    def __init__(self, mode="detection", n=5, w=500, es_training_seconds=600, syscall_mapper=name, model_file="models/mosquitto_default.json"):
+    # membership: backend of the normal database in detection mode (see ngram_table.MEMBERSHIPS),
+    # false_positive_rate: of the bloom backend
+    def __init__(self, mode="detection", n=5, w=500, es_training_seconds=600, syscall_mapper=name, model_file="models/mosquitto_default.json",
+                 membership=MEMBERSHIP_SET, false_positive_rate=DEFAULT_FALSE_POSITIVE_RATE):
 
         # Set the ngram number
         self._n = n
@@ -28,12 +37,19 @@ class ASTIDE():
         self._w = w
 
         self._syscall_mapper = syscall_mapper
+        # the name mapper only needs the syscall name column of a SyscallBatch, the others need the params
+        self.needs_syscall_params = syscall_mapper is not name
 
         # current operating mode
         self.mode = mode
 
         # model file
         self._model_file = model_file
+
+        if membership not in MEMBERSHIPS:
+            raise ValueError(f"membership has to be one of {MEMBERSHIPS}")
+        self._membership = membership
+        self._false_positive_rate = false_positive_rate
         
         # Set the training syscall counter and ngram counter
         self._seen_training_syscalls = 0
@@ -44,8 +60,13 @@ class ASTIDE():
         self._early_stopping_last_modification_ts = 0
         self._early_stopping_last_seen_ts = 0
 
-        # Initialize an empty set to hold normal syscall ngrams
+        # Initialize an empty set to hold the packed keys of normal syscall ngrams
         self._normal_database = set()
+        # sorted array copy of the normal database for score_batch, built on demand
+        self._lookup_table_cache = None
+        # packed keys of the ngrams added since the last checkpoint, and the delta log they are appended to
+        self._checkpoint_keys = set()
+        self._delta_log = None
         
         # Initialize an empty deque to hold the mismatch buffer within the sliding window
         self._window_mismatch_buffer = deque(maxlen=self._w)
@@ -53,11 +74,11 @@ class ASTIDE():
         self._number_of_mismatches_in_window = 0
 
         # Initialize an ngram builder with a specific ngram number
-        self._ngram_builder = ANgram(n)
+        self._ngram_builder = ANgram(n, on_repack=self._repack_database)
 
         if self.mode == "detection":
             print(f"[ASTIDE] started in detection mode...")
-            self.from_json_file(self._model_file)
+            self.load_model(self._model_file)
         else:
             print(f"[ASTIDE] started in training mode...")
 
@@ -66,16 +87,56 @@ class ASTIDE():
         """
         creates a set for distinct ngrams from training data
         """
+        thread_id = syscall.thread_id()
+        self._train_on_element(syscall.timestamp_unix_in_ns(), thread_id, self._ngram_builder.element_id(self._syscall_mapper(syscall)))
+
+    # Method to train on all syscalls of a SyscallBatch
+    def train_on_batch(self, batch: SyscallBatch):
+        """
+        same as train_on for every row of the given batch, without creating Syscall objects
+        """
+        for timestamp, thread_id, element in zip(batch.timestamps, batch.thread_ids, self._map_batch(batch)):
+            self._train_on_element(timestamp, thread_id, element)
+
+    def _train_on_element(self, timestamp, thread_id, element_id):
         self._seen_training_syscalls += 1
-        self._early_stopping_last_seen_ts = syscall.timestamp_unix_in_ns() / 1_000_000_000
+        self._early_stopping_last_seen_ts = timestamp / 1_000_000_000
         # Generate an ngram from the syscall
-        ngram = self._ngram_builder.get_ngram(syscall, self._syscall_mapper)
+        ngram = self._ngram_builder.add_id(thread_id, element_id)
         if ngram is not None:
             self._seen_training_ngrams += 1
             # If the ngram is not already in the normal database, add it
             if ngram not in self._normal_database:
                 self._normal_database.add(ngram)
-                self._early_stopping_last_modification_ts = syscall.timestamp_unix_in_ns() / 1_000_000_000
+                self._checkpoint_keys.add(ngram)
+                self._lookup_table_cache = None
+                self._early_stopping_last_modification_ts = timestamp / 1_000_000_000
+
+    # Helper function to map all rows of a SyscallBatch with the syscall mapper to element ids
+    def _map_batch(self, batch: SyscallBatch):
+        if self._syscall_mapper is name:
+            return self._ngram_builder.translate_ids(batch.names, batch.name_ids)
+        element_id = self._ngram_builder.element_id
+        return [element_id(self._syscall_mapper(row)) for row in batch.rows()]
+
+    # Helper function to convert the database keys after the ngram key layout has grown
+    def _repack_database(self, old_bits):
+        repack = self._ngram_builder.repack
+        self._normal_database = {repack(key, old_bits) for key in self._normal_database}
+        self._checkpoint_keys = {repack(key, old_bits) for key in self._checkpoint_keys}
+        self._lookup_table_cache = None
+
+    # Method to add ngrams which were counted elsewhere (e.g. offline training) to the normal database
+    def merge_ngrams(self, ngrams):
+        """
+        adds the given (ngram tuple, count) pairs to the normal database
+        """
+        pack = self._ngram_builder.pack
+        for ngram, _ in ngrams:
+            # packing may grow the key layout and replace the database, so pack before looking it up
+            key = pack(ngram)
+            self._normal_database.add(key)
+        self._lookup_table_cache = None
 
     # Method to reset the window mismatch buffer and the counter for number of mismatches
     def reset_buffer(self):
@@ -84,26 +145,73 @@ class ASTIDE():
         # Reset the number of mismatches
         self._number_of_mismatches_in_window = 0 
 
+    # Method to create another detector (e.g. for another stream) which shares the model of this one
+    def shared_copy(self):
+        """
+        returns a detector with its own thread ngrams and sliding window, but the (read only) model of this detector
+        only possible in detection mode, the model of a training detector changes
+        """
+        if self.mode != "detection":
+            raise ValueError("only a detection model can be shared")
+        detector = copy.copy(self)
+        # the frozen vocabulary never grows, so the shared key layout and database stay as they are
+        detector._ngram_builder = ANgram(self._n, self._ngram_builder.vocabulary, on_repack=detector._repack_database, bits=self._ngram_builder.bits)
+        detector._lookup_table_cache = self._lookup_table()
+        detector._window_mismatch_buffer = deque(maxlen=self._w)
+        detector._number_of_mismatches_in_window = 0
+        return detector
+
+    # Method to get the number of unique ngrams of the model (set, sorted table and bloom filter hold every ngram once)
+    def ngram_count(self):
+        return len(self._normal_database)
+
+    # Method to continue the running state of another ASTIDE (e.g. the one of the previous model after a reload)
+    def take_over_state(self, detector):
+        """
+        continues the thread ngrams and the sliding window of mismatches of the given detector
+        """
+        self._ngram_builder.take_over_buffers(detector._ngram_builder)
+        self._window_mismatch_buffer = deque(detector._window_mismatch_buffer, maxlen=self._w)
+        self._number_of_mismatches_in_window = sum(self._window_mismatch_buffer)
+
     # Method to finalize the training (currently prints the current size of the training set)
     def fit(self):        
         # print(self._normal_database)
         print(f"[ASTIDE] astide.seen_syscalls in training: {self._seen_training_syscalls}")
         print(f"[ASTIDE] astide.seen_ngrams in training  : {self._seen_training_ngrams}")
         print(f"[ASTIDE] astide.train_set                : {len(self._normal_database)}")
-        self.to_json_file(self._model_file)
         
         dt = self._early_stopping_last_seen_ts - self._early_stopping_last_modification_ts
         print(f"[ASTIDE] time since last model change: {dt} seconds ")
+        # the final model is written as one snapshot
+        self.checkpoint(compact=dt >= self._early_stopping_seconds)
         if dt >= self._early_stopping_seconds:
             # training done...
             print("[ASTIDE] training done -> switch to detection")
             self.mode = "detection"
+            self._ngram_builder.vocabulary.frozen = True
             
 
+    # Method to save the training progress without writing the whole model every time
+    def checkpoint(self, compact=False):
+        """
+        appends the ngrams added since the last checkpoint to the delta log of the model file.
+        a full snapshot of the model replaces the model file and the delta log instead at the first checkpoint,
+        if compact is set or if the delta log has grown too big (see model_store.DELTA_COMPACT_RATIO)
+        """
+        if self._delta_log is None or compact or self._delta_log.needs_compaction(len(self._checkpoint_keys), len(self._normal_database)):
+            self.save_model(self._model_file)
+            self._delta_log = DeltaLog(self._model_file)
+        else:
+            unpack = self._ngram_builder.unpack
+            self._delta_log.append((unpack(key), 1) for key in self._checkpoint_keys)
+            print(f"[ASTIDE] {len(self._checkpoint_keys)} new ngrams appended to {self._delta_log.file_name}")
+        self._checkpoint_keys = set()
+
     # Helper function to determine if a given ngram is a mismatch
-    def _is_mismatch(self, ngram: tuple):
+    def _is_mismatch(self, ngram: int):
         """
-        calculates whether the given ngram is a match (0) or mismatch (1)
+        calculates whether the given ngram (packed key) is a match (0) or mismatch (1)
         """       
         # If the ngram is in the normal database, it's a match, otherwise it's a mismatch
         if ngram in self._normal_database:
@@ -116,8 +224,61 @@ class ASTIDE():
         """
         calculates ratio of unknown ngrams in sliding window of current recording
         """
+        thread_id = syscall.thread_id()
+        return self._score_element(thread_id, self._ngram_builder.element_id(self._syscall_mapper(syscall)))
+
+    # Method to calculate the scores for all syscalls of a SyscallBatch
+    def get_scores(self, batch: SyscallBatch):
+        """
+        same as get_score for every row of the given batch, returns a list with one score (or None) per row
+        """
+        return [self._score_element(thread_id, element) for thread_id, element in zip(batch.thread_ids, self._map_batch(batch))]
+
+    # Method to calculate the scores for all syscalls of a SyscallBatch with vectorized array operations
+    def score_batch(self, batch: SyscallBatch):
+        """
+        same result as get_scores, but returns a numpy array with one score per row (NaN for no score).
+        the ngram and window state is shared with get_score, so both can be mixed and the state carries across batches
+        """
+        return self.score_windows(self.ngram_windows(batch))
+
+    def ngram_windows(self, batch: SyscallBatch):
+        """
+        maps the rows of the batch to elements and returns their ngram windows (see ANgram.get_ngram_windows)
+        """
+        element_ids = np.array(self._map_batch(batch), dtype=np.uint32)
+        return self._ngram_builder.get_ngram_windows(np.frombuffer(batch.thread_ids, dtype=np.int64), element_ids)
+
+    def expire_threads(self, batch: SyscallBatch):
+        """
+        forgets the ngram history of the threads which exited or went idle (see ANgram.expire_threads), after each batch
+        """
+        return self._ngram_builder.expire_batch_threads(batch)
+
+    def score_windows(self, windows: np.ndarray):
+        """
+        scores the ngram windows returned by ANgram.get_ngram_windows
+        """
+        scores = np.full(len(windows), np.nan)
+        # only full ngrams are added to the mismatch window
+        complete = windows[:, 0] != 0
+        keys = pack_windows(windows[complete], self._ngram_builder.bits)
+        mismatches = (~self._lookup_table().contains(keys)).astype(np.int64)
+        scores[complete] = window_means(mismatches, self._window_mismatch_buffer, self._w)
+        self._number_of_mismatches_in_window = sum(self._window_mismatch_buffer)
+        return scores
+
+    # Helper function returning the normal database as SortedNgramTable (or as the BloomNgramFilter it is)
+    def _lookup_table(self):
+        if isinstance(self._normal_database, (SortedNgramTable, BloomNgramFilter)):
+            return self._normal_database
+        if self._lookup_table_cache is None:
+            self._lookup_table_cache = SortedNgramTable.from_keys(self._normal_database, self._ngram_builder.bits, self._n)
+        return self._lookup_table_cache
+
+    def _score_element(self, thread_id, element_id):
         # Generate an ngram from the syscall
-        ngram = self._ngram_builder.get_ngram(syscall, self._syscall_mapper)
+        ngram = self._ngram_builder.add_id(thread_id, element_id)
         if ngram is not None:            
             # Determine if the ngram is a mismatch
             mismatch = self._is_mismatch(ngram)
@@ -139,24 +300,101 @@ class ASTIDE():
         # If no ngram could be generated or the window is not full, return None
         return None
     
+    def load_model(self, file_name):
+        """
+        loads a model from a binary or a json model file and the ngrams of its delta log
+        """
+        if is_binary_model_file(file_name):
+            self.from_binary_file(file_name)
+        else:
+            self.from_json_file(file_name)
+        self._apply_delta_log(file_name)
+        if self.mode == "detection" and self._membership != MEMBERSHIP_SET:
+            self._compact_database()
+
+    def _compact_database(self):
+        # the read only normal database of detection is replaced by the compact backend of self._membership
+        table = self._lookup_table()
+        if self._membership == MEMBERSHIP_BLOOM:
+            self._normal_database = BloomNgramFilter.from_keys(table.keys(), table.bits, table.n, self._false_positive_rate)
+        else:
+            self._normal_database = table
+        self._lookup_table_cache = None
+        print(f"[ASTIDE] normal db as {self._membership}: {self._normal_database.nbytes} bytes")
+
+    def _apply_delta_log(self, file_name):
+        ngrams = read_delta_log(file_name)
+        if not ngrams:
+            return
+        if isinstance(self._normal_database, SortedNgramTable):
+            # a memory mapped model can't be changed in place
+            self._normal_database = set(self._normal_database)
+        # the delta log may hold elements which are not in the snapshot yet
+        vocabulary = self._ngram_builder.vocabulary
+        frozen = vocabulary.frozen
+        vocabulary.frozen = False
+        self.merge_ngrams(ngrams)
+        vocabulary.frozen = frozen
+        print(f"[ASTIDE] {len(ngrams)} ngrams of the delta log applied, normal db size: {len(self._normal_database)}")
+
+    def save_model(self, file_name):
+        """
+        saves the current model, in the binary format if the file name ends with BINARY_MODEL_SUFFIX, as json otherwise
+        a delta log of the file is removed, the saved model contains its ngrams
+        """
+        if file_name.endswith(BINARY_MODEL_SUFFIX):
+            self.to_binary_file(file_name)
+        else:
+            self.to_json_file(file_name)
+        remove_delta_log(file_name)
+
     def to_json_file(self, file_name):
         """
         saves the current model to a json file
         """
-        model = {}
-        model["normal_database"] = list(self._normal_database)
-        with open(file_name, 'w') as outfile:
-            json.dump(model, outfile, indent=4)
-            print(f"[ASTIDE] model saved to {file_name}")
+        unpack = self._ngram_builder.unpack
+        write_json_model(file_name, ASTIDE_MODEL, ((unpack(key), 1) for key in self._normal_database))
+        print(f"[ASTIDE] model saved to {file_name}")
 
     def from_json_file(self, file_name):
         """
         loads a model from a json file
         """
-        with open(file_name) as json_file:
-            model = json.load(json_file)            
-            self._normal_database = set()
-            for element in model["normal_database"]:
-                self._normal_database.add(tuple(element))             
-            print(f"[ASTIDE] model loaded from {file_name}")
-            print(f"[ASTIDE] normal db size: {len(self._normal_database)}")
+        kind, ngrams = read_json_model(file_name)
+        if kind != ASTIDE_MODEL:
+            raise ValueError(f"{file_name} is a {kind} model, not an {ASTIDE_MODEL} model")
+        # build the vocabulary first, so that the key layout fits all elements of the model
+        vocabulary = Vocabulary()
+        for ngram, _ in ngrams:
+            for element in ngram:
+                vocabulary.add(element)
+        vocabulary.frozen = self.mode == "detection"
+        self._ngram_builder = ANgram(self._n, vocabulary, on_repack=self._repack_database)
+        self._normal_database = set()
+        for ngram, _ in ngrams:
+            self._normal_database.add(self._ngram_builder.pack(ngram))
+        self._lookup_table_cache = None
+        print(f"[ASTIDE] model loaded from {file_name}")
+        print(f"[ASTIDE] normal db size: {len(self._normal_database)}")
+
+    def to_binary_file(self, file_name):
+        """
+        saves the current model to a binary model file
+        """
+        write_binary_model(file_name, ASTIDE_MODEL, self._n, self._ngram_builder.bits, self._ngram_builder.vocabulary,
+                           ((key, 1) for key in self._normal_database))
+        print(f"[ASTIDE] model saved to {file_name}")
+
+    def from_binary_file(self, file_name):
+        """
+        opens a binary model file, the ngrams are looked up in the memory mapped file
+        """
+        model = BinaryModel(file_name)
+        if model.kind != ASTIDE_MODEL or model.n != self._n:
+            raise ValueError(f"{file_name} is a {model.kind} model with n={model.n}, expected {ASTIDE_MODEL} with n={self._n}")
+        model.vocabulary.frozen = self.mode == "detection"
+        self._ngram_builder = ANgram(self._n, model.vocabulary, on_repack=self._repack_database, bits=model.bits)
+        self._normal_database = model.table
+        self._lookup_table_cache = None
+        print(f"[ASTIDE] model loaded from {file_name}")
+        print(f"[ASTIDE] normal db size: {len(self._normal_database)}")
@@ -0,0 +1,145 @@
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+
+# production server of ids.py (--async-server) on aiohttp instead of the development server of flask,
+# with the same endpoints (the plain endpoint functions of ids.py):
+#   - upload bodies are streamed to the incoming folder in chunks by a pool of upload threads, they are never held
+#     in memory, and a busy pool leaves further bodies in the socket buffers (backpressure to the agents)
+#   - the testcase endpoints are handled right in the event loop with the timestamp taken when the request arrives,
+#     so they never wait behind uploads, the other control endpoints run in the default executor
+# the event loop itself never blocks on files, sysdig or the pipeline queues
+
+_CHUNK_SIZE = 1 << 20
+_TEXT = "text/html"
+
+
+class _BodyReader:
+    """
+    file like read(size) on the body of an aiohttp request for a thread outside the event loop
+    """
+
+    def __init__(self, content, loop):
+        self._content = content
+        self._loop = loop
+
+    def read(self, size=-1):
+        return asyncio.run_coroutine_threadsafe(self._content.read(size), self._loop).result()
+
+
+def _response(result):
+    # the endpoint functions return (body, status) or (body, status, content type) like flask routes
+    body, status = result[0], result[1]
+    if isinstance(body, (dict, list)):
+        return web.json_response(body, status=status)
+    content_type = result[2] if len(result) > 2 else _TEXT
+    return web.Response(body=body.encode(), status=status, headers={"Content-Type": content_type})
+
+
+class AsyncServer:
+    """
+    control_routes: list of (method, path, function(data, timestamp), inline), data is the json body (None without)
+        inline functions are called in the event loop and have to be fast (the testcase endpoints)
+    upload_routes: list of (path, function(headers, body)), body is a binary stream (read(size)) of the request body,
+        called in an upload thread
+    form_uploads: paths which also accept a multipart upload (field "file" and optional field "stream"),
+        it is saved to incoming_file_name(file name) and passed on with accept_form_upload(incoming file, file name, stream id)
+    """
+
+    def __init__(self, control_routes, upload_routes, form_uploads, incoming_file_name, accept_form_upload, upload_workers=8):
+        self._control_routes = control_routes
+        self._upload_routes = upload_routes
+        self._form_uploads = set(form_uploads)
+        self._incoming_file_name = incoming_file_name
+        self._accept_form_upload = accept_form_upload
+        self._upload_workers = upload_workers
+        self._executor = None
+
+    def create_app(self):
+        # compressed upload bodies are decompressed by decompress_to_file in the upload threads, not in the event loop
+        app = web.Application(handler_args={"auto_decompress": False})
+        for method, path, function, inline in self._control_routes:
+            app.router.add_route(method, path, self._control_handler(function, inline))
+        for path, function in self._upload_routes:
+            app.router.add_post(path, self._upload_handler(path, function))
+        app.on_startup.append(self._start_executor)
+        app.on_cleanup.append(self._stop_executor)
+        return app
+
+    async def _start_executor(self, app):
+        self._executor = ThreadPoolExecutor(max_workers=self._upload_workers, thread_name_prefix="Upload")
+
+    async def _stop_executor(self, app):
+        self._executor.shutdown(wait=True)
+
+    def _control_handler(self, function, inline):
+        async def handle(request):
+            # taken before the body is read, the time the request arrived
+            timestamp = time.time_ns()
+            data = None
+            if request.can_read_body:
+                try:
+                    data = json.loads(await request.read())
+                except ValueError:
+                    return web.Response(text="invalid json", status=400)
+            if inline:
+                result = function(data, timestamp)
+            else:
+                result = await asyncio.get_running_loop().run_in_executor(None, function, data, timestamp)
+            return _response(result)
+        return handle
+
+    def _upload_handler(self, path, function):
+        async def handle(request):
+            loop = asyncio.get_running_loop()
+            if path in self._form_uploads and request.content_type == "multipart/form-data":
+                return _response(await self._form_upload(request, loop))
+            body = _BodyReader(request.content, loop)
+            return _response(await loop.run_in_executor(self._executor, function, request.headers, body))
+        return handle
+
+    async def _form_upload(self, request, loop):
+        reader = await request.multipart()
+        stream_id = request.headers.get('X-Stream-Id')
+        incoming_file = file_name = None
+        try:
+            while True:
+                part = await reader.next()
+                if part is None:
+                    break
+                if part.name == "file" and incoming_file is None:
+                    file_name = part.filename or ""
+                    if file_name == "":
+                        return "no file_name in request", 400
+                    incoming_file = self._incoming_file_name(file_name)
+                    await self._save_part(part, incoming_file, loop)
+                elif part.name == "stream":
+                    stream_id = stream_id or (await part.text())
+        except BaseException:
+            if incoming_file is not None and os.path.exists(incoming_file):
+                os.remove(incoming_file)
+            raise
+        if incoming_file is None:
+            return "no file in request", 400
+        return await loop.run_in_executor(self._executor, self._accept_form_upload, incoming_file, file_name, stream_id)
+
+    async def _save_part(self, part, file_name, loop):
+        output = await loop.run_in_executor(self._executor, open, file_name, 'wb')
+        try:
+            while True:
+                chunk = await part.read_chunk(_CHUNK_SIZE)
+                if not chunk:
+                    break
+                await loop.run_in_executor(self._executor, output.write, chunk)
+        finally:
+            await loop.run_in_executor(self._executor, output.close)
+
+    def run(self, host, port):
+        """
+        serves until the process is interrupted (ctrl+c)
+        """
+        web.run_app(self.create_app(), host=host, port=int(port), print=lambda message: print(f"[AsyncServer] {message}", flush=True))
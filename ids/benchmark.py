@@ -0,0 +1,100 @@
+import json
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+
+import ids_helper
+from check_batch_scoring import DETECTORS
+from replay import replay_text, format_result
+from synthetic_trace import SyntheticTrace
+
+# throughput benchmark of the detection path for the shipped models, see replay.py
+# every model is replayed on a synthetic trace generated from the model itself, the best of REPEATS runs counts.
+# the absolute syscalls/s depend on the machine and its load, so each run is paired with a calibration run
+# (splitting the same trace into lines and fields, the core of the parse stage) and the throughput relative to
+# the calibration speed is compared with the stored baseline, a drop of more than TOLERANCE fails the benchmark
+#   python3 benchmark.py [--syscalls=N] [--update-baseline]
+# run from the ids directory. the baseline was recorded with the default settings on the machine stored in it
+
+BASELINE_FILE = "benchmark_baseline.json"
+SYSCALLS = 200_000
+REPEATS = 3
+TOLERANCE = 0.25
+
+
+def calibrate(text):
+    # seconds to split the trace into lines and fields, independent of the code of the ids
+    start = time.perf_counter()
+    for line in text.splitlines():
+        line.split(b" ", 5)
+    return time.perf_counter() - start
+
+
+def run_benchmark(create_detector, syscalls):
+    """
+    returns the best replay result and the best calibration seconds, each replay directly follows a calibration run
+    """
+    text = SyntheticTrace(create_detector()._model_file, seed=1).text(syscalls).encode()
+    best = None
+    best_calibration = None
+    for _ in range(REPEATS):
+        calibration = calibrate(text)
+        result = replay_text(text, create_detector())
+        if best is None or sum(result[2].values()) < sum(best[2].values()):
+            best = result
+        if best_calibration is None or calibration < best_calibration:
+            best_calibration = calibration
+    return best, best_calibration
+
+
+def cpu_model():
+    try:
+        with open("/proc/cpuinfo") as cpuinfo:
+            for line in cpuinfo:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor()
+
+
+def load_baseline():
+    try:
+        with open(BASELINE_FILE) as baseline_file:
+            return json.load(baseline_file)
+    except FileNotFoundError:
+        return None
+
+
+if __name__ == "__main__":
+    arguments, options = ids_helper.split_options(sys.argv)
+    syscalls = int(options.get("syscalls", SYSCALLS))
+    baseline = load_baseline()
+    results = {}
+    ok = True
+    for name, create_detector in DETECTORS.items():
+        (count, scored, timings), calibration = run_benchmark(create_detector, syscalls)
+        throughput = count / sum(timings.values())
+        # syscalls scored in the time the calibration needs for one syscall line
+        relative = throughput * calibration / count
+        results[name] = {"syscalls_per_second": round(throughput), "relative_throughput": round(relative, 4),
+                         "stage_seconds": {stage: round(seconds, 4) for stage, seconds in timings.items()}}
+        line = f"[Benchmark] {name}: {format_result(count, scored, timings)} | relative {relative:.4f}"
+        if baseline is not None and name in baseline["results"]:
+            expected = baseline["results"][name]["relative_throughput"]
+            line += f" | baseline {expected:.4f} ({100 * (relative / expected - 1):+.0f}%)"
+            if relative < expected * (1 - TOLERANCE):
+                line += " REGRESSION"
+                ok = False
+        print(line, flush=True)
+
+    if "update-baseline" in options:
+        with open(BASELINE_FILE, 'w') as baseline_file:
+            json.dump({"syscalls": syscalls, "repeats": REPEATS, "python": platform.python_version(),
+                       "numpy": np.__version__, "machine": platform.machine(), "cpu": cpu_model(), "cpus": os.cpu_count(),
+                       "results": results}, baseline_file, indent=4)
+        print(f"[Benchmark] baseline written to {BASELINE_FILE}")
+    sys.exit(0 if ok else 1)
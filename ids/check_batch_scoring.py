@@ -0,0 +1,115 @@
+import io
+import math
+import sys
+
+from syscall import Syscall, read_sysdig_batches
+from vocabulary import Vocabulary
+from astide import ASTIDE
+from fstide import FSTIDE
+from synthetic_trace import SyntheticTrace
+
+# checks that score_batch returns the same scores as the per syscall path (get_score)
+# for the shipped models, on a recorded trace or on a synthetic one.
+# the trace is split into two files and small chunks, so that the ngram and window state
+# has to carry across batch and file boundaries
+
+# the ngram history of a thread has to be dropped after it exited (see ANgram.expire_threads), checked on a trace
+# with the exit syscalls and the procexit event as sysdig prints them with SYSDIG_OUTPUT_FORMAT (<NA> for procexit)
+EXITING_THREAD = 4242
+EXIT_LINES = [
+    "{timestamp} mosquitto {thread_id} > exit_group status=0",
+    "{timestamp} mosquitto {thread_id} > <NA> status=0 ret=0 sig=0 core=0",
+]
+
+# ASTIDE scores are exact, FSTIDE scores are float sums which are computed in a different order
+FLOAT_TOLERANCE = 1e-9
+
+DETECTORS = {
+    "astide name n5": lambda: ASTIDE(model_file="models/mosquitto_default.json"),
+    "fstide name n9": lambda: FSTIDE(model_file="models/mosquitto_freq_stide_n9_w500.json", syscall_mapper="name"),
+    "fstide name_result n9": lambda: FSTIDE(model_file="models/mosquitto_freq_stide_r_n9_w500.json", syscall_mapper="name_result"),
+}
+
+
+def reference_scores(detector, lines):
+    scores = []
+    for line in lines:
+        score = detector.get_score(Syscall(line.strip()))
+        scores.append(math.nan if score is None else score)
+    return scores
+
+
+def batch_scores(detector, files, chunk_size):
+    names = Vocabulary()
+    scores = []
+    for text in files:
+        for batch in read_sysdig_batches(io.BytesIO(text.encode()), names, detector.needs_syscall_params, chunk_size):
+            scores.extend(detector.score_batch(batch).tolist())
+    return scores
+
+
+def same_score(expected, actual, tolerance):
+    if math.isnan(expected) or math.isnan(actual):
+        return math.isnan(expected) and math.isnan(actual)
+    return abs(expected - actual) <= tolerance
+
+
+def check(name, create_detector, text, chunk_size):
+    lines = [line for line in text.split("\n") if line.strip()]
+    half = len(lines) // 2
+    files = ["\n".join(lines[:half]) + "\n", "\n".join(lines[half:]) + "\n"]
+
+    expected = reference_scores(create_detector(), lines)
+    actual = batch_scores(create_detector(), files, chunk_size)
+    tolerance = 0 if name.startswith("astide") else FLOAT_TOLERANCE
+    if len(expected) != len(actual):
+        print(f"[check] {name}: FAILED, {len(expected)} reference scores but {len(actual)} batch scores")
+        return False
+    mismatches = [index for index, (e, a) in enumerate(zip(expected, actual)) if not same_score(e, a, tolerance)]
+    if mismatches:
+        index = mismatches[0]
+        print(f"[check] {name}: FAILED, {len(mismatches)} different scores, first at line {index}: {expected[index]} != {actual[index]}")
+        return False
+    print(f"[check] {name}: ok ({sum(not math.isnan(score) for score in expected)} scores)")
+    return True
+
+
+def check_thread_exit(create_detector, text):
+    lines = [line for line in text.split("\n") if line.strip()]
+    timestamp = int(lines[-1].split(" ", 1)[0])
+    # the exiting thread runs like one of the threads of the trace before it ends
+    thread_lines = [line.split(" ") for line in lines[:200]]
+    for offset, parts in enumerate(thread_lines):
+        parts[0], parts[2] = str(timestamp + offset + 1), str(EXITING_THREAD)
+    exit_lines = [line.format(timestamp=timestamp + len(thread_lines) + index + 1, thread_id=EXITING_THREAD)
+                  for index, line in enumerate(EXIT_LINES)]
+    detector = create_detector()
+    names = Vocabulary()
+    text = "\n".join(lines + [" ".join(parts) for parts in thread_lines] + exit_lines) + "\n"
+    seen = False
+    for batch in read_sysdig_batches(io.BytesIO(text.encode()), names, detector.needs_syscall_params, 64 * 1024):
+        detector.score_batch(batch)
+        seen = seen or EXITING_THREAD in detector._ngram_builder._ngram_buffer
+        detector.expire_threads(batch)
+    if not seen or EXITING_THREAD in detector._ngram_builder._ngram_buffer or detector._ngram_builder.thread_count() == 0:
+        print(f"[check] thread exit: FAILED, the ngram history of thread {EXITING_THREAD} was not dropped after its exit")
+        return False
+    print(f"[check] thread exit: ok ({detector._ngram_builder.thread_count()} threads left)")
+    return True
+
+
+if __name__ == "__main__":
+    # optional argument: file with sysdig output (see syscall.SYSDIG_OUTPUT_FORMAT), a synthetic trace is used otherwise
+    # run from the ids directory, the models are loaded from models/
+    ok = True
+    for name, create_detector in DETECTORS.items():
+        if len(sys.argv) > 1:
+            with open(sys.argv[1]) as trace_file:
+                text = trace_file.read()
+        else:
+            model_file = create_detector()._model_file
+            text = SyntheticTrace(model_file, seed=1).text(20_000)
+        ok = check(name, create_detector, text, chunk_size=64 * 1024) and ok
+    create_detector = DETECTORS["astide name n5"]
+    ok = check_thread_exit(create_detector, SyntheticTrace(create_detector()._model_file, seed=1).text(20_000)) and ok
+    sys.exit(0 if ok else 1)
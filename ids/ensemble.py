@@ -0,0 +1,193 @@
+import json
+
+import numpy as np
+
+from syscall import SyscallBatch
+from angram import ANgram
+from vocabulary import Vocabulary
+from ngram_table import MEMBERSHIPS, MEMBERSHIP_SET, DEFAULT_FALSE_POSITIVE_RATE
+from astide import ASTIDE, name as astide_name
+from fstide import FSTIDE, name_r
+
+# runs several detectors over the same decoded syscalls (e.g. ASTIDE n=5 next to FSTIDE n=9)
+# the detectors of one feature share one ngram builder with the largest n of them: the ngram of a detector
+# with a smaller n is the suffix of that ngram, so the per thread history is only kept and built once.
+# every detector keeps its own model (and vocabulary) and its own sliding window of scores.
+# ensemble config file, a json list of detectors (only algorithm and model_file are required):
+#   [{"name": "astide-n5", "algorithm": "astide", "features": "name", "n": 5, "w": 500, "model_file": "models/mosquitto_default.json"},
+#    {"name": "fstide-r-n9", "algorithm": "fstide", "features": "name_result", "n": 9, "w": 500, "alpha": 0.01,
+#     "model_file": "models/mosquitto_freq_stide_r_n9_w500.json"}]
+
+FEATURES = ["name", "name_result"]
+_DEFAULT_N = {"astide": 5, "fstide": 9}
+
+
+def detector_name(algorithm, features, n):
+    return f"{algorithm.lower()}-{features}-n{n}"
+
+
+def read_ensemble_config(file_name):
+    """
+    reads an ensemble config file, returns the list of detector configs with the defaults filled in
+    """
+    with open(file_name) as config_file:
+        configs = json.load(config_file)
+    return [detector_config(config["algorithm"], config.get("features", "name"), config["model_file"], n=config.get("n"),
+                            w=config.get("w", 500), alpha=config.get("alpha", 0.01), name=config.get("name"),
+                            membership=config.get("membership", MEMBERSHIP_SET),
+                            false_positive_rate=config.get("false_positive_rate", DEFAULT_FALSE_POSITIVE_RATE))
+            for config in configs]
+
+
+def detector_config(algorithm, features, model_file, n=None, w=500, alpha=0.01, name=None, membership=MEMBERSHIP_SET,
+                    false_positive_rate=DEFAULT_FALSE_POSITIVE_RATE):
+    """
+    returns the config of one detector, n defaults to the n of the algorithm
+    membership and false_positive_rate: backend of the normal database of ASTIDE (see ngram_table.MEMBERSHIPS)
+    """
+    algorithm = algorithm.lower()
+    if algorithm not in _DEFAULT_N:
+        raise ValueError(f"unknown algorithm {algorithm}")
+    if features not in FEATURES:
+        raise ValueError(f"unknown features {features}")
+    if membership not in MEMBERSHIPS:
+        raise ValueError(f"unknown membership {membership}")
+    if membership != MEMBERSHIP_SET and algorithm != "astide":
+        # FSTIDE needs the counts of the ngrams
+        raise ValueError(f"the membership {membership} is only available for astide")
+    n = int(n) if n is not None else _DEFAULT_N[algorithm]
+    return {
+        "name": name if name is not None else detector_name(algorithm, features, n),
+        "algorithm": algorithm,
+        "features": features,
+        "n": n,
+        "w": int(w),
+        "alpha": float(alpha),
+        "model_file": model_file,
+        "membership": membership,
+        "false_positive_rate": float(false_positive_rate),
+    }
+
+
+def create_detector(config, mode="detection"):
+    """
+    creates an ASTIDE or FSTIDE detector from a detector config (see read_ensemble_config)
+    """
+    if config["algorithm"] == "astide":
+        mapper = astide_name if config["features"] == "name" else name_r
+        return ASTIDE(mode=mode, n=config["n"], w=config["w"], syscall_mapper=mapper, model_file=config["model_file"],
+                      membership=config["membership"], false_positive_rate=config["false_positive_rate"])
+    return FSTIDE(mode=mode, n=config["n"], w=config["w"], syscall_mapper=config["features"], model_file=config["model_file"],
+                  alpha=config["alpha"])
+
+
+class _FeatureGroup:
+    """
+    the detectors of one feature with their shared ngram builder
+    """
+
+    def __init__(self, feature, detectors):
+        self.feature = feature
+        # (name, detector) pairs
+        self.detectors = detectors
+        self._ngram_builder = ANgram(max(detector._ngram_builder.n for _, detector in detectors))
+        # per detector: element id of the shared vocabulary -> element id of the detector model,
+        # elements unknown to a (frozen) model become UNKNOWN like in the own ngram builder of the detector
+        self._translations = [np.array([Vocabulary.EMPTY, Vocabulary.UNKNOWN], dtype=np.uint32) for _ in detectors]
+
+    def _element_ids(self, batch: SyscallBatch):
+        if self.feature == "name":
+            return self._ngram_builder.translate_ids(batch.names, batch.name_ids)
+        element_id = self._ngram_builder.element_id
+        return [element_id(name_r(row)) for row in batch.rows()]
+
+    def _translation(self, index):
+        table = self._translations[index]
+        strings = self._ngram_builder.vocabulary.strings()
+        if len(table) < len(strings):
+            vocabulary = self.detectors[index][1]._ngram_builder.vocabulary
+            added = np.array([vocabulary.get_id(string) for string in strings[len(table):]], dtype=np.uint32)
+            table = self._translations[index] = np.concatenate((table, added))
+        return table
+
+    def replace(self, index, detector):
+        if detector._ngram_builder.n > self._ngram_builder.n:
+            raise ValueError(f"the ngrams of the feature {self.feature} are limited to n={self._ngram_builder.n}")
+        self.detectors[index] = (self.detectors[index][0], detector)
+        self._translations[index] = np.array([Vocabulary.EMPTY, Vocabulary.UNKNOWN], dtype=np.uint32)
+
+    def score_batch(self, batch: SyscallBatch):
+        """
+        returns a list of (detector name, scores) for the given batch, see score_batch of the detectors
+        """
+        element_ids = np.array(self._element_ids(batch), dtype=np.uint32)
+        windows = self._ngram_builder.get_ngram_windows(np.frombuffer(batch.thread_ids, dtype=np.int64), element_ids)
+        results = []
+        for index, (name, detector) in enumerate(self.detectors):
+            # the last n elements of the shared ngram, in the element ids of the detector
+            suffix = windows[:, self._ngram_builder.n - detector._ngram_builder.n:]
+            results.append((name, detector.score_windows(self._translation(index)[suffix])))
+        return results
+
+
+class DetectorEnsemble:
+    """
+    scores every batch with all detectors in one pass (detection only)
+    detectors: list of (name, feature, detector), the first one is the primary detector of the ids
+    """
+
+    def __init__(self, detectors):
+        self.names = [name for name, _, _ in detectors]
+        if len(set(self.names)) != len(self.names):
+            raise ValueError(f"the names of the detectors have to be unique: {self.names}")
+        groups = {}
+        for name, feature, detector in detectors:
+            groups.setdefault(feature, []).append((name, detector))
+        self._groups = [_FeatureGroup(feature, group) for feature, group in groups.items()]
+        self.needs_syscall_params = any(detector.needs_syscall_params for _, _, detector in detectors)
+        for group in self._groups:
+            print(f"[Ensemble] feature {group.feature}: {[name for name, _ in group.detectors]}")
+
+    def score_batch(self, batch: SyscallBatch):
+        """
+        returns a list of (detector name, scores) in the order of the detectors, one score per row (NaN for no score)
+        """
+        scores = {}
+        for group in self._groups:
+            scores.update(group.score_batch(batch))
+        return [(name, scores[name]) for name in self.names]
+
+    def detectors(self):
+        """
+        returns (name, detector) of all detectors in the order of the names
+        """
+        detectors = dict(pair for group in self._groups for pair in group.detectors)
+        return [(name, detectors[name]) for name in self.names]
+
+    def expire_threads(self, batch: SyscallBatch):
+        """
+        forgets the exited and idle threads in the ngram builders of all features, returns the counts of the first one
+        (all of them see the same threads)
+        """
+        return [group._ngram_builder.expire_batch_threads(batch) for group in self._groups][0]
+
+    def active_threads(self):
+        return max(group._ngram_builder.thread_count() for group in self._groups)
+
+    def shared_copy(self):
+        """
+        returns an ensemble with the same models, but its own thread ngrams and sliding windows (e.g. for a live stream)
+        """
+        features = {name: group.feature for group in self._groups for name, _ in group.detectors}
+        return DetectorEnsemble([(name, features[name], detector.shared_copy()) for name, detector in self.detectors()])
+
+    def replace_detector(self, name, detector):
+        """
+        replaces the detector of the given name (e.g. by the one of a reloaded model), returns the old detector
+        """
+        for group in self._groups:
+            for index, (detector_name, old_detector) in enumerate(group.detectors):
+                if detector_name == name:
+                    group.replace(index, detector)
+                    return old_detector
+        raise KeyError(f"no detector {name} in the ensemble")
@@ -1,17 +1,26 @@
 from collections import deque
+import copy
 import time
-import json
 import math
 
-from syscall import Syscall
+import numpy as np
+
+from syscall import Syscall, SyscallBatch
 from syscall import Direction
 from angram import ANgram
 from histogram import Histogram
+from vocabulary import Vocabulary
+from ngram_table import SortedNgramTable, pack_windows
+from model_store import BinaryModel, DeltaLog, is_binary_model_file, read_json_model, write_json_model, write_binary_model, read_delta_log, remove_delta_log, BINARY_MODEL_SUFFIX, FSTIDE_MODEL
+from stats import window_means
+
+# system calls whose result is part of the name_result feature
+RESULT_SYSCALLS = ("read","write", "pread", "pwrite","readv","writev","preadv","pwritev", "sendfile", "splice")
 
 # helper function: maps a given system call to its name
 def name_r(syscall: Syscall):    
     r = ""
-    if syscall.name() in ("read","write", "pread", "pwrite","readv","writev","preadv","pwritev", "sendfile", "splice"):
+    if syscall.name() in RESULT_SYSCALLS:
         r = syscall.param("res")    
         if r is None:
             r = ""
@@ -22,7 +31,7 @@ def name(syscall: Syscall):
 
 class FSTIDE():
     # Initialize FrequencySTIDE with given number of ngrams, window size, and early stopping time
-    def __init__(self, mode="detection", n=9, w=500, es_training_seconds=30, syscall_mapper="name", model_file="models/mosquitto_default.json"):
+    def __init__(self, mode="detection", n=9, w=500, es_training_seconds=30, syscall_mapper="name", model_file="models/mosquitto_default.json", alpha=0.01):
 
         # Set the ngram number
         self._n = n
@@ -33,6 +42,8 @@ class FSTIDE():
             self._syscall_mapper = name
         if syscall_mapper == "name_result":
             self._syscall_mapper = name_r
+        # the name mapper only needs the syscall name column of a SyscallBatch, the others need the params
+        self.needs_syscall_params = self._syscall_mapper is not name
 
         # current operating mode
         self.mode = mode
@@ -51,19 +62,26 @@ class FSTIDE():
 
         # Initialize an empty set to hold normal syscall ngrams
         self._normal_database = Histogram()
-        self._alpha = 0.01
+        self._alpha = alpha
+        # sorted array copy of the normal database for score_batch, built on demand
+        self._lookup_table_cache = None
+        # packed keys of the ngrams counted since the last checkpoint, and the delta log their counts are appended to
+        self._checkpoint_keys = set()
+        self._delta_log = None
         
         # Initialize an empty deque to hold the scores buffer within the sliding window
         self._window_score_buffer = deque(maxlen=self._w)
         # Initialize a counter for the number of scores in the sliding window
         self._sum_of_scores_in_window = 0
+        # number of updates of the running sum since it was last recomputed from the buffer
+        self._updates_since_resync = 0
 
         # Initialize an ngram builder with a specific ngram number
-        self._ngram_builder = ANgram(n)
+        self._ngram_builder = ANgram(n, on_repack=self._repack_database)
 
         if self.mode == "detection":
             print(f"[FreqSTIDE] started in detection mode...")
-            self.from_json_file(self._model_file)
+            self.load_model(self._model_file)
         else:
             print(f"[FreqSTIDE] started in training mode...")
 
@@ -72,17 +90,67 @@ class FSTIDE():
         """
         creates a set for distinct ngrams from training data
         """
+        thread_id = syscall.thread_id()
+        self._train_on_element(syscall.timestamp_unix_in_ns(), thread_id, self._ngram_builder.element_id(self._syscall_mapper(syscall)))
+
+    # Method to train on all syscalls of a SyscallBatch
+    def train_on_batch(self, batch: SyscallBatch):
+        """
+        same as train_on for every row of the given batch, without creating Syscall objects
+        """
+        for timestamp, thread_id, element in zip(batch.timestamps, batch.thread_ids, self._map_batch(batch)):
+            self._train_on_element(timestamp, thread_id, element)
+
+    def _train_on_element(self, timestamp, thread_id, element_id):
         self._seen_training_syscalls += 1
-        self._early_stopping_last_seen_ts = syscall.timestamp_unix_in_ns() / 1_000_000_000
+        self._early_stopping_last_seen_ts = timestamp / 1_000_000_000
         # Generate an ngram from the syscall
-        ngram = self._ngram_builder.get_ngram(syscall, self._syscall_mapper)
+        ngram = self._ngram_builder.add_id(thread_id, element_id)
         if ngram is not None:
             self._seen_training_ngrams += 1
             # add the ngram to the database (increment its count)
             self._normal_database.add(ngram)
+            self._checkpoint_keys.add(ngram)
+            self._lookup_table_cache = None
             # if this was a new ngram, update the early stopping timestamp
             if self._normal_database.get_count(ngram) == 1:
-                self._early_stopping_last_modification_ts = syscall.timestamp_unix_in_ns() / 1_000_000_000
+                self._early_stopping_last_modification_ts = timestamp / 1_000_000_000
+
+    # Helper function to map all rows of a SyscallBatch with the syscall mapper to element ids
+    def _map_batch(self, batch: SyscallBatch):
+        if self._syscall_mapper is name:
+            return self._ngram_builder.translate_ids(batch.names, batch.name_ids)
+        element_id = self._ngram_builder.element_id
+        return [element_id(self._syscall_mapper(row)) for row in batch.rows()]
+
+    # Helper function to convert the database keys after the ngram key layout has grown
+    def _repack_database(self, old_bits):
+        repack = self._ngram_builder.repack
+        self._make_database_writable()
+        self._normal_database.map_keys(lambda key: repack(key, old_bits))
+        self._checkpoint_keys = {repack(key, old_bits) for key in self._checkpoint_keys}
+        self._lookup_table_cache = None
+
+    # Helper function to copy a memory mapped model into a Histogram before changing it
+    def _make_database_writable(self):
+        if isinstance(self._normal_database, SortedNgramTable):
+            # a memory mapped model can't be changed in place
+            database = Histogram()
+            for key, value in self._normal_database.items():
+                database.add(key, value)
+            self._normal_database = database
+
+    # Method to add ngrams which were counted elsewhere (e.g. offline training) to the normal database
+    def merge_ngrams(self, ngrams):
+        """
+        adds the given (ngram tuple, count) pairs to the normal database
+        """
+        pack = self._ngram_builder.pack
+        for ngram, count in ngrams:
+            # packing may grow the key layout and replace the database, so pack before looking it up
+            key = pack(ngram)
+            self._normal_database.add(key, count)
+        self._lookup_table_cache = None
 
     # Method to reset the window scores buffer and the counter for number of scores
     def reset_buffer(self):
@@ -90,6 +158,38 @@ class FSTIDE():
         self._window_score_buffer = deque(maxlen=self._w)
         # Reset the number of scores
         self._sum_of_scores_in_window = 0 
+        self._updates_since_resync = 0
+
+    # Method to create another detector (e.g. for another stream) which shares the model of this one
+    def shared_copy(self):
+        """
+        returns a detector with its own thread ngrams and sliding window, but the (read only) model of this detector
+        only possible in detection mode, the model of a training detector changes
+        """
+        if self.mode != "detection":
+            raise ValueError("only a detection model can be shared")
+        detector = copy.copy(self)
+        # the frozen vocabulary never grows, so the shared key layout and database stay as they are
+        detector._ngram_builder = ANgram(self._n, self._ngram_builder.vocabulary, on_repack=detector._repack_database, bits=self._ngram_builder.bits)
+        detector._lookup_table_cache = self._lookup_table()
+        detector._window_score_buffer = deque(maxlen=self._w)
+        detector._sum_of_scores_in_window = 0
+        detector._updates_since_resync = 0
+        return detector
+
+    # Method to get the number of unique ngrams of the model (len of the histogram is the sum of all counts)
+    def ngram_count(self):
+        return self._normal_database.unique_elements()
+
+    # Method to continue the running state of another FSTIDE (e.g. the one of the previous model after a reload)
+    def take_over_state(self, detector):
+        """
+        continues the thread ngrams and the sliding window of scores of the given detector
+        """
+        self._ngram_builder.take_over_buffers(detector._ngram_builder)
+        self._window_score_buffer = deque(detector._window_score_buffer, maxlen=self._w)
+        self._sum_of_scores_in_window = math.fsum(self._window_score_buffer)
+        self._updates_since_resync = 0
 
     # Method to finalize the training (currently prints the current size of the training set)
     def fit(self):        
@@ -98,25 +198,42 @@ class FSTIDE():
         print(f"[FreqSTIDE] FreqStide.seen_ngrams in training  : {self._seen_training_ngrams}")
         print(f"[FreqSTIDE] FreqStide.unique_elements          : {self._normal_database.unique_elements()}")
         # print(self._normal_database)        
-        self.to_json_file(self._model_file)
         
         dt = self._early_stopping_last_seen_ts - self._early_stopping_last_modification_ts
         print(f"[FreqSTIDE] time since last unique datapoint: {dt} seconds ")
+        # the final model is written as one snapshot
+        self.checkpoint(compact=dt >= self._early_stopping_seconds)
         if dt >= self._early_stopping_seconds:
             # training done...
             print("[FreqSTIDE] training done -> switch to detection")
             self.mode = "detection"
+            self._ngram_builder.vocabulary.frozen = True
             
 
+    # Method to save the training progress without writing the whole model every time
+    def checkpoint(self, compact=False):
+        """
+        appends the counts of the ngrams seen since the last checkpoint to the delta log of the model file.
+        a full snapshot of the model replaces the model file and the delta log instead at the first checkpoint,
+        if compact is set or if the delta log has grown too big (see model_store.DELTA_COMPACT_RATIO)
+        """
+        if self._delta_log is None or compact or self._delta_log.needs_compaction(len(self._checkpoint_keys), self._normal_database.unique_elements()):
+            self.save_model(self._model_file)
+            self._delta_log = DeltaLog(self._model_file)
+        else:
+            unpack = self._ngram_builder.unpack
+            get_count = self._normal_database.get_count
+            self._delta_log.append((unpack(key), get_count(key)) for key in self._checkpoint_keys)
+            print(f"[FreqSTIDE] {len(self._checkpoint_keys)} changed ngrams appended to {self._delta_log.file_name}")
+        self._checkpoint_keys = set()
+
     # Helper function to determine the score of a given ngram
-    def _get_score(self, ngram: tuple):
+    def _get_score(self, ngram: int):
         """
-        calculates the score for a given ngram
+        calculates the score for a given ngram (packed key)
         """       
-        if ngram in self._normal_database:
-            ngram_freq = self._normal_database.get_count(ngram)
-        else:
-            ngram_freq = 0
+        # get_count returns 0 for unknown ngrams
+        ngram_freq = self._normal_database.get_count(ngram)
         # return math.pow(self._alpha, ngram_freq)
         return math.exp(-self._alpha * ngram_freq)
 
@@ -125,8 +242,65 @@ class FSTIDE():
         """
         calculates sum of scores of ngrams in sliding window of current recording
         """
+        thread_id = syscall.thread_id()
+        return self._score_element(thread_id, self._ngram_builder.element_id(self._syscall_mapper(syscall)))
+
+    # Method to calculate the scores for all syscalls of a SyscallBatch
+    def get_scores(self, batch: SyscallBatch):
+        """
+        same as get_score for every row of the given batch, returns a list with one score (or None) per row
+        """
+        return [self._score_element(thread_id, element) for thread_id, element in zip(batch.thread_ids, self._map_batch(batch))]
+
+    # Method to calculate the scores for all syscalls of a SyscallBatch with vectorized array operations
+    def score_batch(self, batch: SyscallBatch):
+        """
+        same result as get_scores, but returns a numpy array with one score per row (NaN for no score).
+        the ngram and window state is shared with get_score, so both can be mixed and the state carries across batches
+        """
+        return self.score_windows(self.ngram_windows(batch))
+
+    def ngram_windows(self, batch: SyscallBatch):
+        """
+        maps the rows of the batch to elements and returns their ngram windows (see ANgram.get_ngram_windows)
+        """
+        element_ids = np.array(self._map_batch(batch), dtype=np.uint32)
+        return self._ngram_builder.get_ngram_windows(np.frombuffer(batch.thread_ids, dtype=np.int64), element_ids)
+
+    def expire_threads(self, batch: SyscallBatch):
+        """
+        forgets the ngram history of the threads which exited or went idle (see ANgram.expire_threads), after each batch
+        """
+        return self._ngram_builder.expire_batch_threads(batch)
+
+    def score_windows(self, windows: np.ndarray):
+        """
+        scores the ngram windows returned by ANgram.get_ngram_windows
+        """
+        scores = np.full(len(windows), np.nan)
+        # only full ngrams are added to the score window
+        complete = windows[:, 0] != 0
+        keys = pack_windows(windows[complete], self._ngram_builder.bits)
+        frequencies = self._lookup_table().lookup(keys)
+        # evaluate exp once per distinct frequency, with the same formula as _get_score
+        distinct_frequencies, inverse = np.unique(frequencies, return_inverse=True)
+        distinct_scores = np.array([math.exp(-self._alpha * int(frequency)) for frequency in distinct_frequencies], dtype=np.float64)
+        scores[complete] = window_means(distinct_scores[inverse.reshape(-1)], self._window_score_buffer, self._w)
+        self._sum_of_scores_in_window = math.fsum(self._window_score_buffer)
+        self._updates_since_resync = 0
+        return scores
+
+    # Helper function returning the normal database as SortedNgramTable
+    def _lookup_table(self):
+        if isinstance(self._normal_database, SortedNgramTable):
+            return self._normal_database
+        if self._lookup_table_cache is None:
+            self._lookup_table_cache = SortedNgramTable.from_counts(dict(self._normal_database.items()), self._ngram_builder.bits, self._n)
+        return self._lookup_table_cache
+
+    def _score_element(self, thread_id, element_id):
         # Generate an ngram from the syscall
-        ngram = self._ngram_builder.get_ngram(syscall, self._syscall_mapper)
+        ngram = self._ngram_builder.add_id(thread_id, element_id)
         if ngram is not None:            
             # Determine the ngram score
             score = self._get_score(ngram)
@@ -140,6 +314,11 @@ class FSTIDE():
             self._window_score_buffer.append(score)
             # Adjust the sum of scores based on the oldest value
             self._sum_of_scores_in_window += score - oldest_value
+            # recompute the running sum once per window length, so that float rounding errors do not add up
+            self._updates_since_resync += 1
+            if self._updates_since_resync == self._w:
+                self._sum_of_scores_in_window = math.fsum(self._window_score_buffer)
+                self._updates_since_resync = 0
             
             # If the window is full, return the sum of scores
             if len(self._window_score_buffer) == self._w:
@@ -148,28 +327,94 @@ class FSTIDE():
         # If no ngram could be generated or the window is not full, return None
         return None
     
+    def load_model(self, file_name):
+        """
+        loads a model from a binary or a json model file and the ngram counts of its delta log
+        """
+        if is_binary_model_file(file_name):
+            self.from_binary_file(file_name)
+        else:
+            self.from_json_file(file_name)
+        self._apply_delta_log(file_name)
+
+    def _apply_delta_log(self, file_name):
+        ngrams = read_delta_log(file_name)
+        if not ngrams:
+            return
+        self._make_database_writable()
+        # the delta log may hold elements which are not in the snapshot yet
+        vocabulary = self._ngram_builder.vocabulary
+        frozen = vocabulary.frozen
+        vocabulary.frozen = False
+        pack = self._ngram_builder.pack
+        for ngram, count in ngrams:
+            key = pack(ngram)
+            # the logged count replaces the count of the snapshot
+            known = self._normal_database.get_count(key)
+            if count > known:
+                self._normal_database.add(key, count - known)
+        vocabulary.frozen = frozen
+        self._lookup_table_cache = None
+        print(f"[FreqSTIDE] {len(ngrams)} ngrams of the delta log applied, unique_elements: {self._normal_database.unique_elements()}")
+
+    def save_model(self, file_name):
+        """
+        saves the current model, in the binary format if the file name ends with BINARY_MODEL_SUFFIX, as json otherwise
+        a delta log of the file is removed, the saved model contains its counts
+        """
+        if file_name.endswith(BINARY_MODEL_SUFFIX):
+            self.to_binary_file(file_name)
+        else:
+            self.to_json_file(file_name)
+        remove_delta_log(file_name)
+
     def to_json_file(self, file_name):
         """
         saves the current model to a json file
         """
-        # print(self._normal_database._counts)
-        # convert tuple(str) keys to json compatible str:
-        data_str_keys = {json.dumps(key): value for key, value in self._normal_database._counts.items()}
-
-        with open(file_name, 'w') as outfile:
-            json.dump(data_str_keys, outfile, indent=4)
-            print(f"[FreqSTIDE] model saved to {file_name}")
+        unpack = self._ngram_builder.unpack
+        write_json_model(file_name, FSTIDE_MODEL, ((unpack(key), value) for key, value in self._normal_database.items()))
+        print(f"[FreqSTIDE] model saved to {file_name}")
 
     def from_json_file(self, file_name):
         """
         loads a model from a json file
         """
-        with open(file_name) as json_file:
-            data_str_keys = json.load(json_file)            
-            # Convert string keys back to tuple keys
-            # data = {tuple(json.loads(key)): value for key, value in data_str_keys.items()}
-            self._normal_database = Histogram()
-            for key, value in data_str_keys.items():
-                self._normal_database.add(tuple(json.loads(key)),value)
-            print(f"[FreqSTIDE] model loaded from {file_name}")
-            print(f"[FreqSTIDE] unique_elements: {self._normal_database.unique_elements()}")
+        kind, ngrams = read_json_model(file_name)
+        if kind != FSTIDE_MODEL:
+            raise ValueError(f"{file_name} is a {kind} model, not an {FSTIDE_MODEL} model")
+        # build the vocabulary first, so that the key layout fits all elements of the model
+        vocabulary = Vocabulary()
+        for ngram, _ in ngrams:
+            for element in ngram:
+                vocabulary.add(element)
+        vocabulary.frozen = self.mode == "detection"
+        self._ngram_builder = ANgram(self._n, vocabulary, on_repack=self._repack_database)
+        self._normal_database = Histogram()
+        for ngram, value in ngrams:
+            self._normal_database.add(self._ngram_builder.pack(ngram),value)
+        self._lookup_table_cache = None
+        print(f"[FreqSTIDE] model loaded from {file_name}")
+        print(f"[FreqSTIDE] unique_elements: {self._normal_database.unique_elements()}")
+
+    def to_binary_file(self, file_name):
+        """
+        saves the current model to a binary model file
+        """
+        write_binary_model(file_name, FSTIDE_MODEL, self._n, self._ngram_builder.bits, self._ngram_builder.vocabulary,
+                           self._normal_database.items())
+        print(f"[FreqSTIDE] model saved to {file_name}")
+
+    def from_binary_file(self, file_name):
+        """
+        opens a binary model file, the ngrams are looked up in the memory mapped file
+        """
+        model = BinaryModel(file_name)
+        if model.kind != FSTIDE_MODEL or model.n != self._n:
+            raise ValueError(f"{file_name} is a {model.kind} model with n={model.n}, expected {FSTIDE_MODEL} with n={self._n}")
+        model.vocabulary.frozen = self.mode == "detection"
+        self._ngram_builder = ANgram(self._n, model.vocabulary, on_repack=self._repack_database, bits=model.bits)
+        self._normal_database = model.table
+        self._lookup_table_cache = None
+        print(f"[FreqSTIDE] model loaded from {file_name}")
+        print(f"[FreqSTIDE] unique_elements: {self._normal_database.unique_elements()}")
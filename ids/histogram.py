@@ -13,6 +13,12 @@ class Histogram:
         self._counts[element] = self._counts[element] + count
         self._size += count
 
+    def map_keys(self, function):
+        """
+        replaces every element by function(element), the counts are kept
+        """
+        self._counts = {function(element): count for element, count in self._counts.items()}
+
     def get_count(self, element):
         if element in self._counts:
             return self._counts[element]
@@ -24,6 +30,9 @@ class Histogram:
     def max_count(self):
         return max(self._counts.values())
 
+    def items(self):
+        return self._counts.items()
+
     def keys(self):
         return self._counts.keys()
 
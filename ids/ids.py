@@ -1,111 +1,278 @@
+import itertools
 import threading
 import sys
 import os
-import requests
+import shutil
 import time
+import zlib
 from datetime import datetime
 
-from flask import Flask, request
+from flask import Flask, Response, request
 from werkzeug.utils import secure_filename
 from watchdog.observers import Observer
 
 import ids_helper as ids_helper
-from ids_file_observer import ParserFileHandler
-from testcases import TestcaseManager, Testcase
+from ids_file_observer import ParserFileHandler, ModelFileHandler
+from stream_server import SyscallStreamServer
+from upload_receiver import SequenceGate, decompress_to_file
+from syscall_stream import SYSCALL_STREAM_SUFFIX
+from ensemble import read_ensemble_config
+from ngram_table import MEMBERSHIPS, MEMBERSHIP_SET, DEFAULT_FALSE_POSITIVE_RATE
+from model_registry import ModelRegistry
+from pipeline import WorkerPool
+from parallel_decode import ParallelDecoder
+from streams import StreamRegistry, DEFAULT_STREAM, valid_stream_id
+from model_store import DELTA_LOG_SUFFIX
+import metrics
+from profiling import profiler, KINDS as PROFILE_KINDS
+from result_sender import ResultSender
 
 # some global variables:
 observer = Observer()
+# watches the model file with --watch-model
+model_observer = Observer()
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = os.getcwd() + "/uploads/"
+# uploads are received here and handed to the detection in order (can be a tmpfs, see --incoming-folder)
+app.config['INCOMING_FOLDER'] = os.getcwd() + "/uploads/.incoming/"
 
 # these three are used as global variables across the whole application (also in flask threads)
-testcases = TestcaseManager()
-current_generation = None
 fuzzino_endpoint = None
 mode = None
 path_to_model_file = None
 algorithm = None
 features = None
+decoder_workers = 1
+# number of threads which score the batches of all streams
+scorer_workers = os.cpu_count() or 1
+hostname_to_listen = None
+stream_port = None
+# further detectors which score the same syscalls in detection mode (see ensemble.py), None for only one detector
+ensemble_configs = None
+# reload the model when the model file is replaced (e.g. by a training), see --watch-model
+watch_model = False
+# with watch_uploads the uploads are moved to the upload folder and picked up by the file observer (old behaviour),
+# otherwise they are handed directly to the ParserFileHandler
+watch_uploads = False
+# serve the endpoints with aiohttp instead of flask, see --async-server
+async_server = False
+# backend of the normal database of ASTIDE in detection mode, see --membership and ngram_table.MEMBERSHIPS
+membership = MEMBERSHIP_SET
+false_positive_rate = DEFAULT_FALSE_POSITIVE_RATE
+# shared by the ParserFileHandlers of all streams, created by run_observer
+model_registry = None
+score_pool = None
+parallel_decoder = None
+stream_server = None
+# sends the generation results to fuzzino_endpoint, see result_sender.py
+result_sender = None
+# seconds between the log lines while evaluate_generation waits for the scores of the testcases
+COMPLETION_LOG_INTERVAL = 10
+# generations in flight (started and not yet evaluated), fuzzino can start the next generation while the previous
+# ones are still scored, see --max-generations
+max_generations = 4
 
 
-# for uploading the files to the ids
-@app.route('/ids/upload_scap', methods=['POST'])
-def upload_file():
-    if 'file' not in request.files:
-        return "no file in request", 400
+def create_stream_handler(stream_id, testcase_manager):
+    return ParserFileHandler(testcase_manager, mode, path_to_model_file, algorithm, features, decoder_workers=decoder_workers,
+                             ensemble_configs=ensemble_configs, model_registry=model_registry, score_pool=score_pool,
+                             parallel_decoder=parallel_decoder, name=f"-{stream_id}", membership=membership,
+                             false_positive_rate=false_positive_rate)
 
-    file = request.files['file']
-    if file.filename == '':
+# every agent (or container) is a stream with its own detector state and testcases, see streams.py
+streams = StreamRegistry(create_stream_handler, max_generations=max_generations)
+
+
+def get_stream(stream_id):
+    """
+    returns the stream of the given id (DEFAULT_STREAM for None) and None, or None and an error response
+    """
+    stream_id = stream_id or DEFAULT_STREAM
+    if not valid_stream_id(stream_id):
+        return None, ("invalid stream id", 400)
+    stream = streams.get(stream_id)
+    if stream is None:
+        return None, ("no more streams accepted (training uses only one stream)", 409)
+    return stream, None
+
+
+def release_upload(upload):
+    incoming_file, upload_file_name, stream = upload
+    if watch_uploads and stream.stream_id == DEFAULT_STREAM:
+        # moving the file into the upload folder hands it to the file observer
+        shutil.move(incoming_file, upload_file_name)
+    else:
+        # the upload is complete, so it can be processed right away instead of waiting for the next file
+        stream.handler.submit_file(incoming_file)
+
+upload_gate = SequenceGate(release_upload)
+
+
+def release_syscall_upload(upload):
+    # binary syscall streams don't need sysdig or the file observer, they always go directly to the decoder
+    incoming_file, upload_file_name, stream = upload
+    stream.handler.submit_file(incoming_file)
+
+syscall_upload_gate = SequenceGate(release_syscall_upload)
+
+# unsequenced uploads are handed over in the order they are complete
+upload_lock = threading.Lock()
+upload_numbers = itertools.count()
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+def incoming_file_name(filename):
+    # unique per request, the original name (and its suffix) is kept at the end
+    return os.path.join(app.config['INCOMING_FOLDER'], f"{time.time_ns()}-{next(upload_numbers)}-{filename}")
+
+
+# the endpoints are plain functions returning (body, status), used by the flask routes below
+# and by the async server (see async_server.py, --async-server)
+
+def check_ready():
+    if score_pool is None:
+        return "ids not ready", 503
+    return None
+
+def accept_form_upload(incoming_file, filename, stream_id):
+    # a multipart upload (field file) which has been saved to incoming_file
+    not_ready = check_ready()
+    stream, error = get_stream(stream_id) if not_ready is None else (None, not_ready)
+    if stream is None:
+        os.remove(incoming_file)
+        return error
+    with upload_lock:
+        release_upload((incoming_file, os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(filename)), stream))
+    return 'file sucessfull uploaded!', 200
+
+def store_syscall_upload(headers, body):
+    # binary syscall streams of agents running with --transcode (see syscall_stream.py)
+    if headers.get('X-Upload-Sequence') is None:
+        return "no sequence number in request", 400
+    filename = secure_filename(headers.get('X-Upload-Filename', ''))
+    if not filename.endswith(SYSCALL_STREAM_SUFFIX):
+        return f"file_name has to end with {SYSCALL_STREAM_SUFFIX}", 400
+    return store_sequenced_upload(headers, body, syscall_upload_gate)
+
+def store_sequenced_upload(headers, body, gate=upload_gate):
+    # the body is the (gzip compressed) file, the agent sends several files at once, numbered per agent session
+    # headers: X-Upload-Session, X-Upload-Sequence, X-Upload-Acked (all lower numbers won't be sent anymore), X-Upload-Filename
+    # and X-Stream-Id (optional)
+    # body: binary stream of the request body, it is copied to the incoming folder without holding it in memory
+    not_ready = check_ready()
+    if not_ready is not None:
+        return not_ready
+    filename = secure_filename(headers.get('X-Upload-Filename', ''))
+    if filename == '':
         return 'no file_name in request', 400
+    stream, error = get_stream(headers.get('X-Stream-Id'))
+    if stream is None:
+        return error
+    try:
+        session = headers.get('X-Upload-Session', '')
+        sequence = int(headers['X-Upload-Sequence'])
+        acked = headers.get('X-Upload-Acked')
+        acked = int(acked) if acked is not None else None
+    except (KeyError, ValueError):
+        return 'invalid sequence number', 400
 
-    filename = secure_filename(file.filename)
-    file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+    incoming_file = incoming_file_name(filename)
+    try:
+        decompress_to_file(body, incoming_file, headers.get('Content-Encoding'))
+    except (ValueError, OSError, zlib.error) as e:
+        if os.path.exists(incoming_file):
+            os.remove(incoming_file)
+        return f'upload failed: {e}', 400
+    if not gate.put(session, sequence, (incoming_file, os.path.join(app.config['UPLOAD_FOLDER'], filename), stream), acked):
+        os.remove(incoming_file)
+        return 'file already uploaded', 200
     return 'file sucessfull uploaded!', 200
 
-@app.route('/ids/start_testcase', methods=['POST'])
-def start_testcase():
+def handle_reload_model(data):
+    # accepts an empty request (reloads the current model file) or json data like:
+    # {
+    # "model_file": "./models/new_model.json",
+    # }
+    not_ready = check_ready()
+    if not_ready is not None:
+        return not_ready
+    if mode != "detection":
+        return "models can only be reloaded in detection mode", 400
+    model_file = (data or {}).get("model_file") or path_to_model_file
+    if not os.path.isfile(model_file):
+        return f"model file {model_file} not found", 400
+    reload_all_streams(model_file)
+    # the model is loaded in the background and used from the next file on
+    return f"loading model {model_file}", 202
+
+def reload_all_streams(model_file):
+    global path_to_model_file
+    # streams created from now on start with the reloaded model
+    path_to_model_file = model_file
+    # the streams share the reloaded model, see model_registry.py
+    for stream in streams.streams():
+        stream.handler.reload_model(model_file)
+
+def handle_start_testcase(data, timestamp=None):
     # accepts requests with json data like:
     # {
     # "testcase_name": "t-007",
     # }
-    global testcases
-
-    result = testcases.add_testcase_from_json(request.json)
-    # print(request.json)
+    # the testcase is started in all streams, at the given timestamp (ns) or now
+    if streams.running_generation() is None:
+        # kept for clients which don't start generations, the next started generation takes the testcase over
+        print(f"[/ids/start_testcase:{get_current_timestamp()}] warning: no generation running, testcase {(data or {}).get('testcase_name')} belongs to the next generation")
+    result = streams.add_testcase_from_json(data, timestamp)
+    # print(data)
     if result:
         return f"testcase accepted", 200
     else:  
         return f"testcase already exists", 400
 
-@app.route('/ids/stop_testcase', methods=['POST'])
-def stop_testcase():
+def handle_stop_testcase(data, timestamp=None):
     # accepts requests with json data like:
     # {
     # "testcase_name": "t-007",
     # }
-    global testcases
-
-    result = testcases.end_testcase_from_json(request.json)
-    # print(request.json)
+    result = streams.end_testcase_from_json(data, timestamp)
+    # print(data)
     if result:
         return "testcase accepted", 200
     else:
         return "testcase not found", 400
 
-@app.route('/ids/start_generation', methods=['POST'])
-def start_generation():
+def handle_start_generation(data, timestamp=None):
     # accepts requests with json data like:
     # {
     # "generation_name": "g-001",
     # }
-    global current_generation
+    # the previous generations can still be evaluated, the syscalls after timestamp (ns, or now) belong to this one
     current_time = get_current_timestamp()
-    print(f"processing '/ids/start_generation' {request.json} at {get_current_timestamp()}")
-    if current_generation is None:
-        current_generation = request.json["generation_name"]
-        if current_generation:
-            print(f"[/ids/start_generation:{current_time}] generation \"{current_generation}\" accepted")
-            return f"generation \"{current_generation}\" accepted", 200
-        else:  
-            print(f"[/ids/start_generation:{current_time}] no name for generation given")
-            return f"no name for generation given", 400
+    print(f"processing '/ids/start_generation' {data} at {get_current_timestamp()}")
+    generation_name = data["generation_name"]
+    if not generation_name:
+        print(f"[/ids/start_generation:{current_time}] no name for generation given")
+        return f"no name for generation given", 400
+    error = streams.start_generation(generation_name, timestamp)
+    if error is None:
+        print(f"[/ids/start_generation:{current_time}] generation \"{generation_name}\" accepted")
+        return f"generation \"{generation_name}\" accepted", 200
     else:
-        print(f"[/ids/start_generation:{current_time}] generation \"{current_generation}\" already running")
-        return f"generation \"{current_generation}\" already running", 400
-    
+        print(f"[/ids/start_generation:{current_time}] {error}")
+        return error, 400
 
-@app.route('/ids/stop_generation', methods=['POST'])
-def stop_generation():
+def handle_stop_generation(data, timestamp=None):
     # accepts requests with json data like:
     # {
     # "generation_name": "g-001",
     # }
-    global current_generation
     current_time = get_current_timestamp()
-    print(f"processing '/ids/stop_generation' {request.json} at {get_current_timestamp()}")
-    if request.json["generation_name"] and request.json["generation_name"] == current_generation:
-        # We start the evaluation in a separate thread so that this request can be immediately closed
-        evaluation_thread = threading.Thread(target=evaluate_generation)
+    print(f"processing '/ids/stop_generation' {data} at {get_current_timestamp()}")
+    if data["generation_name"] and streams.stop_generation(data["generation_name"], timestamp):
+        # We start the evaluation in a separate thread so that this request can be immediately closed,
+        # every generation is evaluated on its own and sent as soon as its testcases are complete
+        evaluation_thread = threading.Thread(target=evaluate_generation, args=(data["generation_name"],),
+                                             name=f"Evaluate-{data['generation_name']}")
         evaluation_thread.start()
         print(f"[/ids/stop_generation:{current_time}] generation ended and data sending initated")
         return f"generation ended and data sending initated", 200
@@ -113,6 +280,173 @@ def stop_generation():
         print(f"[/ids/stop_generation:{current_time}] no name for generation given or the given generation wasnt active")
         return f"no name for generation given or the given generation wasnt active", 400
 
+def handle_metrics(data=None):
+    # Prometheus text format, see metrics.py
+    return metrics.registry.expose(), 200, METRICS_CONTENT_TYPE
+
+def handle_profile(data):
+    # starts profiling the decoder and scorer threads (see profiling.py), accepts requests with json data like:
+    # {
+    # "kind": "sampling",     (or "deterministic")
+    # "files": 5,             (profile the next files and/or seconds)
+    # "seconds": 60,
+    # "spans": true,          (optional: time of parse, ngram, score, testcases)
+    # "interval": 0.005,      (optional: seconds between the samples)
+    # }
+    data = data or {}
+    kind = data.get("kind", "sampling")
+    if kind not in PROFILE_KINDS:
+        return f"kind has to be one of {PROFILE_KINDS}", 400
+    files = data.get("files")
+    seconds = data.get("seconds")
+    if files is None and seconds is None:
+        return "files or seconds are needed", 400
+    try:
+        files = int(files) if files is not None else None
+        seconds = float(seconds) if seconds is not None else None
+        interval = float(data.get("interval", 0.005))
+    except (TypeError, ValueError):
+        return "files, seconds and interval have to be numbers", 400
+    session = profiler.start(kind, files=files, seconds=seconds, spans=bool(data.get("spans", False)), interval=interval)
+    if session is None:
+        return "profiling is already running", 409
+    return f"profiling started, results: {session.prefix}.*", 202
+
+def handle_profile_status(data=None):
+    # the running session and the files of the last one
+    return profiler.status(), 200
+
+def handle_stop_profile(data=None):
+    session = profiler.stop()
+    if session is None:
+        return "no profiling running", 400
+    return f"profiling stopped, results: {session.prefix}.*", 200
+
+
+# for uploading the files to the ids
+@app.route('/ids/upload_scap', methods=['POST'])
+def upload_file():
+    not_ready = check_ready()
+    if not_ready is not None:
+        return not_ready
+    if request.headers.get('X-Upload-Sequence') is not None:
+        return store_sequenced_upload(request.headers, request.stream)
+    if 'file' not in request.files:
+        return "no file in request", 400
+    file = request.files['file']
+    if file.filename == '':
+        return 'no file_name in request', 400
+    incoming_file = incoming_file_name(secure_filename(file.filename))
+    file.save(incoming_file)
+    return accept_form_upload(incoming_file, file.filename, request.headers.get('X-Stream-Id') or request.form.get('stream'))
+
+@app.route('/ids/upload_syscalls', methods=['POST'])
+def upload_syscalls():
+    return store_syscall_upload(request.headers, request.stream)
+
+# for loading a new model without restarting the ids (detection mode only)
+@app.route('/ids/reload_model', methods=['POST'])
+def reload_model():
+    return handle_reload_model(request.get_json(silent=True))
+
+@app.route('/ids/start_testcase', methods=['POST'])
+def start_testcase():
+    timestamp = time.time_ns()
+    return handle_start_testcase(request.json, timestamp)
+
+@app.route('/ids/stop_testcase', methods=['POST'])
+def stop_testcase():
+    timestamp = time.time_ns()
+    return handle_stop_testcase(request.json, timestamp)
+
+@app.route('/ids/start_generation', methods=['POST'])
+def start_generation():
+    return handle_start_generation(request.json)
+
+@app.route('/ids/stop_generation', methods=['POST'])
+def stop_generation():
+    return handle_stop_generation(request.json)
+
+@app.route('/ids/metrics', methods=['GET'])
+def get_metrics():
+    body, status, content_type = handle_metrics()
+    return Response(body, status=status, mimetype=content_type)
+
+@app.route('/ids/profile', methods=['GET', 'POST'])
+def profile():
+    if request.method == 'GET':
+        return handle_profile_status()
+    return handle_profile(request.get_json(silent=True))
+
+@app.route('/ids/profile/stop', methods=['POST'])
+def stop_profile():
+    return handle_stop_profile()
+
+def create_async_server():
+    # the same endpoints as the flask routes above, see async_server.py
+    from async_server import AsyncServer
+    control_routes = [
+        ("POST", "/ids/reload_model", lambda data, timestamp: handle_reload_model(data), False),
+        ("POST", "/ids/start_testcase", handle_start_testcase, True),
+        ("POST", "/ids/stop_testcase", handle_stop_testcase, True),
+        ("POST", "/ids/start_generation", handle_start_generation, False),
+        ("POST", "/ids/stop_generation", handle_stop_generation, False),
+        ("GET", "/ids/metrics", lambda data, timestamp: handle_metrics(), False),
+        ("GET", "/ids/profile", lambda data, timestamp: handle_profile_status(), False),
+        ("POST", "/ids/profile", lambda data, timestamp: handle_profile(data), False),
+        ("POST", "/ids/profile/stop", lambda data, timestamp: handle_stop_profile(), False),
+    ]
+    upload_routes = [
+        ("/ids/upload_scap", store_sequenced_upload),
+        ("/ids/upload_syscalls", store_syscall_upload),
+    ]
+    return AsyncServer(control_routes, upload_routes, ["/ids/upload_scap"],
+                       lambda filename: incoming_file_name(secure_filename(filename)), accept_form_upload)
+
+def count_files(folder):
+    try:
+        with os.scandir(folder) as entries:
+            return sum(1 for entry in entries if entry.is_file())
+    except FileNotFoundError:
+        return 0
+
+def collect_waiting_uploads():
+    # complete uploads wait in uploads/ (with --watch-uploads), uploads in progress or waiting for their sequence in the incoming folder
+    return [({"folder": "uploads"}, count_files(app.config['UPLOAD_FOLDER'])),
+            ({"folder": "incoming"}, count_files(app.config['INCOMING_FOLDER']))]
+
+def collect_queue_depths():
+    return [({"stream": stream.stream_id, "stage": stage}, depth)
+            for stream in streams.streams() for stage, depth in stream.handler.queue_depths().items()]
+
+def collect_model_ngrams():
+    # the streams share their models, so every model is reported once
+    models = {}
+    for stream in streams.streams():
+        for name, model_file, ngrams in stream.handler.model_sizes():
+            models[(name, model_file)] = ngrams
+    return [({"detector": name, "model_file": model_file}, ngrams) for (name, model_file), ngrams in models.items()]
+
+def collect_model_bytes():
+    samples = []
+    for labels, _ in collect_model_ngrams():
+        for file_name in (labels["model_file"], labels["model_file"] + DELTA_LOG_SUFFIX):
+            if file_name and os.path.isfile(file_name):
+                samples.append(({"detector": labels["detector"], "file": file_name}, os.path.getsize(file_name)))
+    return samples
+
+def collect_active_threads():
+    return [({"stream": stream.stream_id}, stream.handler.active_threads()) for stream in streams.streams()]
+
+metrics.registry.gauge("ids_upload_files_waiting", "received files which are not decoded yet", collect_waiting_uploads)
+metrics.registry.gauge("ids_queue_depth", "items waiting in front of the pipeline stages", collect_queue_depths)
+metrics.registry.gauge("ids_model_ngrams", "unique ngrams of the models", collect_model_ngrams)
+metrics.registry.gauge("ids_model_file_bytes", "size of the model files and their delta logs", collect_model_bytes)
+metrics.registry.gauge("ids_results_pending", "generation results waiting to be sent to fuzzino",
+                       lambda: [({}, result_sender.pending())] if result_sender is not None else [])
+metrics.registry.gauge("ids_generations_in_flight", "generations which are started and not yet evaluated",
+                       lambda: [({}, len(streams.generations()))])
+metrics.registry.gauge("ids_ngram_buffer_threads", "threads with a ngram history (ANgram._ngram_buffer)", collect_active_threads)
 
 
 # for the file observer / ids 
@@ -122,46 +456,89 @@ def run_observer():
     global path_to_model_file
     global algorithm
     global features
+    global decoder_workers
+    global model_registry
+    global parallel_decoder
+    global score_pool
+    global stream_server
 
-    path = os.getcwd() + "/uploads/"
-    print(f"[IDS] observing files in: {path}")
-    event_handler = ParserFileHandler(testcases, mode, path_to_model_file, algorithm, features)
-    observer.schedule(event_handler, path, recursive=False)
-    observer.start()
+    model_registry = ModelRegistry()
+    if decoder_workers > 1:
+        parallel_decoder = ParallelDecoder(decoder_workers)
+    score_pool = WorkerPool("Scorer", scorer_workers)
+    if mode == "detection" or watch_uploads:
+        # the model is loaded right away, the streams of the agents share it
+        streams.get(DEFAULT_STREAM)
+    if watch_uploads:
+        path = os.getcwd() + "/uploads/"
+        print(f"[IDS] observing files in: {path}")
+        observer.schedule(streams.get(DEFAULT_STREAM).handler, path, recursive=False)
+        observer.start()
+    else:
+        print(f"[IDS] receiving uploads in: {app.config['INCOMING_FOLDER']}")
+    if watch_model:
+        model_path = os.path.dirname(os.path.abspath(path_to_model_file))
+        print(f"[IDS] watching model file: {path_to_model_file}")
+        model_observer.schedule(ModelFileHandler(reload_all_streams, path_to_model_file), model_path, recursive=False)
+        model_observer.start()
+    if stream_port is not None:
+        # live syscall streams of agents running with --stream
+        stream_server = SyscallStreamServer(hostname_to_listen, stream_port, consume_stream)
+        stream_server.start()
+
+def consume_stream(source, stream_id, syscall_stream):
+    stream, error = get_stream(stream_id)
+    if stream is None:
+        print(f"[IDS] syscall stream {source} rejected: {error[0]}", flush=True)
+        return
+    stream.handler.consume_stream(source, syscall_stream)
 
 def get_current_timestamp():
     """Returns the current system timestamp in a human-readable format"""
     return datetime.today().strftime('%Y-%m-%d %H:%M:%S')
     
 
-def evaluate_generation():
+def evaluate_generation(generation_name):
     ## send the generation results to the fuzzino server
     ## format json, example: {'generation': 'G1', 'testcases': [{'testcase': 'T001', 'anomaly-score-max': 0}]}
 
 
-    global current_generation
-    global testcases
     global fuzzino_endpoint
 
-    # We wait until all testcases have an IDS score or cannot receive any IDS score any more
-    while not testcases.is_complete():
-        print("[IDS] IDS values not complete yet...", flush=True)
-        time.sleep(10)
+    start = time.time()
+    # We wait until all testcases of the generation have an IDS score or cannot receive any IDS score any more,
+    # the scorers signal every testcase which gets its first score or is finished
+    while not streams.wait_until_complete(generation_name, timeout=COMPLETION_LOG_INTERVAL):
+        incomplete = streams.incomplete_testcases(generation_name)
+        print(f"[IDS] IDS values of generation {generation_name} not complete yet, {len(incomplete)} testcase(s) without score, "
+              f"e.g. {incomplete[:3]}", flush=True)
 
-    # evaluate the current generation
+    # evaluate the generation
     result_data = {}
-    result_data["generation"] = current_generation
+    result_data["generation"] = generation_name
     result_data["testcases"] = []
-    for testcase in testcases._testcases.values():
-        # evaluate the testcase
-        if not testcase.has_score():
-            # Sometimes it can happen that no syscall was monitored which was observed during the time of the testcase
-            # In these situations a default score is sent.
-            print(f"[IDS] testcase {testcase} is sent without a real monitored score.")
-        result_data["testcases"].append({
-            "testcase":testcase._name, 
-            "anomaly-score-max":testcase._max_score, "anomaly-score-avg":testcase.get_avg_value(), 
-            "is-real-score": testcase.has_score()})
+    # every stream which received syscalls reports its testcases, without any stream the testcases are sent without score
+    for stream, testcase_manager in streams.generation_testcases(generation_name):
+        stream_id = stream.stream_id if stream is not None else DEFAULT_STREAM
+        detector_names = stream.handler.detector_names() if stream is not None else []
+        for testcase in testcase_manager._testcases.values():
+            # evaluate the testcase
+            if not testcase.has_score():
+                # Sometimes it can happen that no syscall was monitored which was observed during the time of the testcase
+                # In these situations a default score is sent.
+                print(f"[IDS] testcase {testcase} of stream {stream_id} is sent without a real monitored score.")
+            testcase_data = {
+                "testcase":testcase._name, 
+                "anomaly-score-max":testcase._max_score, "anomaly-score-avg":testcase.get_avg_value(), 
+                "anomaly-score-p50":testcase.get_quantile_value(0.5), "anomaly-score-p95":testcase.get_quantile_value(0.95),
+                "anomaly-score-p99":testcase.get_quantile_value(0.99),
+                "is-real-score": testcase.has_score()}
+            if stream_id != DEFAULT_STREAM:
+                testcase_data["stream"] = stream_id
+            if detector_names:
+                # the scores of every detector of the ensemble (the first one is the detector of the scores above)
+                testcase_data["detector-scores"] = testcase.get_detector_scores(detector_names)
+            result_data["testcases"].append(testcase_data)
     # send the results to the server
     print(f"[IDS] sending results to {fuzzino_endpoint}")
     print(f"[IDS] data send: ")
@@ -169,21 +546,12 @@ def evaluate_generation():
     print(f"[IDS] {result_data}")
     print("[IDS] ---------------------")
 
-    # We reset the state to prevent a race condition where Fuzzino could start a new generation even though
-    # we have not yet cleared the state of the previous one
-    # For this, we first create a new testcase manager
-    testcases.reset()
-    # Furthermore, we reset the current_generation as we completely processed it (i.e., sent its IDS values to Fuzzino)
-    current_generation = None
+    # The testcases of the generation are removed, the syscalls of later generations are not attributed to them any more
+    streams.remove_generation(generation_name)
     
-    # Now we send the response data to Fuzzino
-    try:
-        response = requests.post(fuzzino_endpoint, json=result_data)
-        response.raise_for_status()
-        print(f"[IDS] fuzzino response code: {response.status_code}")
-        print(f"[IDS] fuzzino response text: {response.text}")
-    except requests.exceptions.RequestException as e:
-        print(f"[IDS] error: {e}")
+    # Now we send the response data to Fuzzino, in the background (with retries)
+    result_sender.send(result_data)
+    metrics.evaluate_generation_duration.observe(time.time() - start)
 
 ###########################################################################
 # START
@@ -199,41 +567,123 @@ if __name__ == "__main__":
     # third argument: hostname to listen or None
     # fourth argument: port to listen or None
     # fifth argument: fuzzino-endpoint
+    # options (anywhere after the script name):
+    #   --decoder-workers=N  decode every scap file with N sysdig processes in parallel (default 1)
+    #   --stream-port=PORT   also accept live syscall streams of agents (agent.py --stream) on this tcp port
+    #   --incoming-folder=PATH folder for received uploads, e.g. a tmpfs (default uploads/.incoming)
+    #   --watch-uploads      hand scap uploads to the detection through the file observer on the upload folder
+    #                        (a file is only processed once the next one has arrived)
+    #   --ensemble=FILE      detection only: further detectors (see ensemble.py) which score the same syscalls,
+    #                        their scores are sent per testcase as "detector-scores"
+    #   --watch-model        detection only: reload the model whenever the model file (or its delta log) is written
+    #   --scorer-workers=N   number of threads scoring the syscalls of all streams (default: number of cpus)
+    #                        agents with a stream id (agent.py --stream-id) are separate streams with their own
+    #                        detector state and testcases, see streams.py (detection only, training uses one stream)
+    #   --async-server       serve the endpoints with aiohttp (see async_server.py) instead of the development server of flask
+    #   --membership=M       detection with astide only: backend of the normal database, set (default), sorted (sorted key
+    #                        array, binary search) or bloom (bloom filter, misses a mismatch with the false positive rate)
+    #   --false-positive-rate=P false positive rate of --membership=bloom (default 0.001)
+    #   --max-generations=N  generations in flight: fuzzino can start the next generation while the previous ones are
+    #                        still scored, up to N generations which are not yet evaluated (default 4)
 
     # check for arguments    
-    needed_arguments = "needed arguments: [training|detection] path_to_model algorithm features hostname port fuzzino_endpoint"
+    needed_arguments = "needed arguments: [training|detection] path_to_model algorithm features hostname port fuzzino_endpoint [--decoder-workers=N] [--stream-port=PORT] [--incoming-folder=PATH] [--watch-uploads] [--ensemble=FILE] [--watch-model] [--scorer-workers=N] [--async-server] [--max-generations=N] [--membership=set|sorted|bloom] [--false-positive-rate=P]"
     algorithm_list = ["astide", "fstide"]
     features_list = ["name", "name_result"]
-    if len(sys.argv) == 8:
-        mode = sys.argv[1]
+    arguments, options = ids_helper.split_options(sys.argv)
+    if len(arguments) == 8:
+        mode = arguments[1]
         if mode != "training" and mode != "detection":
             print("[IDS] mode has to be \"training\" or \"detection\"")
             print(needed_arguments)
             exit()        
-        path_to_model_file = sys.argv[2]
-        algorithm = sys.argv[3]
+        path_to_model_file = arguments[2]
+        algorithm = arguments[3]
         if algorithm.lower() not in algorithm_list:
             print(f"[IDS] algorithm has to be from the following list: {algorithm_list}")
-        features = sys.argv[4]
+        features = arguments[4]
         if features not in features_list:
             print(f"[IDS] features has to be from the following list: {features_list}")
-        hostname_to_listen = sys.argv[5]
-        port_to_listen = sys.argv[6]        
-        fuzzino_endpoint = sys.argv[7]
+        hostname_to_listen = arguments[5]
+        port_to_listen = arguments[6]        
+        fuzzino_endpoint = arguments[7]
+        decoder_workers = int(options.get("decoder-workers", 1))
+        if decoder_workers < 1:
+            print("[IDS] decoder-workers has to be at least 1")
+            exit()
+        stream_port = options.get("stream-port")
+        watch_uploads = "watch-uploads" in options
+        if "incoming-folder" in options:
+            app.config['INCOMING_FOLDER'] = os.path.join(os.path.abspath(options["incoming-folder"]), "")
+        if "ensemble" in options:
+            if mode != "detection":
+                print("[IDS] an ensemble of detectors can only be used in detection mode")
+                exit()
+            ensemble_configs = read_ensemble_config(options["ensemble"])
+        watch_model = "watch-model" in options
+        scorer_workers = int(options.get("scorer-workers", scorer_workers))
+        async_server = "async-server" in options
+        if scorer_workers < 1:
+            print("[IDS] scorer-workers has to be at least 1")
+            exit()
+        max_generations = int(options.get("max-generations", max_generations))
+        if max_generations < 1:
+            print("[IDS] max-generations has to be at least 1")
+            exit()
+        streams.max_generations = max_generations
+        membership = options.get("membership", membership)
+        false_positive_rate = float(options.get("false-positive-rate", false_positive_rate))
+        if membership not in MEMBERSHIPS:
+            print(f"[IDS] membership has to be one of {MEMBERSHIPS}")
+            exit()
+        if membership != MEMBERSHIP_SET and (mode != "detection" or algorithm.lower() != "astide"):
+            print("[IDS] the membership backends are only available for astide in detection mode")
+            exit()
+        if not 0 < false_positive_rate < 1:
+            print("[IDS] false-positive-rate has to be between 0 and 1")
+            exit()
+        if mode == "training":
+            # all uploads have to go into the one model
+            streams.max_streams = 1
+        if watch_model and mode != "detection":
+            print("[IDS] the model can only be watched in detection mode")
+            exit()
     else:
         print(needed_arguments)
         print(f"algorithm options: {algorithm_list}")
         print(f"feature options: {features_list}")
         exit()
 
+    os.makedirs(app.config['INCOMING_FOLDER'], exist_ok=True)
+
+    result_sender = ResultSender(fuzzino_endpoint)
+
     # run the file observer part
     t = threading.Thread(target=run_observer)
     t.start()
 
     # run server for upload handling
-    app.run(host=hostname_to_listen, port=port_to_listen, debug=False)
-    print("[IDS] flask server ended...")
+    if async_server:
+        create_async_server().run(hostname_to_listen, port_to_listen)
+        print("[IDS] async server ended...")
+    else:
+        app.run(host=hostname_to_listen, port=port_to_listen, debug=False)
+        print("[IDS] flask server ended...")
 
     # at the end, close the other threads
     ids_helper.close_thread(t,"observer helper")
-    ids_helper.close_thread(observer, "observer")
+    if watch_uploads:
+        ids_helper.close_thread(observer, "observer")
+    if watch_model:
+        ids_helper.close_thread(model_observer, "model observer")
+    if stream_server is not None:
+        stream_server.stop()
+    print("[IDS] waiting for the decoders and scorers to finish...")
+    streams.stop()
+    if score_pool is not None:
+        score_pool.stop()
+    if parallel_decoder is not None:
+        parallel_decoder.shutdown()
+    if result_sender is not None:
+        print("[IDS] sending the remaining results...")
+        result_sender.stop(timeout=60)
@@ -1,35 +1,175 @@
+import gc
+import functools
 import subprocess
+import threading
 import time
 
 import os
+import numpy as np
 from watchdog.events import FileSystemEventHandler
 
-from syscall import Syscall
-from astide import ASTIDE
-from fstide import FSTIDE
+import metrics
+from profiling import profiler
+from syscall import SYSDIG_OUTPUT_FORMAT, read_sysdig_batches
+from vocabulary import Vocabulary
 from stats import Stats
+from ensemble import DetectorEnsemble, detector_config
+from model_registry import ModelRegistry
+from pipeline import PipelineStage
+from parallel_decode import ParallelDecoder
+from syscall_stream import SYSCALL_STREAM_SUFFIX, read_syscall_stream
+from model_store import DELTA_LOG_SUFFIX
+from ngram_table import MEMBERSHIP_SET, DEFAULT_FALSE_POSITIVE_RATE
 from queue import Queue
 
+class _SourceState:
+    """
+    scorer state of one source of a ParserFileHandler: the uploaded files, which are scored one after another with
+    one state (the thread ngrams and the sliding window continue from file to file), or a live stream
+    """
+
+    def __init__(self, model, detector, ensemble=None):
+        # the primary detector of the handler which the state follows (a live stream scores with a copy of it)
+        self.model = model
+        self.detector = detector
+        self.ensemble = ensemble
+        # of the current file (or stream), None between two files
+        self.stats = None
+        self.last_timestamp = None
+
+
 # Handles file observer and starts parsing the files
+# the work is split into three stages which are connected by bounded queues:
+#   intake  (watchdog thread): registers the files and hands complete files to the decoder
+#   decoder (own thread)     : runs "sysdig -r" on a file and parses its output into SyscallBatches
+#   scorer  (own thread)     : trains on or scores the batches and adds the scores to the testcases
+# so decoding file i+1 overlaps with scoring file i, and a slow scorer blocks the decoder (and thereby sysdig)
+# live streams (consume_stream) are scored by the same scorer, each with its own thread ngrams, sliding window and
+# stats (see _SourceState), so their batches can arrive in between the batches of a file
+# with several streams (see streams.py) every stream has its own ParserFileHandler, the handlers can share
+# the loaded models (model_registry), the scorer threads (score_pool) and the sysdig processes (parallel_decoder)
 class ParserFileHandler(FileSystemEventHandler):
-    def __init__(self, testcase_manager, mode, path_to_model_file, algorithm, features):        
+    def __init__(self, testcase_manager, mode, path_to_model_file, algorithm, features, decode_queue_size=4, score_queue_size=16, decoder_workers=1,
+                 ensemble_configs=None, model_registry=None, score_pool=None, parallel_decoder=None, name="",
+                 membership=MEMBERSHIP_SET, false_positive_rate=DEFAULT_FALSE_POSITIVE_RATE):
         self._files = set()
+        # file -> time it was received, for the latency until it is scored (see metrics.py)
+        self._received = {}
         self.file_queue = Queue()  # Queue of files to process
-        if algorithm.lower() == "astide":
-            self._stide = ASTIDE(mode=mode, model_file=path_to_model_file)
-        if algorithm.lower() == "fstide":
-            self._stide = FSTIDE(mode=mode, model_file=path_to_model_file, syscall_mapper=features)
+        self._algorithm = algorithm
+        # ASTIDE always maps the syscalls to their names
+        self._features = "name" if algorithm.lower() == "astide" else features
+        self._model_registry = model_registry if model_registry is not None else ModelRegistry()
+        # backend of the normal database of ASTIDE, see ngram_table.MEMBERSHIPS
+        self._membership = membership
+        self._false_positive_rate = false_positive_rate
+        self._stide = self._create_detector(mode, path_to_model_file)
+        self._detector_name = self._detector_config(path_to_model_file)["name"]
+        # a reloaded detector waiting to replace self._stide, see reload_model
+        self._pending_detector = None
+        self._reload_lock = threading.Lock()
+        # source of a live syscall stream -> its _SourceState, until the scorer has finished the stream
+        self._streams = {}
+        # with an ensemble config (see ensemble.py) further detectors score the same batches next to this one
+        self._ensemble = None
+        if ensemble_configs:
+            detectors = [(self._detector_name, self._features, self._stide)]
+            detectors += [(config["name"], config["features"], self._model_registry.detector(config, mode)) for config in ensemble_configs]
+            self._ensemble = DetectorEnsemble(detectors)
+        self._file_state = _SourceState(self._stide, self._stide, self._ensemble)
 
         self._testcase_manager = testcase_manager
+        # syscall names are interned across all parsed files
+        self._syscall_names = Vocabulary()
+
+        # files which are completely written, waiting for the decoder
+        self._decode_queue = Queue(maxsize=decode_queue_size)
+        # decoded batches (and end of file markers), waiting for the scorer
+        if score_pool is not None:
+            self._score_queue = score_pool.serial_queue(f"Scorer{name}", functools.partial(profiler.call, self._score_item), score_queue_size)
+        else:
+            self._score_queue = Queue(maxsize=score_queue_size)
+        # timestamp of the last scored syscall of all sources
+        self._last_timestamp = None
+        # with more than one worker every file is decoded by several sysdig processes at once
+        self._own_parallel_decoder = parallel_decoder is None and decoder_workers > 1
+        self._parallel_decoder = ParallelDecoder(decoder_workers) if self._own_parallel_decoder else parallel_decoder
+
+        # the stages run under the profiler while a deterministic profiling session is running (see profiling.py)
+        self._decoder = PipelineStage(f"Decoder{name}", self._decode_queue, functools.partial(profiler.call, self._decode_file))
+        self._decoder.start()
+        # without pool the scorer has its own thread
+        self._scorer = None
+        if score_pool is None:
+            self._scorer = PipelineStage(f"Scorer{name}", self._score_queue, functools.partial(profiler.call, self._score_item))
+            self._scorer.start()
+
+    def _detector_config(self, model_file):
+        return detector_config(self._algorithm, self._features, model_file, membership=self._membership,
+                               false_positive_rate=self._false_positive_rate)
+
+    def _create_detector(self, mode, model_file):
+        return self._model_registry.detector(self._detector_config(model_file), mode)
+
+    def reload_model(self, model_file):
+        """
+        loads the given model in the background, the scorer switches to it between two files
+        (or between two batches of a live stream), returns False if not in detection mode
+        """
+        if self._stide.mode != "detection":
+            return False
+        threading.Thread(target=self._load_model, args=(model_file,), daemon=True).start()
+        return True
+
+    def _load_model(self, model_file):
+        print(f"[FileHandler] loading model {model_file}", flush=True)
+        try:
+            detector = self._create_detector("detection", model_file)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"[FileHandler] could not load model {model_file}: {e}", flush=True)
+            return
+        with self._reload_lock:
+            # a model loaded before, but not swapped in yet, is replaced
+            self._pending_detector = (model_file, detector)
+        print(f"[FileHandler] model {model_file} loaded, waiting for the scorer to switch", flush=True)
 
-    def on_modified(self, event):        
-        filename = os.path.basename(event.src_path)
-        if not event.is_directory and filename.startswith('trace.scap') and filename[10:].isdigit():            
-            if event.src_path not in self._files:
+    def _swap_detector(self):
+        with self._reload_lock:
+            model_file, detector = self._pending_detector
+            self._pending_detector = None
+        # the thread ngrams and the sliding window continue, so there is no new warm-up
+        detector.take_over_state(self._stide)
+        if self._ensemble is not None:
+            self._ensemble.replace_detector(self._detector_name, detector)
+        self._stide = detector
+        self._file_state.model = self._file_state.detector = detector
+        # the old model is only referenced by its own ngram builder (on_repack) now, so free it right away
+        gc.collect()
+        print(f"[FileHandler] switched to model {model_file}", flush=True)
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self.register_file(event.src_path)
+
+    # sequenced uploads are moved into the upload folder once they are complete,
+    # depending on the observer this is reported as a move or (from an unobserved folder) as a new file
+    def on_moved(self, event):
+        if not event.is_directory:
+            self.register_file(event.dest_path)
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self.register_file(event.src_path)
+
+    def register_file(self, file_path):
+        filename = os.path.basename(file_path)
+        if filename.startswith('trace.scap') and filename[10:].isdigit():
+            if file_path not in self._files:
                 print(f'[FileHandler] ------------------------------------------ ', flush=True)
-                print(f'[FileHandler] Receiving file: {event.src_path}', flush=True)
-                self._files.add(event.src_path) # remove this entry when detection is done on it
-                self.file_queue.put(event.src_path)
+                print(f'[FileHandler] Receiving file: {file_path}', flush=True)
+                self._files.add(file_path) # remove this entry when detection is done on it
+                self._received[file_path] = time.time()
+                self.file_queue.put(file_path)
                 self.parse_next_waiting_file()
 
     def parse_next_waiting_file(self):
@@ -41,10 +181,40 @@ class ParserFileHandler(FileSystemEventHandler):
         self.parse_file(file_path)
 
     def parse_file(self, file_path):
-        print(f"[FileHandler] parsing file: {file_path}", flush=True)
-        self._parse_sysdig_output(file_path)
-        self.delete_file(file_path)
-    
+        # blocks the intake while the decoder is busy with decode_queue_size files
+        self._decode_queue.put(file_path)
+        print(f"[FileHandler] queued file for decoding: {file_path} {self.queue_depths()}", flush=True)
+
+    def submit_file(self, file_path):
+        """
+        hands a completely written file (scap or binary syscall stream) directly to the decoder
+        """
+        self._files.add(file_path)
+        self._received[file_path] = time.time()
+        self.parse_file(file_path)
+
+    def queue_depths(self):
+        """
+        returns the number of waiting items in front of each stage
+        """
+        return {
+            "intake": self.file_queue.qsize(),
+            "decoder": self._decode_queue.qsize(),
+            "scorer": self._score_queue.qsize(),
+        }
+
+    def stop(self):
+        """
+        lets the decoder and the scorer finish their queued work and ends them
+        """
+        self._decoder.stop()
+        if self._scorer is not None:
+            self._scorer.stop()
+        else:
+            self._score_queue.join()
+        if self._own_parallel_decoder:
+            self._parallel_decoder.shutdown()
+
     def delete_file(self, file_path):
         try:
             os.remove(file_path)
@@ -53,30 +223,228 @@ class ParserFileHandler(FileSystemEventHandler):
         except OSError as e:
             print(f"[FileHandler] Error trying do delete: {file_path} : {e.strerror}", flush=True)
 
-    def _parse_sysdig_output(self, file_path):
-        stats = Stats()
-        current_syscall = None
-        with subprocess.Popen(["sysdig", "-r", file_path, "-p", "%evt.rawtime %proc.name %thread.tid %evt.dir %syscall.type %evt.args"], stdout=subprocess.PIPE) as proc:
-            for line in proc.stdout:
-                # line enthält eine Zeile der Ausgabe
-                line = line.decode('utf-8').strip()  # decode and remove leading and trailing whitespace
-                # print(line)
-                current_syscall = Syscall(line)
-                if self._stide.mode == "training":
-                    self._stide.train_on(current_syscall)
-                else:
-                    current_score = self._stide.get_score(current_syscall)
-                    if current_score is not None:
-                        stats.add_value(current_score)
-                        # Getting all testcases which match time timestamp of the syscall and adding the IDS score to them
-                        testcase_list = self._testcase_manager.get_matching_testcases(current_syscall.timestamp_unix_in_ns()) 
-                        if len(testcase_list) > 1:
-                            print(f"[FileHandler] Associating IDS score with multiple test cases, namely {testcase_list}", flush=True)
-                        for testcase in testcase_list:
-                            testcase.add_score(current_score)
+    def consume_stream(self, source, stream):
+        """
+        parses live sysdig output (see SYSDIG_OUTPUT_FORMAT) from the given binary stream (e.g. a socket)
+        and hands the batches to the scorer as soon as they arrive, returns at the end of the stream
+        """
+        print(f"[FileHandler] receiving syscall stream: {source}", flush=True)
+        syscalls = 0
+        # the decoder thread owns self._syscall_names, every stream gets its own vocabulary
+        names = Vocabulary()
+        self._streams[source] = self._stream_state()
+        try:
+            for batch in read_sysdig_batches(stream, names, with_args=self._needs_syscall_params(), chunk_size=1 << 16, low_latency=True):
+                syscalls += len(batch)
+                metrics.syscalls_decoded.inc(len(batch))
+                self._score_queue.put(("batch", source, batch))
+            print(f"[FileHandler] syscall stream {source} ended after {syscalls} syscalls", flush=True)
+        finally:
+            # also after an error, so the scorer finishes the stream and does not score the next source into its stats
+            self._score_queue.put(("end", source, None))
+
+    def _stream_state(self):
+        if self._stide.mode != "detection":
+            # there is only one model in training, the stream trains it next to the files
+            return _SourceState(self._stide, self._stide)
+        if self._ensemble is None:
+            return _SourceState(self._stide, self._stide.shared_copy())
+        ensemble = self._ensemble.shared_copy()
+        # the first detector of the ensemble is the primary one
+        return _SourceState(self._stide, ensemble.detectors()[0][1], ensemble)
+
+    def _follow_model(self, state):
+        # a live stream continues with a copy of the reloaded model, without new warm-up
+        detector = self._stide.shared_copy()
+        detector.take_over_state(state.detector)
+        if state.ensemble is not None:
+            state.ensemble.replace_detector(self._detector_name, detector)
+        state.model = self._stide
+        state.detector = detector
+
+    def _needs_syscall_params(self):
+        if self._ensemble is not None:
+            return self._ensemble.needs_syscall_params
+        return self._stide.needs_syscall_params
+
+    def has_data(self):
+        """
+        returns True once the scorer has received syscalls
+        """
+        return self._last_timestamp is not None
+
+    def detector_names(self):
+        """
+        returns the names of the ensemble detectors, an empty list without ensemble
+        """
+        return [] if self._ensemble is None else list(self._ensemble.names)
+
+    def model_sizes(self):
+        """
+        returns (detector name, model file, unique ngrams) of every detector
+        """
+        if self._ensemble is not None:
+            detectors = self._ensemble.detectors()
+        else:
+            detectors = [(self._detector_name, self._stide)]
+        return [(name, detector._model_file, detector.ngram_count()) for name, detector in detectors]
+
+    def active_threads(self):
+        """
+        returns the number of threads with a ngram history (the ngram builders of an ensemble see the same threads)
+        """
+        states = [self._file_state] + list(self._streams.values())
+        # in training the streams use the detector of the files
+        detectors = {id(state.detector): state for state in states}
+        return sum(state.ensemble.active_threads() if state.ensemble is not None else state.detector._ngram_builder.thread_count()
+                   for state in detectors.values())
+
+    # decoder stage
+    def _decode_file(self, file_path):
+        print(f"[FileHandler] parsing file: {file_path}", flush=True)
+        start = time.time()
+        syscalls = 0
+        with_args = self._needs_syscall_params()
+        try:
+            if file_path.endswith(SYSCALL_STREAM_SUFFIX):
+                # transcoded by the agent, no sysdig needed
+                with open(file_path, 'rb') as stream_file:
+                    for batch in profiler.timed("parse", read_syscall_stream(stream_file, self._syscall_names, with_args=with_args)):
+                        syscalls += len(batch)
+                        self._score_queue.put(("batch", file_path, batch))
+            elif self._parallel_decoder is not None:
+                for batch in profiler.timed("parse", self._parallel_decoder.batches(file_path, self._syscall_names, with_args=with_args)):
+                    syscalls += len(batch)
+                    self._score_queue.put(("batch", file_path, batch))
+            else:
+                with subprocess.Popen(["sysdig", "-r", file_path, "-p", SYSDIG_OUTPUT_FORMAT], stdout=subprocess.PIPE) as proc:
+                    for batch in profiler.timed("parse", read_sysdig_batches(proc.stdout, self._syscall_names, with_args=with_args)):
+                        syscalls += len(batch)
+                        self._score_queue.put(("batch", file_path, batch))
+            duration = time.time() - start
+            metrics.syscalls_decoded.inc(syscalls)
+            metrics.decode_duration.observe(duration)
+            print(f"[FileHandler] decoded {syscalls} syscalls of {file_path} in {duration:.2f}s", flush=True)
+            # the scorer only needs the decoded batches, so the file can go now
+            self.delete_file(file_path)
+        finally:
+            # also after a decoding error, the batches queued so far are scored as this file and the file is finished
+            self._score_queue.put(("end", file_path, None))
+
+    # scorer stage
+    def _score_item(self, item):
+        kind, file_path, batch = item
+        state = self._streams.get(file_path, self._file_state)
+        # a reloaded model is used from the next file on, the live streams follow with their next batch
+        if self._pending_detector is not None and self._file_state.stats is None:
+            self._swap_detector()
+        if state.model is not self._stide:
+            self._follow_model(state)
+        if state.stats is None:
+            state.stats = Stats()
+        if kind == "batch":
+            state.last_timestamp = self._last_timestamp = batch.timestamps[-1]
+            metrics.syscalls_scored.inc(len(batch))
+            if self._stide.mode == "training":
+                self._stide.train_on_batch(batch)
+            else:
+                self._score_batch(batch, state)
+                # all syscalls up to here are scored, testcases which ended before are finished
+                with profiler.span("testcases"):
+                    self._testcase_manager.advance_to(state.last_timestamp)
+            self._expire_threads(batch, state)
+        else:
+            self._finish_file(file_path, state)
+            state.stats = None
+            if state is not self._file_state:
+                del self._streams[file_path]
+
+    def _score_batch(self, batch, state):
+        timestamps = np.frombuffer(batch.timestamps, dtype=np.int64)
+        if state.ensemble is None:
+            # score_batch of the detector in two steps, so they can be timed separately
+            with profiler.span("ngram"):
+                windows = state.detector.ngram_windows(batch)
+            with profiler.span("score"):
+                scores = state.detector.score_windows(windows)
+        else:
+            # the ensemble builds the ngrams while scoring
+            with profiler.span("score"):
+                detector_scores = state.ensemble.score_batch(batch)
+            with profiler.span("testcases"):
+                for name, scores in detector_scores:
+                    scored = np.flatnonzero(~np.isnan(scores))
+                    self._testcase_manager.attribute_scores(timestamps[scored], scores[scored], detector=name)
+            # the first detector is the one of the ids (state.detector)
+            scores = detector_scores[0][1]
+        scored = np.flatnonzero(~np.isnan(scores))
+        state.stats.add_values(scores[scored])
+        # adding the IDS scores to the testcases which match the timestamps of the syscalls
+        with profiler.span("testcases"):
+            self._testcase_manager.attribute_scores(timestamps[scored], scores[scored])
+
+    def _expire_threads(self, batch, state):
+        # the ngram history of exited and idle threads is dropped, so it does not grow over a long campaign
+        with profiler.span("ngram"):
+            exited, expired = (state.ensemble if state.ensemble is not None else state.detector).expire_threads(batch)
+        metrics.ngram_threads_exited.inc(exited)
+        metrics.ngram_threads_expired.inc(expired)
+
+    def _finish_file(self, file_path, state):
+        stats = state.stats
+        print(f"[FileHandler] scored: {file_path} {self.queue_depths()}", flush=True)
+        received = self._received.pop(file_path, None)
+        if received is not None:
+            # the end of a live stream is no file
+            metrics.files_scored.inc()
+            metrics.file_latency.observe(time.time() - received)
+            profiler.file_done()
         if self._stide.mode == "training":
             self._stide.fit()
         elif self._stide.mode == "detection":
             print(f"[FileHandler] min/avg/max anomaly scores for the last file: {stats.get_min()}/{stats.get_average()}/{stats.get_max()}", flush=True)
-            if current_syscall:
-                print(f"[FileHandler] current testcase(s): {self._testcase_manager.get_matching_testcases(current_syscall.timestamp_unix_in_ns())}", flush=True)
+            print(f"[FileHandler] p50/p95/p99 anomaly scores for the last file: {stats.get_quantile(0.5)}/{stats.get_quantile(0.95)}/{stats.get_quantile(0.99)}", flush=True)
+            if state.last_timestamp is not None:
+                with profiler.span("testcases"):
+                    current_testcases = self._testcase_manager.get_matching_testcases(state.last_timestamp)
+                print(f"[FileHandler] current testcase(s): {current_testcases}", flush=True)
+
+
+# Watches the model file (and its delta log) and reloads the model (of all streams) when it was written,
+# the events of one write are combined: the reload starts once the files did not change for delay seconds
+class ModelFileHandler(FileSystemEventHandler):
+    def __init__(self, reload_model, model_file, delay=2.0):
+        # called with the model file, e.g. ParserFileHandler.reload_model
+        self._reload_model = reload_model
+        self._model_file = model_file
+        self._paths = {os.path.abspath(model_file), os.path.abspath(model_file) + DELTA_LOG_SUFFIX}
+        self._delay = delay
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self._changed(event.src_path)
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self._changed(event.src_path)
+
+    # new model files are written to a temporary file first, which then replaces the model file
+    def on_moved(self, event):
+        if not event.is_directory:
+            self._changed(event.dest_path)
+
+    def _changed(self, file_path):
+        if os.path.abspath(file_path) not in self._paths:
+            return
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = threading.Timer(self._delay, self._model_changed)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _model_changed(self):
+        print(f"[ModelFileHandler] model file changed: {self._model_file}", flush=True)
+        self._reload_model(self._model_file)
@@ -18,3 +18,18 @@ def close_thread(t, name):
     except:
         print(f"[IDS] could not join {name} thread")
 
+
+def split_options(arguments):
+    """
+    separates "--name=value" options from the positional arguments
+    returns the positional arguments and a dict of the options (name without dashes -> value)
+    """
+    positional = []
+    options = {}
+    for argument in arguments:
+        if argument.startswith("--"):
+            name, _, value = argument[2:].partition("=")
+            options[name] = value
+        else:
+            positional.append(argument)
+    return positional, options
@@ -0,0 +1,141 @@
+import math
+import threading
+from bisect import bisect_left
+
+# metrics of the ids in the Prometheus text format (GET /ids/metrics), without the prometheus client library:
+# counters and histograms are updated once per batch or file (never per syscall) under a lock, so they stay on.
+# values which can be read at any time (queue depths, model size, ...) are collected when the metrics are scraped.
+# rates like syscalls per second are computed by Prometheus from the counters, e.g. rate(ids_syscalls_decoded_total[1m])
+
+# seconds, from tens of milliseconds (live streams) to minutes (a backlog of 10 s files)
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for value in labels.values())
+    return "{" + ",".join(f"{name}=\"{value}\"" for name, value in zip(labels, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._lock = threading.Lock()
+        self._value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def get(self):
+        return self._value
+
+    def expose(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter", f"{self.name} {_format_value(self._value)}"]
+
+
+class Histogram:
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self._buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # observations per bucket (not cumulative), the last one is +Inf
+        self._counts = [0] * (len(self._buckets) + 1)
+        self._sum = 0.0
+
+    def observe(self, value):
+        with self._lock:
+            self._counts[bisect_left(self._buckets, value)] += 1
+            self._sum += value
+
+    def count(self):
+        return sum(self._counts)
+
+    def expose(self):
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self._buckets + (math.inf,), counts):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{_format_labels({'le': _format_value(float(bound))})} {cumulative}")
+        lines.append(f"{self.name}_sum {_format_value(total)}")
+        lines.append(f"{self.name}_count {cumulative}")
+        return lines
+
+
+class Gauge:
+    """
+    gauge whose samples are collected when the metrics are scraped: collect() returns a list of (labels, value)
+    """
+
+    def __init__(self, name, documentation, collect):
+        self.name = name
+        self.documentation = documentation
+        self._collect = collect
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        lines += [f"{self.name}{_format_labels(labels)} {_format_value(value)}" for labels, value in self._collect()]
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation):
+        return self._register(Counter(name, documentation))
+
+    def histogram(self, name, documentation, buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, documentation, buckets))
+
+    def gauge(self, name, documentation, collect):
+        return self._register(Gauge(name, documentation, collect))
+
+    def expose(self):
+        """
+        returns all metrics in the Prometheus text format
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            try:
+                lines += metric.expose()
+            except Exception as e:
+                # a broken collector must not hide the other metrics
+                print(f"[Metrics] could not collect {metric.name}: {e}", flush=True)
+        return "\n".join(lines) + "\n"
+
+
+# the metrics updated by the pipeline (see ids_file_observer.py), the gauges are registered by ids.py
+registry = MetricsRegistry()
+syscalls_decoded = registry.counter("ids_syscalls_decoded_total", "syscalls decoded from files and live streams")
+syscalls_scored = registry.counter("ids_syscalls_scored_total", "syscalls handled by the scorers (trained on in training mode)")
+files_scored = registry.counter("ids_files_scored_total", "files completely scored (or trained on)")
+ngram_threads_exited = registry.counter("ids_ngram_threads_exited_total", "thread ngram histories dropped after the thread exited (exit or exit_group)")
+ngram_threads_expired = registry.counter("ids_ngram_threads_expired_total", "thread ngram histories dropped because the thread was idle or the least recently seen")
+file_latency = registry.histogram("ids_file_latency_seconds", "seconds from the complete upload of a file until it is scored")
+decode_duration = registry.histogram("ids_decode_duration_seconds", "seconds to decode one file (sysdig or binary syscall stream)")
+evaluate_generation_duration = registry.histogram("ids_evaluate_generation_seconds",
+                                                  "seconds from the end of a generation until its results are queued for fuzzino (including the wait for complete testcases)",
+                                                  buckets=(1, 5, 10, 20, 30, 60, 120, 300, 600, 1200))
@@ -0,0 +1,55 @@
+import os
+import threading
+
+from ensemble import create_detector
+from model_store import DELTA_LOG_SUFFIX
+
+# the streams of the ids (see streams.py) which use the same model share it:
+# every model is loaded once and each stream gets a detector with its own running state on top (shared_copy)
+
+
+def _model_version(model_file):
+    # a model file which was replaced (or whose delta log has grown) is loaded again
+    version = []
+    for file_name in (model_file, model_file + DELTA_LOG_SUFFIX):
+        try:
+            stat = os.stat(file_name)
+            version.append((stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            version.append(None)
+    return tuple(version)
+
+
+class ModelRegistry:
+    """
+    loads the models of detector configs (see ensemble.detector_config) once and hands out detectors sharing them
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # config without the model file -> (model file, model version, detector holding the loaded model),
+        # a reload to another model file replaces the entry, so the registry never keeps the old model alive
+        self._models = {}
+
+    def detector(self, config, mode="detection"):
+        """
+        returns a new detector for the given config, in detection mode it shares the model with all other
+        detectors of the same config, a training detector always gets its own model
+        """
+        if mode != "detection":
+            return create_detector(config, mode)
+        key = tuple(sorted((name, value) for name, value in config.items() if name != "model_file"))
+        model_file = config["model_file"]
+        version = _model_version(model_file)
+        # loading is done under the lock, so several streams asking for the same model load it only once
+        with self._lock:
+            entry = self._models.get(key)
+            if entry is None or entry[0] != model_file or entry[1] != version:
+                # the previous model of the config is dropped, the streams still using it keep it until they switch
+                self._models.pop(key, None)
+                entry = self._models[key] = (model_file, version, create_detector(config, mode))
+        return entry[2].shared_copy()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._models)
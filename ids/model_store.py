@@ -0,0 +1,344 @@
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+
+import numpy as np
+
+import ids_helper
+from angram import ANgram
+from vocabulary import Vocabulary
+from ngram_table import SortedNgramTable, BloomNgramFilter, int_keys_to_array, array_to_int_keys, key_dtype, DEFAULT_FALSE_POSITIVE_RATE
+
+# model kinds, ASTIDE stores a set of ngrams, FSTIDE a count per ngram
+ASTIDE_MODEL = "astide"
+FSTIDE_MODEL = "fstide"
+_KINDS = [ASTIDE_MODEL, FSTIDE_MODEL]
+
+# binary model format (little endian):
+#   header (see _HEADER): magic, version, kind, n, bits, number of vocabulary strings, number of ngrams,
+#                         offset and size of the vocabulary, offset of the keys, offset of the counts
+#   vocabulary: json list of the vocabulary strings (without the reserved ones), utf-8
+#   keys: sorted packed ngram keys, see ngram_table.key_dtype(bits, n)
+#   counts: one uint64 per key
+BINARY_MODEL_MAGIC = b"IDSMODEL"
+BINARY_MODEL_VERSION = 1
+BINARY_MODEL_SUFFIX = ".bin"
+_HEADER = struct.Struct("<8sIIIIIQQQQQ")
+_ALIGNMENT = 64
+
+# delta log of a model file (model file name + DELTA_LOG_SUFFIX), written by the checkpoints of the training:
+#   one json line per ngram changed since the model file (the snapshot) was written: [[element, ...], count]
+#   the count replaces the count of the snapshot (and of earlier lines), so replaying a line twice does no harm
+# the delta log is compacted into a new snapshot once it holds DELTA_COMPACT_RATIO times as many lines as the model ngrams
+DELTA_LOG_SUFFIX = ".delta"
+DELTA_COMPACT_RATIO = 1.0
+
+
+def is_binary_model_file(file_name) -> bool:
+    """
+    returns True if the given file starts with the binary model magic
+    """
+    with open(file_name, 'rb') as model_file:
+        return model_file.read(len(BINARY_MODEL_MAGIC)) == BINARY_MODEL_MAGIC
+
+
+def _aligned(offset):
+    return (offset + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+def write_binary_model(file_name, kind, n, bits, vocabulary: Vocabulary, items):
+    """
+    writes a model in the binary format
+    items: iterable of (packed integer key, count) pairs, keys packed with the given bits
+    the file is written to a temporary file first and then replaces file_name
+    """
+    counts = dict(items)
+    keys = int_keys_to_array(counts.keys(), bits, n)
+    values = np.fromiter(counts.values(), dtype=np.uint64, count=len(keys))
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    values = values[order]
+
+    vocabulary_blob = json.dumps(vocabulary.to_list()).encode('utf-8')
+    vocabulary_offset = _HEADER.size
+    keys_offset = _aligned(vocabulary_offset + len(vocabulary_blob))
+    counts_offset = _aligned(keys_offset + keys.nbytes)
+    header = _HEADER.pack(BINARY_MODEL_MAGIC, BINARY_MODEL_VERSION, _KINDS.index(kind), n, bits,
+                          len(vocabulary.to_list()), len(keys),
+                          vocabulary_offset, len(vocabulary_blob), keys_offset, counts_offset)
+
+    temp_file_name = file_name + ".tmp"
+    with open(temp_file_name, 'wb') as model_file:
+        model_file.write(header)
+        model_file.write(vocabulary_blob)
+        model_file.write(b"\0" * (keys_offset - vocabulary_offset - len(vocabulary_blob)))
+        model_file.write(keys.tobytes())
+        model_file.write(b"\0" * (counts_offset - keys_offset - keys.nbytes))
+        model_file.write(values.tobytes())
+        model_file.flush()
+        os.fsync(model_file.fileno())
+    os.replace(temp_file_name, file_name)
+
+
+class BinaryModel:
+    """
+    a binary model file opened with mmap
+    the key and count arrays of the table are views on the mapped file, so opening a model
+    only reads the header and the vocabulary, no matter how many ngrams it holds
+    """
+
+    def __init__(self, file_name):
+        with open(file_name, 'rb') as model_file:
+            self._mmap = mmap.mmap(model_file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, kind, self.n, self.bits, vocabulary_count, ngram_count,
+         vocabulary_offset, vocabulary_size, keys_offset, counts_offset) = _HEADER.unpack_from(self._mmap, 0)
+        if magic != BINARY_MODEL_MAGIC:
+            raise ValueError(f"{file_name} is not a binary model file")
+        if version != BINARY_MODEL_VERSION:
+            raise ValueError(f"{file_name} has unsupported model version {version}, expected {BINARY_MODEL_VERSION}")
+        self.kind = _KINDS[kind]
+        strings = json.loads(self._mmap[vocabulary_offset:vocabulary_offset + vocabulary_size].decode('utf-8'))
+        if len(strings) != vocabulary_count:
+            raise ValueError(f"{file_name} has a damaged vocabulary")
+        self.vocabulary = Vocabulary(strings)
+        keys = np.frombuffer(self._mmap, dtype=key_dtype(self.bits, self.n), count=ngram_count, offset=keys_offset)
+        counts = np.frombuffer(self._mmap, dtype=np.uint64, count=ngram_count, offset=counts_offset)
+        self.table = SortedNgramTable(keys, counts, self.bits, self.n)
+
+
+def read_json_model(file_name):
+    """
+    reads an ASTIDE or FSTIDE json model
+    returns the model kind and a list of (ngram tuple, count) pairs, ASTIDE ngrams get the count 1
+    """
+    with open(file_name) as json_file:
+        model = json.load(json_file)
+    if "normal_database" in model:
+        return ASTIDE_MODEL, [(tuple(ngram), 1) for ngram in model["normal_database"]]
+    return FSTIDE_MODEL, [(tuple(json.loads(key)), count) for key, count in model.items()]
+
+
+def write_json_model(file_name, kind, ngrams):
+    """
+    writes an ASTIDE or FSTIDE json model
+    ngrams: iterable of (ngram tuple, count) pairs, the counts of ASTIDE models are not stored
+    """
+    if kind == ASTIDE_MODEL:
+        model = {"normal_database": [list(ngram) for ngram, _ in ngrams]}
+    else:
+        # convert tuple(str) keys to json compatible str:
+        model = {json.dumps(ngram): count for ngram, count in ngrams}
+    _write_atomic(file_name, json.dumps(model).encode('utf-8'))
+
+
+def _write_atomic(file_name, data: bytes):
+    """
+    writes the data to a temporary file first, which then replaces file_name
+    a crash while writing leaves the previous file untouched
+    """
+    temp_file_name = file_name + ".tmp"
+    with open(temp_file_name, 'wb') as outfile:
+        outfile.write(data)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.replace(temp_file_name, file_name)
+
+
+def read_delta_log(model_file_name):
+    """
+    reads the delta log of the given model file
+    returns a list of (ngram tuple, count) pairs, later pairs replace earlier ones of the same ngram
+    a line cut off by a crash while appending is ignored
+    """
+    try:
+        with open(model_file_name + DELTA_LOG_SUFFIX, 'rb') as log_file:
+            lines = log_file.read().split(b"\n")
+    except FileNotFoundError:
+        return []
+    ngrams = []
+    for line in lines:
+        if not line:
+            continue
+        try:
+            ngram, count = json.loads(line)
+        except ValueError:
+            continue
+        ngrams.append((tuple(ngram), count))
+    return ngrams
+
+
+def remove_delta_log(model_file_name):
+    try:
+        os.remove(model_file_name + DELTA_LOG_SUFFIX)
+    except FileNotFoundError:
+        pass
+
+
+class DeltaLog:
+    """
+    appends the ngrams changed since the last checkpoint to the delta log of a model file
+    """
+
+    def __init__(self, model_file_name):
+        self.file_name = model_file_name + DELTA_LOG_SUFFIX
+        # number of lines in the log, to decide when it is compacted
+        self.lines = len(read_delta_log(model_file_name))
+        self._drop_incomplete_line()
+
+    def _drop_incomplete_line(self):
+        # a line cut off by a crash would swallow the next appended line
+        try:
+            with open(self.file_name, 'rb+') as log_file:
+                data = log_file.read()
+                if data and not data.endswith(b"\n"):
+                    log_file.truncate(data.rfind(b"\n") + 1)
+        except FileNotFoundError:
+            pass
+
+    def append(self, ngrams):
+        """
+        appends the given (ngram tuple, count) pairs and syncs the log to disk
+        """
+        data = b"".join(json.dumps([list(ngram), count]).encode('utf-8') + b"\n" for ngram, count in ngrams)
+        if not data:
+            return
+        with open(self.file_name, 'ab') as log_file:
+            log_file.write(data)
+            log_file.flush()
+            os.fsync(log_file.fileno())
+        self.lines += data.count(b"\n")
+
+    def needs_compaction(self, pending, model_size):
+        """
+        returns True if the log would hold too many lines after appending pending more
+        """
+        return self.lines + pending >= max(1, DELTA_COMPACT_RATIO * model_size)
+
+
+def convert_json_to_binary(json_file_name, binary_file_name):
+    kind, ngrams = read_json_model(json_file_name)
+    vocabulary = Vocabulary()
+    for ngram, _ in ngrams:
+        for element in ngram:
+            vocabulary.add(element)
+    n = len(ngrams[0][0]) if ngrams else 1
+    ngram_builder = ANgram(n, vocabulary)
+    write_binary_model(binary_file_name, kind, n, ngram_builder.bits, vocabulary,
+                       ((ngram_builder.pack(ngram), count) for ngram, count in ngrams))
+    return kind, n, len(ngrams)
+
+
+def convert_binary_to_json(binary_file_name, json_file_name):
+    model = BinaryModel(binary_file_name)
+    ngram_builder = ANgram(model.n, model.vocabulary, bits=model.bits)
+    write_json_model(json_file_name, model.kind, ((ngram_builder.unpack(key), count) for key, count in model.table.items()))
+    return model.kind, model.n, len(model.table)
+
+
+def _read_int_keys(file_name):
+    # the packed keys of a json or binary model, with the bits and n of their layout
+    if is_binary_model_file(file_name):
+        model = BinaryModel(file_name)
+        return model.kind, array_to_int_keys(model.table.keys()), model.bits, model.n
+    kind, ngrams = read_json_model(file_name)
+    vocabulary = Vocabulary()
+    for ngram, _ in ngrams:
+        for element in ngram:
+            vocabulary.add(element)
+    n = len(ngrams[0][0]) if ngrams else 1
+    ngram_builder = ANgram(n, vocabulary)
+    return kind, [ngram_builder.pack(ngram) for ngram, _ in ngrams], ngram_builder.bits, n
+
+
+def _probe_keys(keys, bits, n, count=200_000, seed=1):
+    # keys to look up: half known keys of the model, half keys with a changed last element (mostly unknown)
+    rng = np.random.default_rng(seed)
+    known = [keys[index] for index in rng.integers(0, len(keys), count // 2).tolist()]
+    max_id = (1 << bits) - 1
+    changed = [(key & ~max_id) | ((key + 1 + offset) & max_id)
+               for key, offset in zip(known, rng.integers(0, max_id, len(known)).tolist())]
+    return known + changed
+
+
+def membership_report(file_name, false_positive_rate=DEFAULT_FALSE_POSITIVE_RATE):
+    """
+    returns (backend, bytes, build seconds, lookups per second, false positive rate) of the normal database
+    of the given model for every membership backend (see ngram_table.MEMBERSHIPS)
+    """
+    kind, keys, bits, n = _read_int_keys(file_name)
+    probe = _probe_keys(keys, bits, n) if keys else []
+    probe_array = int_keys_to_array(probe, bits, n)
+    results = []
+
+    start = time.perf_counter()
+    key_set = set(keys)
+    build = time.perf_counter() - start
+    # the set is looked up key by key, like the per syscall scoring
+    start = time.perf_counter()
+    expected = [key in key_set for key in probe]
+    lookup = time.perf_counter() - start
+    set_bytes = sys.getsizeof(key_set) + sum(sys.getsizeof(key) for key in key_set)
+    results.append(("set", set_bytes, build, len(probe) / lookup if lookup else 0.0, 0.0))
+    expected = np.array(expected, dtype=bool)
+    unknown = ~expected
+
+    start = time.perf_counter()
+    table = SortedNgramTable.from_keys(key_set, bits, n)
+    build = time.perf_counter() - start
+    start = time.perf_counter()
+    table.contains(probe_array)
+    lookup = time.perf_counter() - start
+    results.append(("sorted", table.nbytes, build, len(probe) / lookup if lookup else 0.0, 0.0))
+
+    start = time.perf_counter()
+    bloom = BloomNgramFilter.from_keys(table.keys(), bits, n, false_positive_rate)
+    build = time.perf_counter() - start
+    start = time.perf_counter()
+    found = bloom.contains(probe_array)
+    lookup = time.perf_counter() - start
+    measured = float(found[unknown].mean()) if unknown.any() else 0.0
+    results.append(("bloom", bloom.nbytes, build, len(probe) / lookup if lookup else 0.0, measured))
+    return kind, len(keys), results
+
+
+def _replace_suffix(file_name, suffix):
+    return os.path.splitext(file_name)[0] + suffix
+
+
+if __name__ == "__main__":
+    # converts models between the json and the binary format
+    #   python3 model_store.py to-binary models/*.json   -> writes models/<name>.bin
+    #   python3 model_store.py to-json models/*.bin      -> writes models/<name>.json
+    #   python3 model_store.py info models/<name>.bin
+    #   python3 model_store.py membership models/<name>.json [--false-positive-rate=P]
+    #       memory, build time and lookup throughput of the normal database per membership backend (see ngram_table.py)
+    commands = ["to-binary", "to-json", "info", "membership"]
+    if len(sys.argv) < 3 or sys.argv[1] not in commands:
+        print(f"needed arguments: [{'|'.join(commands)}] model_file [model_file ...]")
+        exit()
+    arguments, options = ids_helper.split_options(sys.argv)
+    command = arguments[1]
+    false_positive_rate = float(options.get("false-positive-rate", DEFAULT_FALSE_POSITIVE_RATE))
+    for file_name in arguments[2:]:
+        if command == "to-binary":
+            target = _replace_suffix(file_name, BINARY_MODEL_SUFFIX)
+            kind, n, size = convert_json_to_binary(file_name, target)
+        elif command == "to-json":
+            target = _replace_suffix(file_name, ".json")
+            kind, n, size = convert_binary_to_json(file_name, target)
+        elif command == "membership":
+            kind, size, results = membership_report(file_name, false_positive_rate)
+            print(f"[ModelStore] {file_name}: {kind} {size} ngrams")
+            for backend, size_bytes, build, lookups, measured in results:
+                print(f"[ModelStore]   {backend:6} {size_bytes:>12} bytes ({size_bytes / max(1, size):6.1f} per ngram)  "
+                      f"build {build:7.3f}s  {lookups:>12,.0f} lookups/s  false positives {measured:.4%}")
+            continue
+        else:
+            model = BinaryModel(file_name)
+            print(f"[ModelStore] {file_name}: {model.kind} n={model.n} bits={model.bits} "
+                  f"vocabulary={len(model.vocabulary.to_list())} ngrams={len(model.table)} bytes={os.path.getsize(file_name)}")
+            continue
+        print(f"[ModelStore] {file_name} -> {target} ({kind}, n={n}, {size} ngrams)")
@@ -0,0 +1,267 @@
+import math
+
+import numpy as np
+
+_WORD_MASK = (1 << 64) - 1
+
+# membership backends of the normal database of ASTIDE (detection only), see ASTIDE.load_model
+#   set    : python set of packed integer keys (a sorted copy is built for the batch lookups)
+#   sorted : SortedNgramTable, sorted key array with binary search (8 bytes per ngram up to 64 bit keys)
+#   bloom  : BloomNgramFilter with the given false positive rate (about 1.2 bytes per ngram at 1%), an unknown ngram
+#            is taken as known with that probability, so a few mismatches are missed
+MEMBERSHIP_SET = "set"
+MEMBERSHIP_SORTED = "sorted"
+MEMBERSHIP_BLOOM = "bloom"
+MEMBERSHIPS = [MEMBERSHIP_SET, MEMBERSHIP_SORTED, MEMBERSHIP_BLOOM]
+DEFAULT_FALSE_POSITIVE_RATE = 0.001
+
+
+def key_words(bits: int, n: int) -> int:
+    """
+    number of 64 bit words needed to hold a packed key of n elements with bits bits each
+    """
+    return max(1, (bits * n + 63) // 64)
+
+
+def key_dtype(bits: int, n: int) -> np.dtype:
+    """
+    numpy dtype of packed ngram keys
+    keys up to 64 bits are plain uint64, wider keys are structured with the most significant
+    word first, so that numpy sorts and compares them like the packed integers
+    """
+    words = key_words(bits, n)
+    if words == 1:
+        return np.dtype(np.uint64)
+    return np.dtype([(f"w{word}", np.uint64) for word in range(words - 1, -1, -1)])
+
+
+def _assemble(word_arrays, dtype):
+    if len(word_arrays) == 1:
+        return word_arrays[0]
+    keys = np.empty(len(word_arrays[0]), dtype=dtype)
+    for word, values in enumerate(word_arrays):
+        keys[f"w{word}"] = values
+    return keys
+
+
+def pack_windows(windows: np.ndarray, bits: int) -> np.ndarray:
+    """
+    packs a (count, n) array of element ids (oldest element in column 0) into keys,
+    the result equals ANgram's packed keys converted with int_keys_to_array
+    """
+    count, n = windows.shape
+    words = key_words(bits, n)
+    values = windows.astype(np.uint64)
+    word_arrays = [np.zeros(count, dtype=np.uint64) for _ in range(words)]
+    for position in range(n):
+        word, shift = divmod(bits * (n - 1 - position), 64)
+        column = values[:, position]
+        word_arrays[word] |= column << np.uint64(shift)
+        if shift + bits > 64:
+            # the element spans two words
+            word_arrays[word + 1] |= column >> np.uint64(64 - shift)
+    return _assemble(word_arrays, key_dtype(bits, n))
+
+
+def int_keys_to_array(keys, bits: int, n: int) -> np.ndarray:
+    """
+    converts packed integer keys (as returned by ANgram) to a numpy key array
+    """
+    keys = list(keys)
+    words = key_words(bits, n)
+    word_arrays = [np.fromiter(((key >> (64 * word)) & _WORD_MASK for key in keys), dtype=np.uint64, count=len(keys))
+                   for word in range(words)]
+    return _assemble(word_arrays, key_dtype(bits, n))
+
+
+def array_to_int_keys(keys: np.ndarray) -> list:
+    """
+    converts a numpy key array back to packed integer keys
+    """
+    if keys.dtype.names is None:
+        return [int(key) for key in keys.tolist()]
+    words = len(keys.dtype.names)
+    result = [0] * len(keys)
+    for word in range(words - 1, -1, -1):
+        values = keys[f"w{word}"].tolist()
+        result = [(key << 64) | value for key, value in zip(result, values)]
+    return result
+
+
+class SortedNgramTable:
+    """
+    ngram database as sorted array of packed keys with a count per key
+    membership and counts are looked up by binary search, for single keys and for whole key arrays
+    """
+
+    def __init__(self, keys: np.ndarray, counts: np.ndarray, bits: int, n: int):
+        """
+        keys have to be sorted and unique
+        """
+        self._keys = keys
+        self._counts = counts
+        self._bits = bits
+        self._n = n
+
+    @classmethod
+    def from_counts(cls, counts: dict, bits: int, n: int):
+        """
+        builds a table from a dict (or Histogram._counts) of packed integer keys and counts
+        """
+        keys = int_keys_to_array(counts.keys(), bits, n)
+        values = np.fromiter(counts.values(), dtype=np.uint64, count=len(keys))
+        order = np.argsort(keys, kind='stable')
+        return cls(keys[order], values[order], bits, n)
+
+    @classmethod
+    def from_keys(cls, keys, bits: int, n: int):
+        """
+        builds a table from a set of packed integer keys, each with count 1
+        """
+        keys = np.sort(int_keys_to_array(keys, bits, n), kind='stable')
+        # one shared count instead of an array of ones
+        return cls(keys, np.broadcast_to(np.uint64(1), len(keys)), bits, n)
+
+    @property
+    def bits(self):
+        return self._bits
+
+    @property
+    def n(self):
+        return self._n
+
+    def keys(self):
+        return self._keys
+
+    def counts(self):
+        return self._counts
+
+    def items(self):
+        """
+        iterates over (packed integer key, count) pairs
+        """
+        return zip(array_to_int_keys(self._keys), self._counts.tolist())
+
+    def lookup(self, keys: np.ndarray) -> np.ndarray:
+        """
+        returns the count of every key in the given key array, 0 for unknown keys
+        """
+        if len(self._keys) == 0 or len(keys) == 0:
+            return np.zeros(len(keys), dtype=np.uint64)
+        positions = np.searchsorted(self._keys, keys)
+        np.minimum(positions, len(self._keys) - 1, out=positions)
+        found = self._keys[positions] == keys
+        return np.where(found, self._counts[positions], np.uint64(0))
+
+    def contains(self, keys: np.ndarray) -> np.ndarray:
+        """
+        returns a bool array telling which of the given keys are in the table
+        """
+        return self.lookup(keys) > 0
+
+    @property
+    def nbytes(self):
+        """
+        bytes of the key and count arrays, a shared count (see from_keys) takes no space
+        """
+        return self._keys.nbytes + (0 if self._counts.strides == (0,) else self._counts.nbytes)
+
+    def get_count(self, key: int) -> int:
+        return int(self.lookup(int_keys_to_array([key], self._bits, self._n))[0])
+
+    def unique_elements(self):
+        return len(self._keys)
+
+    def __iter__(self):
+        return iter(array_to_int_keys(self._keys))
+
+    def __contains__(self, key: int):
+        return self.get_count(key) > 0
+
+    def __len__(self):
+        return len(self._keys)
+
+
+def _mix(values: np.ndarray) -> np.ndarray:
+    # splitmix64 finalizer, the uint64 arithmetic wraps around
+    values = values + np.uint64(0x9E3779B97F4A7C15)
+    values = (values ^ (values >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+
+def _hash_keys(keys: np.ndarray) -> np.ndarray:
+    # one 64 bit hash per key of a key array (see key_dtype)
+    if keys.dtype.names is None:
+        return _mix(keys.astype(np.uint64, copy=False))
+    hashes = np.zeros(len(keys), dtype=np.uint64)
+    for name in keys.dtype.names:
+        hashes = _mix(hashes ^ keys[name])
+    return hashes
+
+
+class BloomNgramFilter:
+    """
+    ngram database as bloom filter over packed keys, for membership only (no counts, no iteration)
+    the filter never misses a key of the model, an unknown key is reported as contained with the false positive rate
+    """
+
+    def __init__(self, filter_bits: np.ndarray, hash_count: int, size: int, bits: int, n: int):
+        self._filter = filter_bits
+        self._filter_size = np.uint64(len(filter_bits) * 8)
+        self._hash_count = hash_count
+        self._size = size
+        self._bits = bits
+        self._n = n
+
+    @classmethod
+    def from_keys(cls, keys: np.ndarray, bits: int, n: int, false_positive_rate=DEFAULT_FALSE_POSITIVE_RATE):
+        """
+        builds a filter for the given key array (see key_dtype) with the given false positive rate
+        """
+        if not 0 < false_positive_rate < 1:
+            raise ValueError("the false positive rate has to be between 0 and 1")
+        count = max(1, len(keys))
+        filter_size = max(64, math.ceil(-count * math.log(false_positive_rate) / math.log(2) ** 2))
+        hash_count = max(1, round(filter_size / count * math.log(2)))
+        bloom = cls(np.zeros((filter_size + 7) // 8, dtype=np.uint8), hash_count, len(keys), bits, n)
+        for positions in bloom._positions(keys):
+            np.bitwise_or.at(bloom._filter, positions >> np.uint64(3), np.left_shift(1, positions & np.uint64(7)).astype(np.uint8))
+        return bloom
+
+    def _positions(self, keys: np.ndarray):
+        # double hashing: the i-th position is h1 + i * h2
+        hashes = _hash_keys(keys)
+        first = _mix(hashes ^ np.uint64(0x5851F42D4C957F2D))
+        step = _mix(hashes ^ np.uint64(0x14057B7EF767814F)) | np.uint64(1)
+        for index in range(self._hash_count):
+            yield (first + np.uint64(index) * step) % self._filter_size
+
+    @property
+    def bits(self):
+        return self._bits
+
+    @property
+    def n(self):
+        return self._n
+
+    @property
+    def nbytes(self):
+        return self._filter.nbytes
+
+    def contains(self, keys: np.ndarray) -> np.ndarray:
+        """
+        returns a bool array telling which of the given keys are (probably) in the filter
+        """
+        found = np.ones(len(keys), dtype=bool)
+        if len(keys) == 0:
+            return found
+        for positions in self._positions(keys):
+            found &= ((self._filter[positions >> np.uint64(3)] >> (positions & np.uint64(7)).astype(np.uint8)) & 1).astype(bool)
+        return found
+
+    def __contains__(self, key: int):
+        return bool(self.contains(int_keys_to_array([key], self._bits, self._n))[0])
+
+    def __len__(self):
+        return self._size
@@ -0,0 +1,123 @@
+import multiprocessing
+import subprocess
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from syscall import SYSDIG_OUTPUT_FORMAT, read_sysdig_batches
+from vocabulary import Vocabulary
+
+# time span of one recording of the agent (sysdig -G 10)
+DEFAULT_FILE_SPAN_NS = 10 * 1000 * 1000 * 1000
+# decoded batches a worker can hand over ahead of the decoder, a full queue blocks the worker (and its sysdig)
+RANGE_QUEUE_SIZE = 4
+
+
+def first_timestamp(file_path):
+    """
+    returns the timestamp (in ns) of the first event of the given scap file or None for an empty file
+    """
+    output = subprocess.run(["sysdig", "-r", file_path, "-n", "1", "-p", "%evt.rawtime"],
+                            stdout=subprocess.PIPE, check=False).stdout.split()
+    return int(output[0]) if output else None
+
+
+def time_ranges(start_ns, span_ns, count):
+    """
+    splits [start_ns, start_ns + span_ns) into count ranges of equal length
+    the first range is open to the left and the last one to the right (None),
+    so events outside of the expected span are not lost
+    """
+    bounds = [start_ns + span_ns * index // count for index in range(1, count)]
+    return list(zip([None] + bounds, bounds + [None]))
+
+
+def _range_filter(begin, end):
+    conditions = []
+    if begin is not None:
+        conditions.append(f"evt.rawtime>={begin}")
+    if end is not None:
+        conditions.append(f"evt.rawtime<{end}")
+    return " and ".join(conditions)
+
+
+def decode_range(file_path, begin, end, with_args, output):
+    """
+    runs in a worker process: decodes the events of the given time range of a scap file into the output queue,
+    batch by batch as (strings added to the local vocabulary since the previous batch, batch), then None.
+    the batches are rebased by the caller
+    """
+    names = Vocabulary()
+    known = len(names)
+    command = ["sysdig", "-r", file_path, "-p", SYSDIG_OUTPUT_FORMAT]
+    range_filter = _range_filter(begin, end)
+    if range_filter:
+        command.append(range_filter)
+    try:
+        with subprocess.Popen(command, stdout=subprocess.PIPE) as proc:
+            for batch in read_sysdig_batches(proc.stdout, names, with_args=with_args):
+                # the batches are pickled without their vocabulary, only the new names are sent along
+                batch.names = None
+                output.put((names.strings()[known:], batch))
+                known = len(names)
+    finally:
+        output.put(None)
+
+
+class ParallelDecoder:
+    """
+    decodes one scap file with several sysdig processes at once
+    the recording is split into consecutive time ranges, each range is decoded by its own sysdig process
+    in a process pool and the batches are yielded range by range, i.e. in timestamp order,
+    so the ngram state per thread is the same as with a single sysdig process.
+    at most workers ranges of a file are decoded at once and each hands over its batches through a bounded queue,
+    so a slow scorer blocks the sysdig processes like with a single one (memory does not grow with the file size)
+    """
+
+    def __init__(self, workers, file_span_ns=DEFAULT_FILE_SPAN_NS):
+        self.workers = workers
+        self._file_span_ns = file_span_ns
+        self._pool = ProcessPoolExecutor(max_workers=workers)
+        # the queues of the ranges have to be passed to the pool processes, so they are managed queues
+        self._manager = multiprocessing.Manager()
+
+    def batches(self, file_path, names: Vocabulary, with_args=True):
+        """
+        yields the SyscallBatches of the given scap file, with name ids of the given vocabulary
+        """
+        start = first_timestamp(file_path)
+        if start is None:
+            return
+        ranges = iter(time_ranges(start, self._file_span_ns, self.workers))
+        # (future, output queue) of the ranges submitted and not yet read, oldest first
+        in_flight = deque()
+        try:
+            while True:
+                while len(in_flight) < self.workers:
+                    bounds = next(ranges, None)
+                    if bounds is None:
+                        break
+                    output = self._manager.Queue(maxsize=RANGE_QUEUE_SIZE)
+                    in_flight.append((self._pool.submit(decode_range, file_path, *bounds, with_args, output), output))
+                if not in_flight:
+                    return
+                future, output = in_flight[0]
+                local_names = Vocabulary()
+                for strings, batch in iter(output.get, None):
+                    for string in strings:
+                        local_names.add(string)
+                    batch.names = local_names
+                    batch.rebase_names(names)
+                    yield batch
+                in_flight.popleft()
+                # raises the error of the worker
+                future.result()
+        finally:
+            # stopped early (e.g. an error of the scorer or a worker): the running workers would block on their full queues
+            for future, output in in_flight:
+                if not future.cancel():
+                    for _ in iter(output.get, None):
+                        pass
+
+    def shutdown(self):
+        self._pool.shutdown()
+        self._manager.shutdown()
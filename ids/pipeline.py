@@ -0,0 +1,123 @@
+import threading
+import traceback
+from collections import deque
+from queue import Queue
+
+# put on the input queue of a PipelineStage to end it
+STOP = object()
+
+class PipelineStage(threading.Thread):
+    """
+    worker thread of a staged pipeline: takes the items of its input queue one by one and hands them to a handler.
+    the handler passes its results on by putting them on the (bounded) input queue of the next stage,
+    so a full queue blocks the stage before it (backpressure) instead of letting memory grow
+    """
+
+    def __init__(self, name, input_queue, handler):
+        super().__init__(name=name, daemon=True)
+        self.input_queue = input_queue
+        self._handler = handler
+
+    def run(self):
+        while True:
+            item = self.input_queue.get()
+            if item is STOP:
+                break
+            try:
+                self._handler(item)
+            except Exception:
+                # one broken item must not end the whole pipeline
+                print(f"[{self.name}] error while processing {item}:", flush=True)
+                traceback.print_exc()
+
+    def stop(self):
+        self.input_queue.put(STOP)
+        self.join()
+
+
+class SerialQueue:
+    """
+    bounded input queue of a WorkerPool: its items are handed to the handler in order and never to two workers at once.
+    put blocks while the queue is full, like the bounded queue in front of a PipelineStage
+    """
+
+    def __init__(self, pool, name, handler, maxsize):
+        self.name = name
+        self._pool = pool
+        self._handler = handler
+        self._maxsize = maxsize
+        self._items = deque()
+        self._condition = threading.Condition()
+        # True while the queue waits in the ready queue of the pool or one of its items is handled
+        self._scheduled = False
+
+    def put(self, item):
+        with self._condition:
+            while len(self._items) >= self._maxsize:
+                self._condition.wait()
+            self._items.append(item)
+            if not self._scheduled:
+                self._scheduled = True
+                self._pool._ready.put(self)
+
+    def qsize(self):
+        with self._condition:
+            return len(self._items)
+
+    def _handle_next(self):
+        # called by a worker of the pool: handles one item, so the queues of the pool take turns
+        with self._condition:
+            item = self._items.popleft()
+            self._condition.notify_all()
+        try:
+            self._handler(item)
+        except Exception:
+            print(f"[{self.name}] error while processing {item}:", flush=True)
+            traceback.print_exc()
+        with self._condition:
+            if self._items:
+                self._pool._ready.put(self)
+            else:
+                self._scheduled = False
+                self._condition.notify_all()
+
+    def join(self):
+        """
+        waits until all items put so far are handled
+        """
+        with self._condition:
+            while self._items or self._scheduled:
+                self._condition.wait()
+
+
+class WorkerPool:
+    """
+    a fixed number of worker threads shared by several SerialQueues (e.g. the scorers of all streams),
+    so the work of many streams is spread over the workers without a thread per stream
+    """
+
+    def __init__(self, name, workers):
+        self.name = name
+        self._ready = Queue()
+        self._workers = [threading.Thread(target=self._run, name=f"{name}-{number}", daemon=True) for number in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def serial_queue(self, name, handler, maxsize):
+        return SerialQueue(self, name, handler, maxsize)
+
+    def _run(self):
+        while True:
+            serial_queue = self._ready.get()
+            if serial_queue is STOP:
+                break
+            serial_queue._handle_next()
+
+    def stop(self):
+        """
+        ends the workers, the queues have to be joined before
+        """
+        for _ in self._workers:
+            self._ready.put(STOP)
+        for worker in self._workers:
+            worker.join()
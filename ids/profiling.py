@@ -0,0 +1,293 @@
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+from contextlib import nullcontext
+
+# on demand profiling of the decoder and scorer threads, controlled over REST (see /ids/profile in ids.py).
+# a profiling session runs for the next N scored files and/or S seconds, two kinds:
+#   sampling      : a background thread samples the stacks of the decoder and scorer threads every interval seconds,
+#                   low overhead, writes <prefix>.collapsed (one "frame;frame;... count" line per stack, for flamegraph.pl
+#                   or speedscope)
+#   deterministic : additionally every decoded file and scored batch runs under cProfile (slower), writes <prefix>.pstats
+#                   (python3 -m pstats <prefix>.pstats) next to the collapsed stacks. since python 3.12 only one
+#                   profiler can be enabled per process, then one call at a time runs under cProfile and the calls
+#                   of the other threads meanwhile are only sampled
+# with spans the time of the stages (parse, ngram, score, testcases) is summed up and written to <prefix>.spans.txt
+# without session the hooks cost one attribute check per file or batch
+
+SAMPLING = "sampling"
+DETERMINISTIC = "deterministic"
+KINDS = [SAMPLING, DETERMINISTIC]
+# the threads of the pipeline (see ids_file_observer.py and pipeline.py)
+PROFILED_THREADS = ("Decoder", "Scorer")
+_NO_SPAN = nullcontext()
+# before python 3.12 every thread can enable its own cProfile.Profile
+_PROFILE_PER_THREAD = sys.version_info < (3, 12)
+_END = object()
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+def _stack(frame):
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    names.reverse()
+    return names
+
+
+class _Span:
+    def __init__(self, session, name):
+        self._session = session
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self._session.add_span(self._name, time.perf_counter() - self._start)
+
+
+class ProfileSession:
+    def __init__(self, kind, files=None, seconds=None, spans=False, interval=0.005, prefix="profile"):
+        if kind not in KINDS:
+            raise ValueError(f"kind has to be one of {KINDS}")
+        if files is None and seconds is None:
+            raise ValueError("files or seconds are needed")
+        self.kind = kind
+        self.files = files
+        self.seconds = seconds
+        self.spans = spans
+        self.interval = interval
+        self.prefix = prefix
+        self.started = time.time()
+        self.files_done = 0
+        self._lock = threading.Condition()
+        self._closed = False
+        # number of profiled calls in progress, the results are written once they have returned
+        self._active = 0
+        # thread id (one key for the whole process since python 3.12) -> cProfile.Profile
+        self._profiles = {}
+        # keys of the profiles enabled right now, and of the ones enabled at least once (the others have no stats)
+        self._enabled = set()
+        self._profiled = set()
+        # stack -> samples
+        self._stacks = {}
+        self._samples = 0
+        # span -> [count, seconds, max seconds]
+        self._spans = {}
+        self._sampler = threading.Thread(target=self._sample, name="ProfileSampler", daemon=True)
+
+    def start(self):
+        self._sampler.start()
+
+    # sampling
+    def _sample(self):
+        own = threading.get_ident()
+        while not self._closed:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            stacks = []
+            for ident, frame in sys._current_frames().items():
+                name = names.get(ident, "")
+                if ident != own and name.startswith(PROFILED_THREADS):
+                    # threads of the same kind (e.g. the scorer workers of a pool) are summed up
+                    stacks.append(";".join([name.rstrip("0123456789-")] + _stack(frame)))
+            with self._lock:
+                for stack in stacks:
+                    self._stacks[stack] = self._stacks.get(stack, 0) + 1
+                self._samples += 1
+            time.sleep(self.interval)
+
+    # deterministic
+    def call(self, function, *args):
+        key = threading.get_ident() if _PROFILE_PER_THREAD else None
+        with self._lock:
+            if self._closed or key in self._enabled:
+                profile = None
+            else:
+                profile = self._profiles.get(key)
+                if profile is None:
+                    profile = self._profiles[key] = cProfile.Profile()
+                self._enabled.add(key)
+                self._active += 1
+        if profile is None:
+            return function(*args)
+        enabled = False
+        try:
+            try:
+                profile.enable()
+                enabled = True
+            except ValueError as e:
+                # another profiling tool is active (e.g. a debugger), the call is only sampled
+                print(f"[Profiler] call not profiled: {e}", flush=True)
+            return function(*args)
+        finally:
+            if enabled:
+                profile.disable()
+            with self._lock:
+                if enabled:
+                    self._profiled.add(key)
+                self._enabled.discard(key)
+                self._active -= 1
+                self._lock.notify_all()
+
+    def span(self, name):
+        return _Span(self, name)
+
+    def add_span(self, name, seconds):
+        with self._lock:
+            span = self._spans.get(name)
+            if span is None:
+                self._spans[name] = [1, seconds, seconds]
+            else:
+                span[0] += 1
+                span[1] += seconds
+                span[2] = max(span[2], seconds)
+
+    def file_done(self):
+        """
+        returns True if the session has profiled all of its files
+        """
+        with self._lock:
+            self.files_done += 1
+            return self.files is not None and self.files_done >= self.files
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            # a profile can only be read after its call has returned
+            while self._active:
+                self._lock.wait()
+        if self._sampler.is_alive():
+            self._sampler.join()
+
+    def write(self):
+        """
+        writes the results, returns the names of the written files
+        """
+        written = []
+        collapsed = self.prefix + ".collapsed"
+        with open(collapsed, 'w') as collapsed_file:
+            collapsed_file.writelines(f"{stack} {count}\n" for stack, count in sorted(self._stacks.items()))
+        written.append(collapsed)
+        profiles = [profile for key, profile in self._profiles.items() if key in self._profiled]
+        if self.kind == DETERMINISTIC and profiles:
+            stats = pstats.Stats(profiles[0])
+            for profile in profiles[1:]:
+                stats.add(profile)
+            stats.dump_stats(self.prefix + ".pstats")
+            written.append(self.prefix + ".pstats")
+        if self.spans:
+            with open(self.prefix + ".spans.txt", 'w') as spans_file:
+                spans_file.write("span count seconds avg_ms max_ms\n")
+                for name, (count, seconds, max_seconds) in self._spans.items():
+                    spans_file.write(f"{name} {count} {seconds:.6f} {1000 * seconds / count:.3f} {1000 * max_seconds:.3f}\n")
+            written.append(self.prefix + ".spans.txt")
+        return written
+
+    def status(self):
+        return {"kind": self.kind, "files": self.files, "seconds": self.seconds, "spans": self.spans,
+                "files-done": self.files_done, "running-seconds": round(time.time() - self.started, 3),
+                "samples": self._samples, "prefix": self.prefix}
+
+
+class Profiler:
+    """
+    runs at most one ProfileSession at a time, the hooks (call, span, file_done) are used by the pipeline
+    """
+
+    def __init__(self, output_folder="profiles"):
+        self.output_folder = output_folder
+        self._lock = threading.Lock()
+        self._session = None
+        self._timer = None
+        # files written by the last session
+        self.last_result = []
+
+    def start(self, kind, files=None, seconds=None, spans=False, interval=0.005):
+        """
+        starts a session, returns it or None if a session is already running
+        """
+        with self._lock:
+            if self._session is not None:
+                return None
+            os.makedirs(self.output_folder, exist_ok=True)
+            prefix = os.path.join(self.output_folder, f"profile-{time.strftime('%Y%m%d-%H%M%S')}-{kind}")
+            session = ProfileSession(kind, files, seconds, spans, interval, prefix)
+            session.start()
+            self._session = session
+            if seconds is not None:
+                self._timer = threading.Timer(seconds, self.stop, args=(session,))
+                self._timer.daemon = True
+                self._timer.start()
+        print(f"[Profiler] {kind} profiling started (files: {files}, seconds: {seconds}, spans: {spans})", flush=True)
+        return session
+
+    def stop(self, session=None):
+        """
+        ends the running session (only if it is the given one) and writes its results in the background,
+        returns the ended session or None
+        """
+        with self._lock:
+            if self._session is None or (session is not None and self._session is not session):
+                return None
+            session = self._session
+            self._session = None
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        # the session can be ended from within a profiled call (file_done), so it is closed by another thread
+        threading.Thread(target=self._write, args=(session,), name="ProfileWriter", daemon=True).start()
+        return session
+
+    def _write(self, session):
+        session.close()
+        try:
+            self.last_result = session.write()
+            print(f"[Profiler] profile written: {self.last_result}", flush=True)
+        except OSError as e:
+            print(f"[Profiler] could not write the profile {session.prefix}: {e}", flush=True)
+
+    def status(self):
+        session = self._session
+        return {"running": session.status() if session is not None else None, "last-result": self.last_result}
+
+    # hooks of the pipeline
+    def call(self, function, *args):
+        session = self._session
+        if session is None or session.kind != DETERMINISTIC:
+            return function(*args)
+        return session.call(function, *args)
+
+    def span(self, name):
+        session = self._session
+        if session is None or not session.spans:
+            return _NO_SPAN
+        return session.span(name)
+
+    def timed(self, name, iterable):
+        """
+        yields the items of the iterable, the time to produce each item is a span (e.g. parsing a batch)
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.span(name):
+                item = next(iterator, _END)
+            if item is _END:
+                return
+            yield item
+
+    def file_done(self):
+        session = self._session
+        if session is not None and session.file_done():
+            self.stop(session)
+
+
+profiler = Profiler()
@@ -0,0 +1,110 @@
+import io
+import sys
+import time
+
+import numpy as np
+
+import ids_helper
+from syscall import read_sysdig_batches
+from vocabulary import Vocabulary
+from astide import ASTIDE
+from fstide import FSTIDE
+from testcases import TestcaseManager
+from synthetic_trace import SyntheticTrace
+
+# replays recorded or synthetic sysdig output (see syscall.SYSDIG_OUTPUT_FORMAT) through the detection path
+# of the ids without agent, flask, file observer and sysdig, and measures the time of each stage:
+#   parse       : sysdig output -> SyscallBatch
+#   ngram       : SyscallBatch  -> ngram windows (feature mapping and per thread ngrams)
+#   score       : ngram windows -> anomaly scores
+#   attribution : anomaly scores -> testcases
+
+STAGES = ["parse", "ngram", "score", "attribution"]
+
+
+def create_detector(algorithm, model_file, features="name", mode="detection"):
+    if algorithm.lower() == "astide":
+        return ASTIDE(mode=mode, model_file=model_file)
+    if algorithm.lower() == "fstide":
+        return FSTIDE(mode=mode, model_file=model_file, syscall_mapper=features)
+    raise ValueError(f"unknown algorithm {algorithm}")
+
+
+def add_testcases(testcase_manager, start_ns, end_ns, duration_ns):
+    """
+    adds consecutive testcases of the given duration covering [start_ns, end_ns]
+    """
+    for number, start in enumerate(range(start_ns, end_ns + 1, duration_ns)):
+        testcase_manager._add_testcase(f"replay-{number}", start, start + duration_ns - 1)
+
+
+def replay(stream, detector, testcase_manager=None, chunk_size=1 << 20):
+    """
+    feeds the sysdig output of the given binary stream into the detector (and the testcases)
+    returns the number of syscalls, the number of scores and the seconds spent per stage
+    """
+    names = Vocabulary()
+    timings = dict.fromkeys(STAGES, 0.0)
+    syscalls = 0
+    scored = 0
+    batches = read_sysdig_batches(stream, names, with_args=detector.needs_syscall_params, chunk_size=chunk_size)
+    while True:
+        start = time.perf_counter()
+        batch = next(batches, None)
+        timings["parse"] += time.perf_counter() - start
+        if batch is None:
+            break
+        syscalls += len(batch)
+
+        start = time.perf_counter()
+        windows = detector.ngram_windows(batch)
+        timings["ngram"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        scores = detector.score_windows(windows)
+        timings["score"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        has_score = np.flatnonzero(~np.isnan(scores))
+        scored += len(has_score)
+        if testcase_manager is not None:
+            timestamps = np.frombuffer(batch.timestamps, dtype=np.int64)
+            testcase_manager.attribute_scores(timestamps[has_score], scores[has_score])
+        timings["attribution"] += time.perf_counter() - start
+    return syscalls, scored, timings
+
+
+def replay_text(text: bytes, detector, testcase_duration_ns=100 * 1000 * 1000, chunk_size=1 << 20):
+    """
+    replays the given sysdig output with testcases of the given duration over the whole trace
+    """
+    first_line_end = text.find(b"\n")
+    last_line_start = text.rstrip(b"\n").rfind(b"\n") + 1
+    testcase_manager = TestcaseManager()
+    if first_line_end > 0:
+        add_testcases(testcase_manager, int(text[:first_line_end].split(b" ", 1)[0]),
+                      int(text[last_line_start:].split(b" ", 1)[0]), testcase_duration_ns)
+    return replay(io.BytesIO(text), detector, testcase_manager, chunk_size)
+
+
+def format_result(syscalls, scored, timings):
+    total = sum(timings.values())
+    stages = ", ".join(f"{stage} {seconds:.3f}s ({100 * seconds / total if total else 0:.0f}%)" for stage, seconds in timings.items())
+    return f"{syscalls} syscalls ({scored} scores) in {total:.3f}s, {syscalls / total if total else 0:.0f} syscalls/s | {stages}"
+
+
+if __name__ == "__main__":
+    # python3 replay.py algorithm model_file features [sysdig_output.txt] [--syscalls=N] [--chunk-size=BYTES]
+    #   without sysdig output file a synthetic trace with N syscalls (default 200000) is generated from the model
+    arguments, options = ids_helper.split_options(sys.argv)
+    if len(arguments) not in (4, 5):
+        print("needed arguments: algorithm model_file features [sysdig_output.txt] [--syscalls=N] [--chunk-size=BYTES]")
+        exit()
+    algorithm, model_file, features = arguments[1:4]
+    if len(arguments) == 5:
+        with open(arguments[4], 'rb') as trace_file:
+            text = trace_file.read()
+    else:
+        text = SyntheticTrace(model_file).text(int(options.get("syscalls", 200_000))).encode()
+    detector = create_detector(algorithm, model_file, features)
+    print(f"[Replay] {format_result(*replay_text(text, detector, chunk_size=int(options.get('chunk-size', 1 << 20))))}")
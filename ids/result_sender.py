@@ -0,0 +1,79 @@
+import threading
+import time
+from queue import Queue
+
+import requests
+
+# sends the generation results to fuzzino in the background: evaluate_generation only queues them,
+# so a slow or unreachable fuzzino does not hold up the next generation.
+# the results are sent in order over one persistent session, a failed request is retried with exponential backoff
+# if fuzzino was not reached, timed out or answered with a server error (5xx), other errors (e.g. 4xx) are final
+
+STOP = object()
+
+
+class ResultSender:
+    def __init__(self, endpoint, max_attempts=10, timeout=30.0, max_delay=30.0):
+        self._endpoint = endpoint
+        self._max_attempts = max_attempts
+        # seconds per request, a hanging fuzzino counts as a failed attempt
+        self._timeout = timeout
+        self._max_delay = max_delay
+        self._session = requests.Session()
+        self._queue = Queue()
+        self._thread = threading.Thread(target=self._run, name="ResultSender", daemon=True)
+        self._thread.start()
+
+    def send(self, result_data):
+        """
+        queues the results of a generation, returns right away
+        """
+        self._queue.put(result_data)
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _run(self):
+        while True:
+            result_data = self._queue.get()
+            if result_data is STOP:
+                break
+            self._deliver(result_data)
+        # closed here, stop() can return while a result is still sent
+        self._session.close()
+
+    @staticmethod
+    def _retry(error):
+        if isinstance(error, requests.exceptions.HTTPError):
+            return error.response is not None and error.response.status_code >= 500
+        return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+    def _deliver(self, result_data):
+        delay = 1
+        for attempt in range(1, self._max_attempts + 1):
+            try:
+                response = self._session.post(self._endpoint, json=result_data, timeout=self._timeout)
+                response.raise_for_status()
+                print(f"[ResultSender] generation {result_data.get('generation')} sent, fuzzino response code: {response.status_code}", flush=True)
+                print(f"[ResultSender] fuzzino response text: {response.text}", flush=True)
+                return True
+            except requests.exceptions.RequestException as e:
+                if not self._retry(e):
+                    print(f"[ResultSender] error: {e}, giving up the results of generation {result_data.get('generation')}", flush=True)
+                    return False
+                if attempt == self._max_attempts:
+                    print(f"[ResultSender] error: {e}, giving up the results of generation {result_data.get('generation')} "
+                          f"after {attempt} attempts", flush=True)
+                    return False
+                print(f"[ResultSender] error: {e}, retrying in {delay}s", flush=True)
+                time.sleep(delay)
+                delay = min(delay * 2, self._max_delay)
+
+    def stop(self, timeout=None):
+        """
+        sends the queued results (waits at most timeout seconds) and ends the sender
+        """
+        self._queue.put(STOP)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            print(f"[ResultSender] still sending after {timeout}s, the session is closed by the sender when it is done", flush=True)
@@ -1,22 +1,189 @@
+import math
+
+import numpy as np
+
+class QuantileSketch:
+    """
+    mergeable quantile sketch with relative accuracy (like DDSketch):
+    values are counted in logarithmic buckets, so every quantile is returned with a relative error
+    of at most relative_accuracy, using memory in the order of the logarithm of the value range
+    """
+
+    def __init__(self, relative_accuracy=0.01, min_value=1e-9):
+        self._relative_accuracy = relative_accuracy
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+        # values with a magnitude below min_value are counted as 0
+        self._min_value = min_value
+        self._positive = {}
+        self._negative = {}
+        self._zero_count = 0
+        self.count = 0
+
+    def _bucket(self, magnitude):
+        return math.ceil(math.log(magnitude) / self._log_gamma)
+
+    def _bucket_value(self, bucket):
+        return 2 * self._gamma ** bucket / (self._gamma + 1)
+
+    def add_value(self, value):
+        if value > self._min_value:
+            bucket = self._bucket(value)
+            self._positive[bucket] = self._positive.get(bucket, 0) + 1
+        elif value < -self._min_value:
+            bucket = self._bucket(-value)
+            self._negative[bucket] = self._negative.get(bucket, 0) + 1
+        else:
+            self._zero_count += 1
+        self.count += 1
+
+    def add_values(self, values: np.ndarray):
+        values = np.asarray(values, dtype=np.float64)
+        for sign, store in ((1, self._positive), (-1, self._negative)):
+            magnitudes = values[sign * values > self._min_value] * sign
+            if len(magnitudes) == 0:
+                continue
+            buckets, counts = np.unique(np.ceil(np.log(magnitudes) / self._log_gamma).astype(np.int64), return_counts=True)
+            for bucket, count in zip(buckets.tolist(), counts.tolist()):
+                store[bucket] = store.get(bucket, 0) + count
+        self._zero_count += int(np.count_nonzero(np.abs(values) <= self._min_value))
+        self.count += len(values)
+
+    def merge(self, other):
+        """
+        adds the values of another sketch (with the same relative accuracy) to this one
+        """
+        if other._gamma != self._gamma:
+            raise ValueError("only sketches with the same relative accuracy can be merged")
+        for store, other_store in ((self._positive, other._positive), (self._negative, other._negative)):
+            for bucket, count in other_store.items():
+                store[bucket] = store.get(bucket, 0) + count
+        self._zero_count += other._zero_count
+        self.count += other.count
+
+    def get_quantile(self, quantile):
+        """
+        returns the value at the given quantile (0 <= quantile <= 1), None if no value has been added
+        """
+        if self.count == 0:
+            return None
+        rank = quantile * (self.count - 1)
+        seen = 0
+        for bucket in sorted(self._negative, reverse=True):
+            seen += self._negative[bucket]
+            if seen > rank:
+                return -self._bucket_value(bucket)
+        seen += self._zero_count
+        if seen > rank:
+            return 0
+        for bucket in sorted(self._positive):
+            seen += self._positive[bucket]
+            if seen > rank:
+                return self._bucket_value(bucket)
+        return self._bucket_value(max(self._positive))
+
 
 class Stats:
+    """
+    streaming statistics of a sequence of values in constant memory:
+    count, mean and variance (Welford), min, max and quantiles (QuantileSketch)
+    """
+
     def __init__(self):
-        self.values = []
+        self.count = 0
+        self._mean = 0.0
+        self._m2 = 0.0
+        self._min = None
+        self._max = None
+        self._sketch = QuantileSketch()
     
     def add_value(self, value):
-        self.values.append(value)
+        self.count += 1
+        delta = value - self._mean
+        self._mean += delta / self.count
+        self._m2 += delta * (value - self._mean)
+        if self._min is None or value < self._min:
+            self._min = value
+        if self._max is None or value > self._max:
+            self._max = value
+        self._sketch.add_value(value)
+
+    def add_values(self, values: np.ndarray):
+        """
+        adds all values of the given array at once
+        """
+        values = np.asarray(values, dtype=np.float64)
+        if len(values) == 0:
+            return
+        self._combine(len(values), float(values.mean()), float(((values - values.mean()) ** 2).sum()),
+                      float(values.min()), float(values.max()))
+        self._sketch.add_values(values)
+
+    def merge(self, other):
+        """
+        adds the values of another Stats to this one
+        """
+        if other.count == 0:
+            return
+        self._combine(other.count, other._mean, other._m2, other._min, other._max)
+        self._sketch.merge(other._sketch)
+
+    def _combine(self, count, mean, m2, minimum, maximum):
+        # parallel variant of Welford's algorithm (Chan et al.)
+        total = self.count + count
+        delta = mean - self._mean
+        self._mean += delta * count / total
+        self._m2 += m2 + delta * delta * self.count * count / total
+        self.count = total
+        self._min = minimum if self._min is None else min(self._min, minimum)
+        self._max = maximum if self._max is None else max(self._max, maximum)
 
     def get_max(self):
-        if len(self.values) == 0:
+        if self.count == 0:
             return 0
-        return max(value for value in self.values)
+        return self._max
 
     def get_min(self):
-        if len(self.values) == 0:
+        if self.count == 0:
             return 0
-        return min(value for value in self.values)
+        return self._min
 
     def get_average(self):
-        if len(self.values) == 0:
+        if self.count == 0:
             return 0
-        return sum(value for value in self.values) / len(self.values)
+        return self._mean
+
+    def get_variance(self):
+        if self.count == 0:
+            return 0
+        return self._m2 / self.count
+
+    def get_quantile(self, quantile):
+        """
+        returns the approximated value at the given quantile (e.g. 0.95), 0 if no value has been added
+        """
+        if self.count == 0:
+            return 0
+        # the sketch is exact up to its relative accuracy, keep the result within the seen values
+        return min(max(self._sketch.get_quantile(quantile), self._min), self._max)
+
+
+def window_means(values: np.ndarray, window, w: int) -> np.ndarray:
+    """
+    sliding window mean over the given values, continued from the values in window
+    (a deque with maxlen w holding the last values of the previous calls), which is updated in place.
+    returns one mean per value, NaN as long as fewer than w values have been seen.
+    the window sums come from a cumulative sum which is restarted on every call, so rounding
+    errors of float values do not add up across calls
+    """
+    previous = np.array(window, dtype=values.dtype)
+    extended = np.concatenate((previous, values))
+    cumulative = np.concatenate((np.zeros(1, dtype=values.dtype), np.cumsum(extended)))
+    # index (in extended) of the last value of each window
+    ends = np.arange(len(previous), len(extended))
+    means = np.full(len(values), np.nan)
+    full = ends + 1 >= w
+    ends = ends[full]
+    means[full] = (cumulative[ends + 1] - cumulative[ends + 1 - w]) / w
+    window.extend(values[-w:].tolist())
+    return means
@@ -0,0 +1,46 @@
+import socketserver
+import threading
+
+# an agent with a stream id starts its connection with this header line: b"#stream-id <id>\n"
+STREAM_ID_HEADER = b"#stream-id "
+
+
+def read_stream_id(stream):
+    """
+    reads the stream id header from the given buffered binary stream, returns None if the stream has no header
+    """
+    if not stream.peek(len(STREAM_ID_HEADER)).startswith(STREAM_ID_HEADER):
+        return None
+    return stream.readline()[len(STREAM_ID_HEADER):].strip().decode('utf-8', errors='replace')
+
+
+class _StreamRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        source = f"stream:{self.client_address[0]}:{self.client_address[1]}"
+        self.server.consumer(source, read_stream_id(self.rfile), self.rfile)
+
+
+class SyscallStreamServer(socketserver.ThreadingTCPServer):
+    """
+    tcp server for the streaming mode of the agent: every connection carries live sysdig output
+    (see syscall.SYSDIG_OUTPUT_FORMAT), which is handed to consumer(source, stream_id, stream) in its own thread
+    (stream_id is None for agents without stream id)
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host, port, consumer):
+        super().__init__((host, int(port)), _StreamRequestHandler)
+        self.consumer = consumer
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name="StreamServer", daemon=True)
+        self._thread.start()
+        print(f"[StreamServer] listening for syscall streams on {self.server_address[0]}:{self.server_address[1]}", flush=True)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
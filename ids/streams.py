@@ -0,0 +1,254 @@
+import re
+import threading
+import time
+
+from testcases import ChangeSignal, GenerationTestcases
+
+# one ids process can serve several agents (or containers): every agent sends its uploads (and live streams)
+# with a stream id, each stream gets its own ParserFileHandler (decoder, detector state) and testcases.
+# uploads without stream id belong to DEFAULT_STREAM.
+# the testcases of fuzzino apply to all streams: they are recorded in StreamRegistry.testcases and
+# started/stopped in every stream, streams created later get a copy of the testcases so far.
+# several generations can be in flight: fuzzino can start the next generation while the syscalls of the previous
+# ones are still scored. every generation has its own TestcaseManager per stream (see GenerationTestcases),
+# the syscalls belong to the generation started last before them. a generation is removed once its results are sent
+DEFAULT_STREAM = "default"
+# testcases started while no generation is running belong to an implicit generation (as before there were
+# generations in flight), the next started generation takes it over with its testcases and its start
+IMPLICIT_GENERATION = "<implicit>"
+_STREAM_ID = re.compile(r"[A-Za-z0-9_.-]{1,64}")
+
+
+def valid_stream_id(stream_id) -> bool:
+    return stream_id is not None and _STREAM_ID.fullmatch(stream_id) is not None
+
+
+class Stream:
+    def __init__(self, stream_id, testcases, handler):
+        self.stream_id = stream_id
+        self.testcases = testcases
+        self.handler = handler
+
+    def __repr__(self) -> str:
+        return f"[Stream: {self.stream_id}]"
+
+
+class Generation:
+    def __init__(self, name, start):
+        self.name = name
+        self.start = start
+        # None while the generation is running
+        self.end = None
+
+    def __repr__(self) -> str:
+        return f"[Generation: {self.name}]"
+
+
+class StreamRegistry:
+    """
+    creates the streams on their first use, create_handler(stream_id, testcases) returns the ParserFileHandler
+    of a new stream. max_streams limits the number of streams (e.g. to one in training mode), None for no limit.
+    max_generations limits the number of generations in flight (started and not yet removed), None for no limit
+    """
+
+    def __init__(self, create_handler, max_streams=None, max_generations=None):
+        self._create_handler = create_handler
+        self.max_streams = max_streams
+        self.max_generations = max_generations
+        self._lock = threading.Lock()
+        self._streams = {}
+        # generation name -> Generation, in the order they were started
+        self._generations = {}
+        # set whenever a testcase of a stream gets its first score or is finished, see wait_until_complete
+        self._changed = ChangeSignal()
+        # all testcases of the generations in flight, they don't get scores
+        self.testcases = GenerationTestcases(on_change=self._testcases_changed)
+
+    def get(self, stream_id):
+        """
+        returns the stream of the given id, creates it if needed, None if no more streams are allowed
+        """
+        with self._lock:
+            stream = self._streams.get(stream_id)
+            if stream is not None:
+                return stream
+            if self.max_streams is not None and len(self._streams) >= self.max_streams:
+                return None
+        # the handler loads the model and starts its threads, the testcase endpoints must not wait for that
+        testcases = GenerationTestcases(on_change=self._testcases_changed)
+        handler = self._create_handler(stream_id, testcases)
+        with self._lock:
+            stream = self._streams.get(stream_id)
+            if stream is None and (self.max_streams is None or len(self._streams) < self.max_streams):
+                # the testcases started meanwhile are copied here, under the same lock as the testcase endpoints
+                for name, start, testcase_manager in self.testcases.generations():
+                    testcase_manager.copy_testcases_to(testcases.add_generation(name, start))
+                stream = Stream(stream_id, testcases, handler)
+                self._streams[stream_id] = stream
+                print(f"[Streams] new stream: {stream_id} ({len(self._streams)} streams)", flush=True)
+                return stream
+        # another request created the stream first (or took the last free one)
+        handler.stop()
+        return stream
+
+    def streams(self):
+        with self._lock:
+            return list(self._streams.values())
+
+    def active_streams(self):
+        """
+        returns the streams which have received syscalls
+        """
+        return [stream for stream in self.streams() if stream.handler.has_data()]
+
+    def running_generation(self):
+        """
+        returns the generation which was started and not yet stopped, None if there is none
+        """
+        with self._lock:
+            return self._running_generation()
+
+    def _running_generation(self):
+        for generation in self._generations.values():
+            if generation.end is None:
+                return generation
+        return None
+
+    def generations(self):
+        with self._lock:
+            return list(self._generations.values())
+
+    def start_generation(self, name, timestamp=None):
+        """
+        starts a generation at the given timestamp (ns) or now, returns None or why it could not be started
+        """
+        with self._lock:
+            running = self._running_generation()
+            if running is not None and running.name != IMPLICIT_GENERATION:
+                return f"generation \"{running.name}\" already running"
+            if name in self._generations:
+                return f"generation \"{name}\" is still evaluated"
+            evaluated = [other for other in self._generations.values() if other is not running]
+            if self.max_generations is not None and len(evaluated) >= self.max_generations:
+                return f"{len(evaluated)} generations are still evaluated"
+            if running is not None:
+                self._rename_generation(running, name)
+                return None
+            generation = Generation(name, timestamp if timestamp is not None else time.time_ns())
+            self._generations[name] = generation
+            self.testcases.add_generation(name, generation.start)
+            for stream in self._streams.values():
+                stream.testcases.add_generation(name, generation.start)
+            return None
+
+    def _rename_generation(self, generation, name):
+        del self._generations[generation.name]
+        for testcases in [self.testcases] + [stream.testcases for stream in self._streams.values()]:
+            testcases.rename_generation(generation.name, name)
+        generation.name = name
+        self._generations[name] = generation
+
+    def _start_implicit_generation(self, start):
+        generation = Generation(IMPLICIT_GENERATION, start)
+        self._generations[IMPLICIT_GENERATION] = generation
+        self.testcases.add_generation(IMPLICIT_GENERATION, start)
+        for stream in self._streams.values():
+            stream.testcases.add_generation(IMPLICIT_GENERATION, start)
+        return generation
+
+    def stop_generation(self, name, timestamp=None):
+        """
+        stops the running generation if it has the given name, its testcases without end are ended, returns True if stopped
+        """
+        with self._lock:
+            generation = self._generations.get(name)
+            if generation is None or generation.end is not None:
+                return False
+            generation.end = timestamp if timestamp is not None else time.time_ns()
+            for testcases in [self.testcases] + [stream.testcases for stream in self._streams.values()]:
+                testcases.get(name).end_open_testcases(generation.end)
+            return True
+
+    def remove_generation(self, name):
+        """
+        removes the testcases of a generation (after its results are sent)
+        """
+        with self._lock:
+            self._generations.pop(name, None)
+            self.testcases.remove_generation(name)
+            for stream in self._streams.values():
+                stream.testcases.remove_generation(name)
+
+    def add_testcase_from_json(self, json, timestamp=None):
+        """
+        starts a testcase in the running generation, returns False if it has a testcase of this name.
+        without running generation the testcase starts the implicit one (see IMPLICIT_GENERATION)
+        """
+        with self._lock:
+            generation = self._running_generation()
+            if generation is None:
+                if timestamp is None:
+                    timestamp = time.time_ns()
+                generation = self._start_implicit_generation(timestamp)
+            testcases = self.testcases.get(generation.name)
+            if not testcases.add_testcase_from_json(json, timestamp):
+                return False
+            testcase = testcases.get_testcase(json["testcase_name"])
+            for stream in self._streams.values():
+                stream.testcases.get(generation.name)._add_testcase(testcase._name, testcase._start)
+            return True
+
+    def end_testcase_from_json(self, json, timestamp=None):
+        with self._lock:
+            generation = self._running_generation()
+            if generation is None:
+                return False
+            testcases = self.testcases.get(generation.name)
+            if not testcases.end_testcase_from_json(json, timestamp):
+                return False
+            testcase = testcases.get_testcase(json["testcase_name"])
+            for stream in self._streams.values():
+                stream_testcases = stream.testcases.get(generation.name)
+                if stream_testcases.get_testcase(testcase._name) is not None:
+                    stream_testcases._end_testcase(testcase._name, testcase._end)
+            return True
+
+    def generation_testcases(self, name):
+        """
+        returns (stream, TestcaseManager) of the streams which received syscalls for the given generation,
+        (None, testcases without scores) if no stream received syscalls
+        """
+        # a stream which never received syscalls would never finish its testcases
+        sources = [(stream, stream.testcases.get(name)) for stream in self.active_streams()]
+        sources = [(stream, testcases) for stream, testcases in sources if testcases is not None]
+        if not sources:
+            testcases = self.testcases.get(name)
+            return [(None, testcases)] if testcases is not None else []
+        return sources
+
+    def is_complete(self, name):
+        """
+        returns True if the scores of the testcases of the given generation are fixed in all streams
+        """
+        return all(testcases.is_complete() for stream, testcases in self.generation_testcases(name))
+
+    def wait_until_complete(self, name, timeout=None):
+        """
+        waits until is_complete(name) is True, returns False if the timeout (seconds) has passed before
+        """
+        return self._changed.wait_for(lambda: self.is_complete(name), timeout)
+
+    def incomplete_testcases(self, name):
+        """
+        returns (stream id, testcase) of the testcases which is_complete(name) is waiting for
+        """
+        return [(stream.stream_id if stream is not None else None, testcase)
+                for stream, testcases in self.generation_testcases(name) for testcase in testcases.incomplete_testcases()]
+
+    def _testcases_changed(self):
+        # called by the scorers, is_complete is checked by the waiting threads
+        self._changed.set()
+
+    def stop(self):
+        for stream in self.streams():
+            stream.handler.stop()
@@ -0,0 +1,96 @@
+import random
+
+from fstide import RESULT_SYSCALLS
+from model_store import read_json_model
+
+
+def split_element(element):
+    """
+    splits a name_result element (e.g. "read48") into the syscall name and its result
+    returns (name, None) for all other elements
+    """
+    # check longer names first, "readv" must not be taken as "read" with result "v"
+    for syscall_name in sorted(RESULT_SYSCALLS, key=len, reverse=True):
+        if element.startswith(syscall_name) and element != syscall_name:
+            return syscall_name, element[len(syscall_name):]
+    return element, None
+
+
+class SyntheticTrace:
+    """
+    generates sysdig output lines (see syscall.SYSDIG_OUTPUT_FORMAT) which look like a recording
+    of the process a model was trained on: every thread walks through the ngrams of the model
+    (weighted by their counts) and a few threads produce most of the syscalls.
+    with probability noise a random element is inserted, which leads to unknown ngrams
+    """
+
+    def __init__(self, model_file, threads=8, noise=0.01, seed=0, process_name="mosquitto",
+                 start_ns=1_700_000_000_000_000_000, mean_gap_ns=2_000):
+        self._random = random.Random(seed)
+        self._noise = noise
+        self._process_name = process_name
+        self._timestamp = start_ns
+        self._mean_gap_ns = mean_gap_ns
+
+        _, ngrams = read_json_model(model_file)
+        self._ngrams = [ngram for ngram, _ in ngrams]
+        self._weights = [count for _, count in ngrams]
+        # possible next elements (with their counts) for the last n-1 elements of a thread
+        self._successors = {}
+        for ngram, count in ngrams:
+            elements, weights = self._successors.setdefault(ngram[1:], ([], []))
+            elements.append(ngram[-1])
+            weights.append(count)
+
+        # zipf like thread activity: the first threads are the busy ones
+        self._thread_ids = [1000 + index for index in range(threads)]
+        self._thread_weights = [1 / (index + 1) for index in range(threads)]
+        self._histories = {thread_id: self._random_ngram()[1:] for thread_id in self._thread_ids}
+        self._open_syscalls = {}
+
+    def _random_ngram(self):
+        return self._random.choices(self._ngrams, weights=self._weights)[0]
+
+    def _next_element(self, thread_id):
+        history = self._histories[thread_id]
+        if self._random.random() < self._noise:
+            element = self._random.choice(self._ngrams)[0]
+        elif history in self._successors:
+            elements, weights = self._successors[history]
+            element = self._random.choices(elements, weights=weights)[0]
+        else:
+            # dead end (e.g. after noise): continue with a new ngram of the model
+            ngram = self._random_ngram()
+            history = ngram[:-1]
+            element = ngram[-1]
+        self._histories[thread_id] = history[1:] + (element,)
+        return element
+
+    def lines(self, count):
+        """
+        yields count sysdig output lines
+        """
+        for _ in range(count):
+            self._timestamp += self._random.randint(1, 2 * self._mean_gap_ns)
+            thread_id = self._random.choices(self._thread_ids, weights=self._thread_weights)[0]
+            syscall_name, result = split_element(self._next_element(thread_id))
+            # results only exist when leaving a syscall, elements of result syscalls without result are the entering events
+            if result is not None:
+                direction = "<"
+                self._open_syscalls.pop(thread_id, None)
+                args = f"res={result}"
+            elif syscall_name not in RESULT_SYSCALLS and self._open_syscalls.get(thread_id) == syscall_name:
+                direction = "<"
+                self._open_syscalls.pop(thread_id, None)
+                args = "res=0"
+            else:
+                direction = ">"
+                self._open_syscalls[thread_id] = syscall_name
+                args = f"fd={self._random.randint(3, 64)}"
+            yield f"{self._timestamp} {self._process_name} {thread_id} {direction} {syscall_name} {args}"
+
+    def text(self, count):
+        """
+        returns count sysdig output lines as one string
+        """
+        return "".join(line + "\n" for line in self.lines(count))
@@ -1,6 +1,29 @@
 
 from enum import IntEnum
 from datetime import datetime
+from array import array
+
+import numpy as np
+
+from vocabulary import Vocabulary
+
+# output format of "sysdig -p" expected by Syscall and the batch parser
+SYSDIG_OUTPUT_FORMAT = "%evt.rawtime %proc.name %thread.tid %evt.dir %syscall.type %evt.args"
+# names of the events after which a thread is gone (its thread id can be reused afterwards):
+# %syscall.type prints <NA> for the procexit tracepoint of sysdig (it is no syscall), so the exit syscalls of the
+# thread itself are used: exit ends the calling thread, exit_group its whole process (the other threads of the
+# process are not known here and expire as idle). procexit is kept for output formats with %evt.type
+THREAD_EXITS = ("exit", "exit_group", "procexit")
+# thread id of events without thread (sysdig prints -1 or <NA>), the same as in the binary syscall stream
+NO_THREAD = -1
+
+
+def parse_thread_id(field) -> int:
+    try:
+        return int(field)
+    except ValueError:
+        return NO_THREAD
+
 
 class Direction(IntEnum):
     OPEN = 0
@@ -55,7 +78,7 @@ class Syscall:
         """
         if self._timestamp_datetime is None:
             self._timestamp_datetime = datetime.fromtimestamp(
-                int(self._line_list[SyscallSplitPart.TIMESTAMP]) * 10 ** -9)
+                self.timestamp_unix_in_ns() * 10 ** -9)
 
         return self._timestamp_datetime
 
@@ -83,7 +106,7 @@ class Syscall:
 
         """
         if self._thread_id is None:
-            self._thread_id = int(self._line_list[SyscallSplitPart.THREAD_ID])
+            self._thread_id = parse_thread_id(self._line_list[SyscallSplitPart.THREAD_ID])
 
         return self._thread_id
 
@@ -130,8 +153,9 @@ class Syscall:
         """
         if self._params is None:
             self._params = {}
-            if len(self._line_list) > 5:  # check if params are given
-                for param in self._line_list[SyscallSplitPart.PARAMS_BEGIN:]:
+            args = self._args()
+            if args:  # check if params are given
+                for param in args:
                     split = param.split('=', 1)
                     try:
                         self._params[split[Param.NAME]] = split[Param.VALUE]
@@ -139,6 +163,14 @@ class Syscall:
                         pass
         return self._params
 
+    def _args(self) -> list:
+        """
+
+        returns the unparsed params of the recorded line as list of "name=value" strings
+
+        """
+        return self._line_list[SyscallSplitPart.PARAMS_BEGIN:]
+
     def param(self, param_name: str) -> str:
         """
 
@@ -159,3 +191,177 @@ class Syscall:
 
     def __str__(self):
         return f"[{self.name()}, {self.direction()}, {self.params()}]"
+
+
+# direction codes stored in SyscallBatch.directions
+_DIRECTION_CODES = {'>': Direction.OPEN, '<': Direction.CLOSE}
+_DIRECTION_NONE = 255
+
+
+class SyscallRow(Syscall):
+    """
+    view on a single row of a SyscallBatch
+    provides the Syscall api without splitting the recorded line again
+    """
+
+    def __init__(self, batch, index: int):
+        self._batch = batch
+        self._index = index
+        self._timestamp_datetime = None
+        self._params = None
+
+    def timestamp_unix_in_ns(self) -> int:
+        return self._batch.timestamps[self._index]
+
+    def process_name(self) -> str:
+        return self._batch.process_names[self._index]
+
+    def thread_id(self) -> int:
+        return self._batch.thread_ids[self._index]
+
+    def name(self) -> str:
+        return self._batch.names.get_string(self._batch.name_ids[self._index])
+
+    def direction(self) -> Direction:
+        code = self._batch.directions[self._index]
+        if code == _DIRECTION_NONE:
+            return None
+        return Direction(code)
+
+    def _args(self) -> list:
+        if self._batch.args is None:
+            return []
+        args = self._batch.args[self._index]
+        if not args:
+            return []
+        return args.split(' ')
+
+
+class SyscallBatch:
+    """
+    columnar representation of a chunk of sysdig output lines
+
+    timestamps, thread ids and interned syscall name ids are stored in compact arrays,
+    the params of each line are kept as one unsplit string (or not at all, if with_args is False)
+    and are only split when a SyscallRow asks for them
+    """
+
+    def __init__(self, names: Vocabulary, with_args=True):
+        self.names = names
+        self.timestamps = array('q')
+        self.thread_ids = array('q')
+        self.name_ids = array('i')
+        self.directions = bytearray()
+        self.process_names = []
+        self.args = [] if with_args else None
+
+    def append_lines(self, lines):
+        """
+        parses the given sysdig output lines (see SYSDIG_OUTPUT_FORMAT) and appends them as rows
+        lines with less than five columns are skipped
+        """
+        timestamps = self.timestamps
+        thread_ids = self.thread_ids
+        name_ids = self.name_ids
+        directions = self.directions
+        process_names = self.process_names
+        args = self.args
+        known_names = self.names._ids
+        add_name = self.names.get_id
+        # reuse one string object per process name
+        process_name_cache = {}
+
+        for line in lines:
+            parts = line.strip().split(' ', SyscallSplitPart.PARAMS_BEGIN)
+            if len(parts) < SyscallSplitPart.PARAMS_BEGIN:
+                continue
+            timestamps.append(int(parts[SyscallSplitPart.TIMESTAMP]))
+            thread_ids.append(parse_thread_id(parts[SyscallSplitPart.THREAD_ID]))
+            syscall_name = parts[SyscallSplitPart.SYSCALL_NAME]
+            name_id = known_names.get(syscall_name)
+            if name_id is None:
+                name_id = add_name(syscall_name)
+            name_ids.append(name_id)
+            directions.append(_DIRECTION_CODES.get(parts[SyscallSplitPart.DIRECTION], _DIRECTION_NONE))
+            process_name = parts[SyscallSplitPart.PROCESS_NAME]
+            process_names.append(process_name_cache.setdefault(process_name, process_name))
+            if args is not None:
+                args.append(parts[SyscallSplitPart.PARAMS_BEGIN] if len(parts) > SyscallSplitPart.PARAMS_BEGIN else "")
+
+    def rebase_names(self, names: Vocabulary):
+        """
+        moves the name ids of all rows to the given vocabulary (e.g. for batches parsed in another process)
+        """
+        if names is self.names:
+            return
+        mapping = [Vocabulary.EMPTY, Vocabulary.UNKNOWN] + [names.get_id(string) for string in self.names.to_list()]
+        self.name_ids = array('i', [mapping[name_id] for name_id in self.name_ids])
+        self.names = names
+
+    def thread_ids_of(self, syscall_names):
+        """
+        returns the distinct thread ids of the rows with one of the given syscall names (e.g. THREAD_EXITS) as list
+        """
+        name_ids = [self.names._ids[syscall_name] for syscall_name in syscall_names if syscall_name in self.names._ids]
+        if not name_ids:
+            return []
+        rows = np.isin(np.frombuffer(self.name_ids, dtype=np.intc), name_ids)
+        return np.unique(np.frombuffer(self.thread_ids, dtype=np.int64)[rows]).tolist()
+
+    def name_strings(self):
+        """
+        returns the syscall names of all rows as list of strings
+        """
+        strings = self.names.strings()
+        return [strings[name_id] for name_id in self.name_ids]
+
+    def rows(self):
+        """
+        iterates over all rows as SyscallRow views
+        """
+        for index in range(len(self.timestamps)):
+            yield SyscallRow(self, index)
+
+    def __getitem__(self, index: int) -> SyscallRow:
+        if index < 0:
+            index += len(self.timestamps)
+        if not 0 <= index < len(self.timestamps):
+            raise IndexError("SyscallBatch index out of range")
+        return SyscallRow(self, index)
+
+    def __iter__(self):
+        return self.rows()
+
+    def __len__(self):
+        return len(self.timestamps)
+
+
+def read_sysdig_batches(stream, names: Vocabulary, with_args=True, chunk_size=1 << 20, low_latency=False):
+    """
+    reads sysdig output (see SYSDIG_OUTPUT_FORMAT) from the given binary stream in large chunks
+    and yields one SyscallBatch per chunk
+    lines spanning two chunks are carried over to the next batch
+    with low_latency a chunk is whatever the stream has available (read1, at most chunk_size bytes),
+    so live streams yield their events right away instead of waiting for a full chunk
+    """
+    read = stream.read1 if low_latency else stream.read
+    rest = b""
+    while True:
+        chunk = read(chunk_size)
+        if not chunk:
+            break
+        chunk = rest + chunk
+        end = chunk.rfind(b'\n')
+        if end < 0:
+            rest = chunk
+            continue
+        rest = chunk[end + 1:]
+        batch = SyscallBatch(names, with_args)
+        batch.append_lines(chunk[:end].decode('utf-8', errors='replace').split('\n'))
+        if len(batch) > 0:
+            yield batch
+    if rest:
+        batch = SyscallBatch(names, with_args)
+        batch.append_lines([rest.decode('utf-8', errors='replace')])
+        if len(batch) > 0:
+            yield batch
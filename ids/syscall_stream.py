@@ -0,0 +1,123 @@
+from array import array
+
+import numpy as np
+
+from syscall import SyscallBatch, _DIRECTION_NONE, Direction
+from vocabulary import Vocabulary
+
+# compact binary syscall stream, written by the agent when it transcodes its recordings (agent.py --transcode)
+# the writer is agent/transcoder.py, both have to agree on this format:
+#   magic SYSCALL_STREAM_MAGIC, then records, each starting with a tag byte
+#   'N' name definition:   varint id, varint length, utf-8 syscall name  (ids are numbered from 0 by the writer)
+#   'R' result definition: varint id, varint length, utf-8 result string (value of the "res" param)
+#   'B' block of events:   varint count, zigzag varint base timestamp (ns), then five columns,
+#                          each as varint byte length followed by the data:
+#       timestamps: count zigzag varints, delta to the previous timestamp (the first one to the base)
+#       thread ids: count zigzag varints (-1 for events without thread)
+#       name ids:   count varints
+#       directions: count bytes, 0 = none, 1 = '>', 2 = '<'
+#       results:    count varints, 0 = no result, id + 1 otherwise (empty column if the stream has no results)
+#   definitions always come before the first block using them
+SYSCALL_STREAM_MAGIC = b"IDSSYSC2"
+SYSCALL_STREAM_SUFFIX = ".sysc"
+
+# directions column -> SyscallBatch.directions
+_DIRECTIONS = np.array([_DIRECTION_NONE, Direction.OPEN, Direction.CLOSE] + [_DIRECTION_NONE] * 253, dtype=np.uint8)
+
+
+def decode_varints(data, count):
+    """
+    decodes count LEB128 varints from the given bytes at once, returns an uint64 array
+    """
+    values = np.frombuffer(data, dtype=np.uint8)
+    ends = np.flatnonzero(values < 0x80)
+    if len(ends) != count or (count and ends[-1] != len(values) - 1):
+        raise ValueError(f"damaged syscall stream: expected {count} varints")
+    if count == 0:
+        return np.zeros(0, dtype=np.uint64)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    # position of every byte within its varint
+    positions = np.arange(len(values)) - np.repeat(starts, ends - starts + 1)
+    parts = (values & 0x7f).astype(np.uint64) << (7 * positions).astype(np.uint64)
+    return np.bitwise_or.reduceat(parts, starts)
+
+
+def _unzigzag(values):
+    return (values >> np.uint64(1)).astype(np.int64) ^ -(values & np.uint64(1)).astype(np.int64)
+
+
+class _Reader:
+    def __init__(self, stream):
+        self._stream = stream
+
+    def read(self, size):
+        data = self._stream.read(size)
+        while len(data) < size:
+            more = self._stream.read(size - len(data))
+            if not more:
+                raise ValueError("syscall stream ends within a record")
+            data += more
+        return data
+
+    def varint(self):
+        value = 0
+        shift = 0
+        while True:
+            byte = self.read(1)[0]
+            value |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return value
+            shift += 7
+
+    def zigzag(self):
+        value = self.varint()
+        return (value >> 1) ^ -(value & 1)
+
+
+def read_syscall_stream(stream, names: Vocabulary, with_args=True):
+    """
+    reads a binary syscall stream from the given binary stream and yields one SyscallBatch per block
+    the batches have no process names, their args only hold the result ("res=...")
+    """
+    reader = _Reader(stream)
+    if reader.read(len(SYSCALL_STREAM_MAGIC)) != SYSCALL_STREAM_MAGIC:
+        raise ValueError("not a syscall stream")
+    # stream ids -> ids of names, and stream result ids + 1 -> args
+    name_ids = []
+    result_args = [""]
+    while True:
+        tag = stream.read(1)
+        if not tag:
+            return
+        if tag == b"N":
+            stream_id = reader.varint()
+            name = reader.read(reader.varint()).decode('utf-8', errors='replace')
+            name_ids.extend([Vocabulary.UNKNOWN] * (stream_id + 1 - len(name_ids)))
+            name_ids[stream_id] = names.get_id(name)
+        elif tag == b"R":
+            stream_id = reader.varint()
+            result = reader.read(reader.varint()).decode('utf-8', errors='replace')
+            result_args.extend([""] * (stream_id + 2 - len(result_args)))
+            result_args[stream_id + 1] = "res=" + result
+        elif tag == b"B":
+            count = reader.varint()
+            base = reader.zigzag()
+            columns = [reader.read(reader.varint()) for _ in range(5)]
+            timestamps = base + np.cumsum(_unzigzag(decode_varints(columns[0], count)))
+            name_map = np.array(name_ids, dtype=np.int32)
+
+            batch = SyscallBatch(names, with_args)
+            batch.timestamps = array('q', timestamps.tobytes())
+            batch.thread_ids = array('q', _unzigzag(decode_varints(columns[1], count)).tobytes())
+            batch.name_ids = array('i', name_map[decode_varints(columns[2], count).astype(np.intp)].tobytes())
+            batch.directions = bytearray(_DIRECTIONS[np.frombuffer(columns[3], dtype=np.uint8)].tobytes())
+            batch.process_names = [""] * count
+            if with_args:
+                if columns[4]:
+                    batch.args = [result_args[result] for result in decode_varints(columns[4], count).tolist()]
+                else:
+                    batch.args = [""] * count
+            if count:
+                yield batch
+        else:
+            raise ValueError(f"damaged syscall stream: unknown record {tag}")
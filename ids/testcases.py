@@ -4,10 +4,49 @@
 
 import time
 import threading
+from bisect import bisect_right
+
+import numpy as np
 
 from ids_helper import timestamp_in_hh_mm_ss
 from stats import Stats
 
+# end of a testcase without end in the end array of the interval index
+_OPEN_END = np.iinfo(np.int64).max
+
+class ChangeSignal:
+    """
+    signals changes to any number of waiting threads: wait_for(predicate) checks the predicate again after every set()
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._changes = 0
+
+    def set(self):
+        with self._condition:
+            self._changes += 1
+            self._condition.notify_all()
+
+    def wait_for(self, predicate, timeout=None):
+        """
+        waits until predicate() is True, returns False if the timeout (seconds) has passed before
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._condition:
+                changes = self._changes
+            # checked without the condition, the predicate can take other locks (e.g. of the StreamRegistry)
+            if predicate():
+                return True
+            with self._condition:
+                while self._changes == changes:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self._condition.wait(remaining)
+
+
 class Testcase:
     def __init__(self, name, start, end=None):
         self._name = name
@@ -17,6 +56,8 @@ class Testcase:
         self._has_score = False  # If True, it indicates that an IDS score has been set for this Testcase
         self._is_finished = False  # If True, it indicates that no more IDS scores will be added to this Testcase
         self._score_stats = Stats()
+        # scores of the ensemble detectors (see ensemble.py): detector name -> Stats
+        self._detector_stats = {}
 
     def is_finished(self):
         return self._is_finished
@@ -32,9 +73,36 @@ class Testcase:
         self._score_stats.add_value(score)
         self._has_score = True
 
+    def add_scores(self, scores, detector=None):
+        """adds several IDS scores at once (e.g. a numpy array), of the given ensemble detector if not None"""
+        if len(scores) == 0:
+            return
+        if detector is not None:
+            if detector not in self._detector_stats:
+                self._detector_stats[detector] = Stats()
+            self._detector_stats[detector].add_values(scores)
+            return
+        self._max_score = max(self._max_score, float(np.max(scores)))
+        self._score_stats.add_values(scores)
+        self._has_score = True
+
     def get_avg_value(self):
         return self._score_stats.get_average()
 
+    def get_quantile_value(self, quantile):
+        return self._score_stats.get_quantile(quantile)
+
+    def get_detector_scores(self, detectors):
+        """returns {detector name: {score name: value}} for the given ensemble detectors, 0 for detectors without scores"""
+        result = {}
+        for detector in detectors:
+            stats = self._detector_stats.get(detector, Stats())
+            result[detector] = {
+                "anomaly-score-max": stats.get_max(), "anomaly-score-avg": stats.get_average(),
+                "anomaly-score-p50": stats.get_quantile(0.5), "anomaly-score-p95": stats.get_quantile(0.95),
+                "anomaly-score-p99": stats.get_quantile(0.99)}
+        return result
+
     def __str__(self) -> str:
         return f"[TC: {self._name}, {timestamp_in_hh_mm_ss(self._start)} - {timestamp_in_hh_mm_ss(self._end)}, {self._max_score}]"
 
@@ -52,6 +120,10 @@ class SafeDict:
         with self._lock:
             self._dict[key] = value
 
+    def get(self, key):
+        with self._lock:
+            return self._dict.get(key)
+
     def remove(self, key):
         with self._lock:
             if key in self._dict:
@@ -78,69 +150,317 @@ class SafeDict:
 
 
 class TestcaseManager:
-    def __init__(self):
+    def __init__(self, on_change=None):
+        self._index_lock = threading.Lock()
+        # called (without arguments) whenever a Testcase gets its first score or is finished, see wait_until_complete
+        self._on_change = on_change
+        self._changed_event = ChangeSignal()
         self.reset()
 
     def is_complete(self):
         """Returns True if the IDS scores of all its Testcases are fixed (i.e., they won't change anymore)"""
-        result = True
-        for testcase in self._testcases.iterate_values():
-            if not testcase.has_score() and not testcase.is_finished():
-                print(f"Testcase {testcase} has no value yet!", flush=True)
-                result = False
-        return result
+        return not self.incomplete_testcases()
+
+    def incomplete_testcases(self):
+        """Returns the Testcases which have no IDS score yet and can still get one"""
+        return [testcase for testcase in self._testcases.iterate_values() if not testcase.has_score() and not testcase.is_finished()]
+
+    def wait_until_complete(self, timeout=None):
+        """Waits until is_complete() is True, returns False if the timeout (seconds) has passed before"""
+        return self._changed_event.wait_for(self.is_complete, timeout)
+
+    def _changed(self):
+        # a Testcase got its first score or was finished, the completion of the Testcases has to be checked again
+        self._changed_event.set()
+        if self._on_change is not None:
+            self._on_change()
 
     def reset(self):
         self._testcases = SafeDict()
         self._last_inserted_testcase = None
         self._current_testcase = None
+        with self._index_lock:
+            # interval index: testcases ordered by start, starting a testcase ends the previous one,
+            # so the time windows do not overlap
+            self._index = []
+            self._starts = []
+            # the starts and ends of the index as numpy arrays for attribute_scores, with spare room at the end,
+            # so adding a testcase is amortized O(1)
+            self._start_array = np.zeros(16, dtype=np.int64)
+            self._end_array = np.zeros(16, dtype=np.int64)
+            # all testcases in front of the cursor are finished
+            self._cursor = 0
+            self._last_lookup = None
+        self._changed()
+
+    def _advance(self, timestamp):
+        """
+        Moves the cursor over all testcases which ended before the given timestamp and marks them as finished
+        returns True if a testcase was finished
+        """
+        index = self._index
+        cursor = self._cursor
+        while self._cursor < len(index) and index[self._cursor]._end is not None and index[self._cursor]._end < timestamp:
+            index[self._cursor].set_is_finished(True)
+            self._cursor += 1
+        return self._cursor != cursor
+
+    def _insert_interval(self, position, start, end):
+        # called after the testcase was inserted into the index
+        count = len(self._index) - 1
+        if count == len(self._start_array):
+            self._start_array = np.concatenate((self._start_array, np.zeros(count, dtype=np.int64)))
+            self._end_array = np.concatenate((self._end_array, np.zeros(count, dtype=np.int64)))
+        # testcases from the past (clock went backwards) are inserted in front of the later ones
+        self._start_array[position + 1:count + 1] = self._start_array[position:count]
+        self._end_array[position + 1:count + 1] = self._end_array[position:count]
+        self._start_array[position] = start
+        self._end_array[position] = _OPEN_END if end is None else end
+
+    def _set_end(self, testcase, end):
+        testcase._end = end
+        position = bisect_right(self._starts, testcase._start) - 1
+        while self._index[position] is not testcase:
+            position -= 1
+        self._end_array[position] = end
 
     def get_matching_testcases(self, timestamp):
         """Returns all Testcases of this TestcaseManager whose time window includes the given timestamp"""
-        # TODO: If I am not mistaken, then there can be at max one test case which matches a given time stamp. So, the list might not be necessary.
-        #  However, the iteration over all testcases here still makes sense to set testcases as 'finished' for which no more IDS updates are expected.
-        test_case_list = []
-        for testcase in self._testcases.iterate_values():
-                # Making sure that the testcases starts before or at the given timestamp
-                if testcase._start <= timestamp:
-                    if testcase._end is None or timestamp <= testcase._end:
-                        # We add the testcase if it does not have any defined end or if its end is after or at the given timestamp              
-                        test_case_list.append(testcase)
-                    elif testcase._end is not None and testcase._end < timestamp:
-                        # If the testcase has a defined end and but it is smaller than the timestamp, then we assume that
-                        # the IDS is already processing syscalls which happened after this testcase. This testcase will
-                        # thus not receive any more updates from the IDS and we consider it finished 
-                        testcase.set_is_finished(True)
+        # Testcases which end before the given timestamp will not receive any more updates from the IDS, as the
+        # IDS is already processing syscalls which happened after them. We consider them finished.
+        # The syscall timestamps usually increase, so the lookup starts at the cursor and moves it forward.
+        changed = False
+        with self._index_lock:
+            index = self._index
+            end = bisect_right(self._starts, timestamp)
+            if self._last_lookup is None or timestamp >= self._last_lookup:
+                changed = self._advance(timestamp)
+                self._last_lookup = timestamp
+                begin = self._cursor
+            else:
+                # the timestamp went backwards: search back from the last testcase starting before it
+                begin = end
+                while begin > 0 and (index[begin - 1]._end is None or index[begin - 1]._end >= timestamp):
+                    begin -= 1
+            test_case_list = []
+            for testcase in index[begin:end]:
+                if testcase._end is None or timestamp <= testcase._end:
+                    test_case_list.append(testcase)
+                elif not testcase.is_finished():
+                    testcase.set_is_finished(True)
+                    changed = True
+        if changed:
+            self._changed()
         return test_case_list
-        
+
+    def advance_to(self, timestamp):
+        """
+        Tells the TestcaseManager that all syscalls up to the given timestamp have been processed,
+        Testcases which ended before it are marked as finished
+        """
+        with self._index_lock:
+            changed = self._advance(timestamp)
+            if self._last_lookup is None or timestamp > self._last_lookup:
+                self._last_lookup = timestamp
+        if changed:
+            self._changed()
+
+    def attribute_scores(self, timestamps, scores, detector=None):
+        """
+        Adds the given IDS scores to the Testcases whose time windows include the timestamps of the scores
+        timestamps and scores are numpy arrays of the same length, returns the number of attributed scores
+        detector: name of the ensemble detector the scores are from, None for the scores of the IDS
+        the Testcases which ended before the scores are finished after the scores are added (only with the scores of the IDS,
+        they are added after the ones of the ensemble detectors), so a waiting evaluation never sees a Testcase
+        as finished which is still missing scores of this batch
+        """
+        if len(timestamps) == 0:
+            return 0
+        groups = []
+        with self._index_lock:
+            count = len(self._index)
+            # the syscall timestamps usually increase: the testcases in front of the cursor ended before them
+            first = self._cursor
+            if first >= count or self._start_array[first] > timestamps.min():
+                first = max(int(np.searchsorted(self._start_array[:count], timestamps.min(), side='right')) - 1, 0)
+            starts = self._start_array[first:count]
+            ends = self._end_array[first:count]
+            # the only candidate for each timestamp is the last testcase starting before it
+            positions = np.searchsorted(starts, timestamps, side='right') - 1
+            matching = positions >= 0
+            matching[matching] = timestamps[matching] <= ends[positions[matching]]
+            positions = positions[matching]
+            scores = scores[matching]
+            if len(positions) > 0:
+                # the scores of each testcase are added at once
+                order = np.argsort(positions, kind='stable')
+                positions = positions[order]
+                scores = scores[order]
+                bounds = np.flatnonzero(np.diff(positions)) + 1
+                for begin, end in zip(np.concatenate(([0], bounds)).tolist(), np.concatenate((bounds, [len(positions)])).tolist()):
+                    groups.append((self._index[first + int(positions[begin])], scores[begin:end]))
+        changed = False
+        for testcase, testcase_scores in groups:
+            # the first IDS score of a testcase completes it
+            changed = changed or (detector is None and not testcase.has_score())
+            testcase.add_scores(testcase_scores, detector)
+        if detector is None:
+            with self._index_lock:
+                changed = self._advance(int(timestamps.max())) or changed
+                if self._last_lookup is None or timestamps[-1] > self._last_lookup:
+                    self._last_lookup = int(timestamps[-1])
+        if changed:
+            self._changed()
+        return len(positions)
+
+    def get_testcase(self, name):
+        """Returns the Testcase of the given name, None if there is none"""
+        return self._testcases.get(name)
+
+    def copy_testcases_to(self, other):
+        """Adds the name and time window of all Testcases to the other TestcaseManager (without scores)"""
+        with self._index_lock:
+            testcases = [(testcase._name, testcase._start, testcase._end) for testcase in self._index]
+        for name, start, end in testcases:
+            other._add_testcase(name, start, end)
+
     def _get_last_testcase(self):
         return self._last_inserted_testcase
     
     def _add_testcase(self, name, start, end=None):
         temp_testcase = Testcase(name, start, end)
-        if self._get_last_testcase() is not None:
-            if self._get_last_testcase()._end is None:
-                self._get_last_testcase()._end = start-1
+        with self._index_lock:
+            if self._get_last_testcase() is not None:
+                if self._get_last_testcase()._end is None:
+                    self._set_end(self._get_last_testcase(), start-1)
+            position = bisect_right(self._starts, start)
+            self._starts.insert(position, start)
+            self._index.insert(position, temp_testcase)
+            self._insert_interval(position, start, end)
+            if position < self._cursor:
+                # a testcase from the past (clock went backwards), it has to be looked at again
+                self._cursor = position
         self._testcases.add(name,temp_testcase)
         self._last_inserted_testcase = temp_testcase
         
     def _end_testcase(self , name, timestamp):
         temp_testcase = self._testcases._dict[name]
-        temp_testcase._end = timestamp
+        with self._index_lock:
+            self._set_end(temp_testcase, timestamp)
 
-    def add_testcase_from_json(self, json):
+    def add_testcase_from_json(self, json, timestamp=None):
+        # timestamp: when the request was received (ns), now if None
         if json["testcase_name"] in self._testcases:
             return False
         else:
-            self._add_testcase(json["testcase_name"], time.time_ns())
+            self._add_testcase(json["testcase_name"], timestamp if timestamp is not None else time.time_ns())
             return True
         
-    def end_testcase_from_json(self, json):
+    def end_testcase_from_json(self, json, timestamp=None):
         if json["testcase_name"] in self._testcases:
             if self._testcases._dict[json["testcase_name"]]._end is not None:
                 return False
             else:
-                self._end_testcase(json["testcase_name"], time.time_ns())
+                self._end_testcase(json["testcase_name"], timestamp if timestamp is not None else time.time_ns())
                 return True
         else:
             return False
+
+    def end_open_testcases(self, timestamp):
+        """Ends all Testcases without end at the given timestamp (e.g. at the end of their generation)"""
+        with self._index_lock:
+            for position, testcase in enumerate(self._index):
+                if testcase._end is None:
+                    testcase._end = timestamp
+                    self._end_array[position] = timestamp
+
+
+class GenerationTestcases:
+    """
+    the TestcaseManagers of the generations in flight (of one stream), each syscall timestamp belongs to the
+    generation started last before it. provides advance_to, attribute_scores and get_matching_testcases of
+    TestcaseManager, so the scorer does not need to know about generations
+    """
+
+    def __init__(self, on_change=None):
+        self._on_change = on_change
+        self._lock = threading.Lock()
+        # ordered by start, the generations do not overlap as fuzzino stops a generation before it starts the next one
+        self._starts = []
+        self._names = []
+        self._managers = []
+
+    def add_generation(self, name, start):
+        """Adds a generation starting at the given timestamp (ns), returns its TestcaseManager"""
+        testcase_manager = TestcaseManager(on_change=self._on_change)
+        with self._lock:
+            position = bisect_right(self._starts, start)
+            # copies, so the scorer can go over the lists without the lock
+            self._starts = self._starts[:position] + [start] + self._starts[position:]
+            self._names = self._names[:position] + [name] + self._names[position:]
+            self._managers = self._managers[:position] + [testcase_manager] + self._managers[position:]
+        return testcase_manager
+
+    def remove_generation(self, name):
+        with self._lock:
+            if name in self._names:
+                position = self._names.index(name)
+                self._starts = self._starts[:position] + self._starts[position + 1:]
+                self._names = self._names[:position] + self._names[position + 1:]
+                self._managers = self._managers[:position] + self._managers[position + 1:]
+
+    def rename_generation(self, name, new_name):
+        with self._lock:
+            if name in self._names:
+                position = self._names.index(name)
+                self._names = self._names[:position] + [new_name] + self._names[position + 1:]
+
+    def get(self, name):
+        """Returns the TestcaseManager of the given generation, None if there is none"""
+        with self._lock:
+            if name in self._names:
+                return self._managers[self._names.index(name)]
+            return None
+
+    def generations(self):
+        """Returns (name, start, TestcaseManager) of the generations in flight, ordered by start"""
+        with self._lock:
+            return list(zip(self._names, self._starts, self._managers))
+
+    def _started_before(self, timestamp):
+        # the TestcaseManagers of the generations started up to the timestamp
+        with self._lock:
+            return self._managers[:bisect_right(self._starts, timestamp)]
+
+    def advance_to(self, timestamp):
+        # a timestamp of a later generation also finishes the testcases of the earlier ones
+        for testcase_manager in self._started_before(timestamp):
+            testcase_manager.advance_to(timestamp)
+
+    def get_matching_testcases(self, timestamp):
+        testcase_managers = self._started_before(timestamp)
+        for testcase_manager in testcase_managers[:-1]:
+            testcase_manager.advance_to(timestamp)
+        return testcase_managers[-1].get_matching_testcases(timestamp) if testcase_managers else []
+
+    def attribute_scores(self, timestamps, scores, detector=None):
+        if len(timestamps) == 0:
+            return 0
+        with self._lock:
+            starts = np.array(self._starts, dtype=np.int64)
+            managers = self._managers
+        if len(managers) == 0:
+            return 0
+        # syscalls before the first generation in flight do not belong to any testcase
+        positions = np.searchsorted(starts, timestamps, side='right') - 1
+        newest = int(timestamps.max())
+        attributed = 0
+        for position in range(int(positions.max()) + 1):
+            matching = positions == position
+            if matching.any():
+                attributed += managers[position].attribute_scores(timestamps[matching], scores[matching], detector)
+            # the earlier generations are advanced to the newest timestamp, after their scores are added
+            # (only with the scores of the IDS, which are attributed after the ones of the ensemble detectors)
+            if detector is None:
+                managers[position].advance_to(newest)
+        return attributed
@@ -0,0 +1,157 @@
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import ids_helper
+from syscall import SYSDIG_OUTPUT_FORMAT, read_sysdig_batches
+from syscall_stream import SYSCALL_STREAM_SUFFIX, read_syscall_stream
+from vocabulary import Vocabulary
+from ngram_table import pack_windows
+from replay import create_detector
+
+# trains an ASTIDE or FSTIDE model offline on a directory of recordings:
+#   scap files (decoded with sysdig), sysdig output text files (*.txt, see syscall.SYSDIG_OUTPUT_FORMAT)
+#   and binary syscall streams (*.sysc, see syscall_stream.py)
+# every file is counted in its own worker process (map), the ngram counts are merged into one model (reduce).
+# the ngrams of a thread continue within a file, but not across files.
+# the report shows how many unique ngrams had been seen after which time of recording and where the early stopping
+# of the live training (no new ngram for es_training_seconds) would have ended the training
+#   python3 train_offline.py algorithm features model_file directory [--workers=N] [--report-interval=SECONDS] [--curve=FILE]
+
+TEXT_SUFFIX = ".txt"
+
+
+def _batches(file_path, names, with_args):
+    if file_path.endswith(SYSCALL_STREAM_SUFFIX):
+        with open(file_path, 'rb') as stream_file:
+            yield from read_syscall_stream(stream_file, names, with_args=with_args)
+    elif file_path.endswith(TEXT_SUFFIX):
+        with open(file_path, 'rb') as text_file:
+            yield from read_sysdig_batches(text_file, names, with_args=with_args)
+    else:
+        with subprocess.Popen(["sysdig", "-r", file_path, "-p", SYSDIG_OUTPUT_FORMAT], stdout=subprocess.PIPE) as proc:
+            yield from read_sysdig_batches(proc.stdout, names, with_args=with_args)
+
+
+def count_file(file_path, algorithm, features):
+    """
+    runs in a worker process: counts the ngrams of one recording
+    returns the number of syscalls, the first and last timestamp and {ngram tuple: [count, first timestamp]}
+    """
+    detector = create_detector(algorithm, None, features, mode="training")
+    strings = detector._ngram_builder.vocabulary.strings()
+    counts = {}
+    syscalls = 0
+    first_timestamp = last_timestamp = None
+    for batch in _batches(file_path, Vocabulary(), detector.needs_syscall_params):
+        syscalls += len(batch)
+        if first_timestamp is None:
+            first_timestamp = batch.timestamps[0]
+        last_timestamp = batch.timestamps[-1]
+        windows = detector.ngram_windows(batch)
+        complete = np.flatnonzero(windows[:, 0] != 0)
+        if len(complete) == 0:
+            continue
+        # count the distinct ngrams of the batch at once
+        keys = pack_windows(windows[complete], detector._ngram_builder.bits)
+        _, first_rows, batch_counts = np.unique(keys, return_index=True, return_counts=True)
+        timestamps = np.frombuffer(batch.timestamps, dtype=np.int64)
+        for row, count in zip(complete[first_rows].tolist(), batch_counts.tolist()):
+            ngram = tuple(strings[element_id] for element_id in windows[row].tolist())
+            entry = counts.get(ngram)
+            if entry is None:
+                counts[ngram] = [count, int(timestamps[row])]
+            else:
+                entry[0] += count
+    return syscalls, first_timestamp, last_timestamp, counts
+
+
+def recordings(directory):
+    return sorted(os.path.join(directory, file_name) for file_name in os.listdir(directory)
+                  if os.path.isfile(os.path.join(directory, file_name)) and not file_name.startswith("."))
+
+
+def merge(results):
+    """
+    merges the ngram counts of count_file, the first occurrence of an ngram is the earliest of all files
+    """
+    merged = {}
+    for _, _, _, counts in results:
+        for ngram, (count, first_seen) in counts.items():
+            entry = merged.get(ngram)
+            if entry is None:
+                merged[ngram] = [count, first_seen]
+            else:
+                entry[0] += count
+                entry[1] = min(entry[1], first_seen)
+    return merged
+
+
+def early_stopping_point(first_seen, end, es_seconds):
+    """
+    returns the timestamp at which the live training would have stopped (no new ngram for es_seconds)
+    and the number of unique ngrams by then, or None if new ngrams were found until the end
+    """
+    es_ns = int(es_seconds * 1_000_000_000)
+    for index, timestamp in enumerate(first_seen):
+        next_new = first_seen[index + 1] if index + 1 < len(first_seen) else end
+        if next_new - timestamp >= es_ns:
+            return timestamp + es_ns, index + 1
+    return None
+
+
+def report(merged, start, end, es_seconds, interval_seconds, curve_file=None):
+    first_seen = sorted(first for _, first in merged.values())
+    total = len(first_seen)
+    print(f"[Training] unique ngrams over time of recording (every {interval_seconds}s):")
+    rows = []
+    interval_ns = int(interval_seconds * 1_000_000_000)
+    for timestamp in range(start, end + interval_ns, interval_ns):
+        unique = int(np.searchsorted(first_seen, min(timestamp, end), side='right'))
+        rows.append(((min(timestamp, end) - start) / 1_000_000_000, unique))
+    for seconds, unique in rows:
+        print(f"[Training] {seconds:10.1f}s {unique:8d} ({100 * unique / total if total else 0:5.1f}%)")
+    if curve_file is not None:
+        with open(curve_file, 'w') as curve:
+            curve.write("seconds,unique_ngrams\n")
+            curve.writelines(f"{seconds},{unique}\n" for seconds, unique in rows)
+    stop = early_stopping_point(first_seen, end, es_seconds)
+    if stop is None:
+        print(f"[Training] no early stopping point: new ngrams were found less than {es_seconds}s before the end of the recordings")
+    else:
+        timestamp, unique = stop
+        print(f"[Training] early stopping ({es_seconds}s without new ngram) after {(timestamp - start) / 1_000_000_000:.1f}s "
+              f"of recording with {unique} of {total} unique ngrams ({100 * unique / total:.1f}%)")
+
+
+if __name__ == "__main__":
+    arguments, options = ids_helper.split_options(sys.argv)
+    if len(arguments) != 5:
+        print("needed arguments: algorithm features model_file directory [--workers=N] [--report-interval=SECONDS] [--curve=FILE]")
+        exit()
+    algorithm, features, model_file, directory = arguments[1:5]
+    files = recordings(directory)
+    if not files:
+        print(f"[Training] no recordings in {directory}")
+        exit()
+    workers = int(options.get("workers", os.cpu_count() or 1))
+
+    start_time = time.time()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(count_file, files, [algorithm] * len(files), [features] * len(files)))
+    results = [result for result in results if result[1] is not None]
+    merged = merge(results)
+    syscalls = sum(result[0] for result in results)
+    print(f"[Training] {len(files)} files, {syscalls} syscalls, {len(merged)} unique ngrams in {time.time() - start_time:.1f}s ({workers} workers)")
+
+    detector = create_detector(algorithm, model_file, features, mode="training")
+    detector.merge_ngrams((ngram, count) for ngram, (count, _) in merged.items())
+    detector.save_model(model_file)
+
+    if results:
+        report(merged, min(result[1] for result in results), max(result[2] for result in results),
+               detector._early_stopping_seconds, float(options.get("report-interval", 60)), options.get("curve"))
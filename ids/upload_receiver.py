@@ -0,0 +1,100 @@
+import threading
+import time
+import zlib
+
+_CHUNK_SIZE = 1 << 20
+# seconds without upload after which a session is forgotten (the agent uploads a file every 10 s while it runs)
+SESSION_IDLE_SECONDS = 3600
+
+
+def decompress_to_file(stream, file_name, content_encoding=None):
+    """
+    copies the given request body stream to a file, gzip/deflate bodies are decompressed on the fly
+    returns the number of bytes written
+    """
+    decompressor = None
+    if content_encoding in ("gzip", "deflate"):
+        # + 32: detect the gzip or zlib header automatically
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS + 32)
+    elif content_encoding not in (None, "", "identity"):
+        raise ValueError(f"unsupported content encoding {content_encoding}")
+    written = 0
+    with open(file_name, 'wb') as output:
+        while True:
+            chunk = stream.read(_CHUNK_SIZE)
+            if not chunk:
+                break
+            if decompressor is not None:
+                chunk = decompressor.decompress(chunk)
+            output.write(chunk)
+            written += len(chunk)
+        if decompressor is not None:
+            chunk = decompressor.flush()
+            output.write(chunk)
+            written += len(chunk)
+            if not decompressor.eof:
+                raise ValueError("compressed upload is incomplete")
+    return written
+
+
+class SequenceGate:
+    """
+    passes items which arrive out of order (e.g. uploads of several parallel connections) on in the order
+    of their sequence numbers, separately for every session (e.g. one run of an agent)
+    with every item the sender tells which sequence numbers it will not send anymore (acked: all lower ones),
+    so a gap of an item the sender has given up on does not block the session forever.
+    sessions without put for idle_seconds are forgotten, their waiting items are passed on in order
+    """
+
+    def __init__(self, release, idle_seconds=SESSION_IDLE_SECONDS):
+        # release(item) is called in order, while the gate is locked
+        self._release = release
+        self._idle_seconds = idle_seconds
+        self._lock = threading.Lock()
+        self._next = {}
+        self._waiting = {}
+        # session -> time.monotonic() of its last put
+        self._last_put = {}
+
+    def put(self, session, sequence, item, acked=None):
+        """
+        returns False if the item was already passed on (a repeated upload), True otherwise
+        """
+        with self._lock:
+            self._expire_sessions(session)
+            expected = self._next.get(session)
+            if expected is None:
+                expected = sequence if acked is None else acked
+            if acked is not None:
+                expected = max(expected, acked)
+            waiting = self._waiting.setdefault(session, {})
+            if sequence < expected or sequence in waiting:
+                self._next[session] = expected
+                return False
+            waiting[sequence] = item
+            # the sender gave up the predecessors of these items, they do not have to wait anymore
+            for skipped in sorted(number for number in waiting if number < expected):
+                self._release(waiting.pop(skipped))
+            while expected in waiting:
+                self._release(waiting.pop(expected))
+                expected += 1
+            self._next[session] = expected
+            return True
+
+    def _expire_sessions(self, session):
+        now = time.monotonic()
+        self._last_put[session] = now
+        for idle in [other for other, last_put in self._last_put.items() if now - last_put > self._idle_seconds]:
+            # the sender is gone, the gaps will not be filled anymore
+            waiting = self._waiting.pop(idle, {})
+            for sequence in sorted(waiting):
+                self._release(waiting.pop(sequence))
+            del self._next[idle]
+            del self._last_put[idle]
+
+    def waiting(self):
+        """
+        returns the number of items waiting for their predecessors
+        """
+        with self._lock:
+            return sum(len(waiting) for waiting in self._waiting.values())
@@ -0,0 +1,62 @@
+class Vocabulary:
+    """
+    maps strings (syscall names or mapped syscall features) to small integer ids and back
+    id 0 is reserved for an empty slot and id 1 for strings unknown to a frozen vocabulary,
+    so the first real string gets id 2
+    """
+    EMPTY = 0
+    UNKNOWN = 1
+
+    def __init__(self, strings=None):
+        self._ids = {}
+        self._strings = ["", "<unknown>"]
+        # a frozen vocabulary does not grow anymore, unseen strings are mapped to UNKNOWN
+        self.frozen = False
+        if strings is not None:
+            for string in strings:
+                self.add(string)
+
+    def add(self, string: str) -> int:
+        """
+        adds the given string (if not yet known) and returns its id
+        """
+        string_id = self._ids.get(string)
+        if string_id is None:
+            string_id = len(self._strings)
+            self._ids[string] = string_id
+            self._strings.append(string)
+        return string_id
+
+    def get_id(self, string: str) -> int:
+        """
+        returns the id of the given string
+        unknown strings are added, or mapped to UNKNOWN if the vocabulary is frozen
+        """
+        string_id = self._ids.get(string)
+        if string_id is None:
+            if self.frozen:
+                return Vocabulary.UNKNOWN
+            return self.add(string)
+        return string_id
+
+    def get_string(self, string_id: int) -> str:
+        return self._strings[string_id]
+
+    def strings(self):
+        """
+        returns the list of strings indexed by their id (including the two reserved entries)
+        """
+        return self._strings
+
+    def to_list(self):
+        """
+        returns the known strings ordered by id, without the reserved entries
+        """
+        return self._strings[2:]
+
+    def __contains__(self, string):
+        return string in self._ids
+
+    def __len__(self):
+        # number of ids in use, including the reserved ones
+        return len(self._strings)